@@ -0,0 +1,49 @@
+from argparse import ArgumentParser
+from time import perf_counter
+import numpy as np
+
+from fractal_zero.vectorized_environment import SerialVectorizedEnvironment
+
+
+def benchmark_cloning(
+    env_id: str, num_walkers: int, steps: int, clone_rate: float, use_snapshots: bool
+) -> float:
+    vec_env = SerialVectorizedEnvironment(
+        env_id, n=num_walkers, use_snapshots=use_snapshots
+    )
+    vec_env.batch_reset()
+    frozen_mask = np.zeros(num_walkers, dtype=bool)
+    vec_env.batch_step(vec_env.batched_action_space_sample(), frozen_mask)
+
+    rng = np.random.default_rng(0)
+    total = 0.0
+    for _ in range(steps):
+        partners = rng.integers(0, num_walkers, size=num_walkers)
+        clone_mask = rng.uniform(size=num_walkers) < clone_rate
+
+        start = perf_counter()
+        vec_env.clone(partners, clone_mask)
+        total += perf_counter() - start
+
+    return total / steps
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("env_cloning")
+    parser.add_argument("--env", type=str, default="CartPole-v0")
+    parser.add_argument("--num_walkers", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=64)
+    parser.add_argument("--clone_rate", type=float, default=0.5)
+
+    args = parser.parse_args()
+
+    times = {}
+    for use_snapshots in (False, True):
+        times[use_snapshots] = benchmark_cloning(
+            args.env, args.num_walkers, args.steps, args.clone_rate, use_snapshots
+        )
+
+    print(f"env={args.env}, num_walkers={args.num_walkers}")
+    print(f"deepcopy: {times[False] * 1000:.3f}ms per clone")
+    print(f"snapshot: {times[True] * 1000:.3f}ms per clone")
+    print(f"speedup: {times[False] / times[True]:.1f}x")
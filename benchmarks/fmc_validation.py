@@ -0,0 +1,59 @@
+from argparse import ArgumentParser
+from time import perf_counter
+
+from fractal_zero.search.array_tree import ArrayGameTree
+from fractal_zero.search.fmc import FMC
+from fractal_zero.search.tree import GameTree
+from fractal_zero.vectorized_environment import CartPoleVectorizedEnvironment
+
+
+TREE_CLASSES = {"game_tree": GameTree, "array_tree": ArrayGameTree}
+
+
+def benchmark_fmc(
+    tree_class, num_walkers: int, steps: int, validate: bool, trials: int
+) -> float:
+    """Average time of one FMC simulation step."""
+
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=num_walkers, seed=0)
+
+    total = 0.0
+    total_steps = 0
+    for _ in range(trials):
+        fmc = FMC(vec_env, tree_class=tree_class, validate=validate)
+
+        start = perf_counter()
+        for _ in range(steps):
+            fmc.simulate(1)
+            total_steps += 1
+            if fmc.did_early_exit:
+                break
+        total += perf_counter() - start
+
+    return total / total_steps
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("fmc_validation")
+    parser.add_argument("--num_walkers", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--steps", type=int, default=64)
+    parser.add_argument("--trials", type=int, default=4)
+    parser.add_argument(
+        "--trees", type=str, nargs="+", default=list(TREE_CLASSES.keys())
+    )
+
+    args = parser.parse_args()
+
+    for num_walkers in args.num_walkers:
+        for tree in args.trees:
+            times = {
+                validate: benchmark_fmc(
+                    TREE_CLASSES[tree], num_walkers, args.steps, validate, args.trials
+                )
+                for validate in (False, True)
+            }
+            overhead = times[True] / times[False]
+            print(
+                f"num_walkers={num_walkers} {tree}: {times[False] * 1000:.3f}ms per step, "
+                f"{times[True] * 1000:.3f}ms validated ({overhead:.1f}x)"
+            )
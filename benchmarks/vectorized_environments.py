@@ -0,0 +1,94 @@
+from argparse import ArgumentParser
+from time import perf_counter
+import numpy as np
+import ray
+
+from fractal_zero.vectorized_environment import (
+    ProcessVectorizedEnvironment,
+    RayVectorizedEnvironment,
+    SerialVectorizedEnvironment,
+    ThreadPoolVectorizedEnvironment,
+)
+
+
+def make_vectorized_environment(backend: str, env_id: str, num_walkers: int, num_workers: int):
+    if backend == "serial":
+        return SerialVectorizedEnvironment(env_id, n=num_walkers)
+    if backend == "thread":
+        return ThreadPoolVectorizedEnvironment(env_id, n=num_walkers, num_workers=num_workers)
+    if backend == "process":
+        return ProcessVectorizedEnvironment(env_id, n=num_walkers, num_workers=num_workers)
+    if backend == "ray":
+        walkers_per_actor = int(np.ceil(num_walkers / num_workers))
+        return RayVectorizedEnvironment(
+            env_id, n=num_walkers, walkers_per_actor=walkers_per_actor
+        )
+    raise ValueError(f"Unknown backend {backend}.")
+
+
+def benchmark_backend(
+    backend: str,
+    env_id: str,
+    num_walkers: int,
+    num_workers: int,
+    steps: int,
+    clone_rate: float,
+) -> float:
+    """Average time of one search step (batch step + clone), not counting setup."""
+
+    vec_env = make_vectorized_environment(backend, env_id, num_walkers, num_workers)
+    vec_env.batch_reset()
+
+    rng = np.random.default_rng(0)
+    frozen_mask = np.zeros(num_walkers, dtype=bool)
+
+    # warmup
+    vec_env.batch_step(vec_env.batched_action_space_sample(), frozen_mask)
+
+    total = 0.0
+    for _ in range(steps):
+        actions = vec_env.batched_action_space_sample()
+        partners = rng.integers(0, num_walkers, size=num_walkers)
+        clone_mask = rng.uniform(size=num_walkers) < clone_rate
+
+        start = perf_counter()
+        vec_env.batch_step(actions, frozen_mask)
+        vec_env.clone(partners, clone_mask)
+        total += perf_counter() - start
+
+    if hasattr(vec_env, "close"):
+        vec_env.close()
+    return total / steps
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("vectorized_environments")
+    parser.add_argument("--env", type=str, default="CartPole-v0")
+    parser.add_argument("--num_walkers", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=64)
+    parser.add_argument("--clone_rate", type=float, default=0.5)
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=["serial", "thread", "process", "ray"],
+    )
+
+    args = parser.parse_args()
+
+    if "ray" in args.backends:
+        ray.init(num_cpus=args.num_workers)
+
+    print(f"env={args.env}, num_workers={args.num_workers}")
+    for num_walkers in args.num_walkers:
+        for backend in args.backends:
+            t = benchmark_backend(
+                backend,
+                args.env,
+                num_walkers,
+                args.num_workers,
+                args.steps,
+                args.clone_rate,
+            )
+            print(f"num_walkers={num_walkers} {backend}: {t * 1000:.3f}ms per step")
@@ -28,6 +28,12 @@ class FMCConfig:
     num_walkers: int = 8
     balance: float = 1
 
+    search_using_actual_environment: bool = False
+
+    # after every step of the game, the search tree is re-rooted at the child of the action that
+    # was taken, so the next search starts with the walkers and nodes below it.
+    reuse_search_tree: bool = True
+
     track_game_tree: bool = True
     use_policy_for_action_selection: bool = False
 
@@ -52,6 +58,13 @@ class FractalZeroConfig:
 
     max_replay_buffer_size: int = 512
     replay_buffer_pop_strategy: str = "oldest"  # oldest or random
+    # if set, the replay buffer is memory-mapped to (and resumed from) files in this directory.
+    replay_buffer_directory: str = None
+    # prioritized experience replay (PER) https://arxiv.org/abs/1511.05952
+    prioritized_replay: bool = False
+    priority_alpha: float = 0.6
+    priority_beta: float = 0.4
+    priority_epsilon: float = 1e-6
     num_games: int = 5_000
     max_game_steps: int = 200
 
@@ -59,6 +72,8 @@ class FractalZeroConfig:
     dynamic_batch_size: bool = True
     unroll_steps: int = 16
     minimize_batch_padding: bool = True
+    # number of batches built ahead of time by a background thread (0 builds them synchronously).
+    prefetch_batches: int = 0
     learning_rate: float = 0.001
     lr_scheduler_config: dict = field(default_factory=lambda: CONSTANT_LR_CONFIG)
     weight_decay: float = 1e-4
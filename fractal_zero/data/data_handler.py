@@ -1,23 +1,40 @@
 from typing import Tuple
-import gym
 import torch
-import numpy as np
 from fractal_zero.config import FractalZeroConfig
+from fractal_zero.data.memory_mapped_replay_buffer import MemoryMappedReplayBuffer
 from fractal_zero.data.replay_buffer import ReplayBuffer
-from fractal_zero.utils import get_space_shape
 
 
 class DataHandler:
     def __init__(self, config: FractalZeroConfig):
         self.config = config
 
-        self.replay_buffer = ReplayBuffer(self.config)
+        if self.config.replay_buffer_directory is not None:
+            self.replay_buffer = MemoryMappedReplayBuffer(
+                self.config, self.config.replay_buffer_directory
+            )
+        else:
+            self.replay_buffer = ReplayBuffer(self.config)
+
+        # batch arrays are reused between calls, keyed by (batch size, number of frames).
+        self._batch_arrays = {}
 
         # TODO: expert dataset
 
     def get_batch(
         self, num_frames: int
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Sample a batch of clips. All clips are drawn and gathered at once, into float32 arrays
+        that are reused by every call with the same batch size and number of frames.
+
+        Along with the observations, actions, auxiliaries, values and the total number of empty
+        frames, the clips' importance sampling weights, replay buffer indices and slot generations
+        are returned (see `ReplayBuffer.sample_game_clips`).
+
+        NOTE: on the CPU, the returned tensors share memory with those arrays, so they are
+        overwritten by the next call.
+        """
+
         # TODO: a version of this that allows non-uniform numbers of frames per batch
 
         assert num_frames > 0
@@ -29,51 +46,33 @@ class DataHandler:
         else:
             batch_size = self.config.max_batch_size
 
-        observations = np.zeros(
-            (batch_size, num_frames, *self.config.observation_shape), dtype=float
-        )
-        actions = np.zeros(
-            (batch_size, num_frames, *self.config.action_shape), dtype=float
-        )
-        auxiliaries = np.zeros(
-            (
-                batch_size,
-                num_frames,
-            ),
-            dtype=float,
-        )
-        values = np.zeros(
-            (
-                batch_size,
-                num_frames,
-            ),
-            dtype=float,
-        )
-
-        total_empty_frames = 0
-        for i in range(batch_size):
-            (
-                gobservations,
-                gactions,
-                grewards,
-                gvalues,
-                num_empty_frames,
-            ) = self.replay_buffer.sample_game_clip(num_frames, pad_to_num_frames=True)
-
-            observations[i, :] = gobservations
-            actions[i] = np.expand_dims(
-                gactions, -1
-            )  # TODO: fix action shape to avoid this expanddims
-            auxiliaries[i] = grewards  # auxiliary is a generalization of reward.
-            values[i] = gvalues
+        key = (batch_size, num_frames)
+        if key not in self._batch_arrays:
+            self._batch_arrays[key] = self.replay_buffer.allocate_clips(*key)
 
-            total_empty_frames += num_empty_frames
+        (
+            observations,
+            actions,
+            auxiliaries,  # auxiliary is a generalization of reward.
+            values,
+            num_empty_frames,
+            weights,
+            indices,
+            generations,
+        ) = self.replay_buffer.sample_game_clips(
+            batch_size, num_frames, out=self._batch_arrays[key]
+        )
 
-        # TODO: put these on the correct device sooner?
+        device = self.config.device
         return (
-            torch.tensor(observations, device=self.config.device).float(),
-            torch.tensor(actions, device=self.config.device).float(),
-            torch.tensor(auxiliaries, device=self.config.device).unsqueeze(-1).float(),
-            torch.tensor(values, device=self.config.device).unsqueeze(-1).float(),
-            total_empty_frames,
+            torch.from_numpy(observations).to(device),
+            torch.from_numpy(actions)
+            .reshape(batch_size, num_frames, *self.config.action_shape)
+            .to(device),
+            torch.from_numpy(auxiliaries).unsqueeze(-1).to(device),
+            torch.from_numpy(values).unsqueeze(-1).to(device),
+            int(num_empty_frames.sum()),
+            torch.from_numpy(weights).to(device),
+            indices,
+            generations,
         )
@@ -0,0 +1,205 @@
+import json
+import os
+
+import numpy as np
+
+from fractal_zero.config import FractalZeroConfig
+from fractal_zero.data.replay_buffer import ReplayBuffer
+from fractal_zero.data.sum_tree import SumTree
+from fractal_zero.utils import RNGSeed
+
+
+_ARRAY_NAMES = ("observations", "actions", "rewards", "values")
+
+
+class MemoryMappedReplayBuffer(ReplayBuffer):
+    """`ReplayBuffer` that keeps its frames in memory-mapped `.npy` files inside `directory`, so
+    it can hold more frames than fit in RAM (the OS pages them in as they're sampled) and it
+    persists across restarts. Creating a buffer on a directory that already holds one resumes it.
+
+    Besides the frame arrays, the directory holds an index: the length of the game in every slot
+    (`lengths.npy`) and a small `state.json`. Before a game is written, its slot is recorded as
+    pending in the state, and it's only cleared once the game and its length were flushed. If the
+    process dies in between, the pending slot is dropped when resuming.
+
+    NOTE: pickling (i.e. `FractalZeroTrainer.save_checkpoint`) only stores the directory, the
+    frames stay on disk.
+    """
+
+    def __init__(
+        self, config: FractalZeroConfig, directory: str, seed: RNGSeed = None
+    ):
+        super().__init__(config, seed=seed)
+        self.directory = directory
+
+        if os.path.exists(self._state_path):
+            self._load()
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lengths = np.lib.format.open_memmap(
+                self._get_path("lengths"), mode="w+", dtype=np.int64, shape=(self.capacity,)
+            )
+            self._save_state()
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self.directory, "state.json")
+
+    def _get_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _save_state(self, pending_slot: int = None):
+        self._lengths.flush()
+
+        state = {
+            "capacity": self.capacity,
+            "max_game_length": self.max_game_length,
+            "num_games": self._num_games,
+            "next_slot": self._next_slot,
+            "pending_slot": pending_slot,
+            "max_priority": getattr(self, "_max_priority", 1.0),
+        }
+
+        # replacing the file is atomic, so the state is never partially written.
+        temporary_path = f"{self._state_path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self._state_path)
+
+    def _load(self):
+        with open(self._state_path) as f:
+            state = json.load(f)
+
+        if (state["capacity"], state["max_game_length"]) != (
+            self.capacity,
+            self.max_game_length,
+        ):
+            raise ValueError(
+                f"The replay buffer in {self.directory} holds {state['capacity']} games of up to "
+                f"{state['max_game_length']} frames, but the config expects {self.capacity} "
+                f"games of up to {self.max_game_length} frames."
+            )
+
+        self._num_games = state["num_games"]
+        self._next_slot = state["next_slot"]
+        self._lengths = np.lib.format.open_memmap(self._get_path("lengths"), mode="r+")
+        if os.path.exists(self._get_path("observations")):
+            for name in _ARRAY_NAMES:
+                setattr(self, name, np.lib.format.open_memmap(self._get_path(name), mode="r+"))
+
+        if state["pending_slot"] is not None:
+            self._discard_slot(state["pending_slot"])
+
+        if self.priorities is not None:
+            # priorities aren't persisted, every stored frame starts out with the highest one.
+            self._max_priority = state["max_priority"]
+            frames = np.arange(self.capacity * self.max_game_length)
+            slots, offsets = np.divmod(frames, self.max_game_length)
+            is_stored = offsets < self._lengths[slots]
+            self.priorities.update(
+                frames, np.where(is_stored, self._max_priority**self.config.priority_alpha, 0)
+            )
+
+    def _discard_slot(self, slot: int):
+        """Drop the (possibly partially written) game in `slot`, keeping the stored games in the
+        first slots by moving the last one into it.
+        """
+
+        if slot < self._num_games:
+            last = self._num_games - 1
+            if slot != last:
+                length = self._lengths[last]
+                source, target = self._starts[last], self._starts[slot]
+                for name in _ARRAY_NAMES:
+                    array = getattr(self, name)
+                    array[target : target + self.max_game_length] = array[
+                        source : source + self.max_game_length
+                    ]
+                    array.flush()
+                self._lengths[slot] = length
+                self._generations[slot] += 1
+            slot = last
+            self._num_games = last
+            self._next_slot = self._num_games
+
+        self._lengths[slot] = 0
+        self._generations[slot] += 1
+        self._save_state()
+
+    def _allocate(self, observations: np.ndarray, actions: np.ndarray):
+        num_frames = self.capacity * self.max_game_length
+        shapes = {
+            "observations": (num_frames, *observations.shape[1:]),
+            "actions": (num_frames, *actions.shape[1:]),
+            "rewards": (num_frames,),
+            "values": (num_frames,),
+        }
+        for name, shape in shapes.items():
+            array = np.lib.format.open_memmap(
+                self._get_path(name), mode="w+", dtype=np.float32, shape=shape
+            )
+            setattr(self, name, array)
+
+    def append(self, game_history):
+        with self._lock:
+            super().append(game_history)
+            self._save_state()
+
+    def _write_game(self, slot: int, observations, actions, rewards, values):
+        self._save_state(pending_slot=slot)
+
+        super()._write_game(slot, observations, actions, rewards, values)
+
+        # clear the rest of the slot, so clips that run past the end of the game are zero padded.
+        start = self._starts[slot]
+        for name in _ARRAY_NAMES:
+            array = getattr(self, name)
+            array[start + len(observations) : start + self.max_game_length] = 0
+            array.flush()
+
+    def sample_game_clip(
+        self, clip_length: int, pad_to_num_frames: bool = True
+    ) -> tuple:
+        """Same as `ReplayBuffer.sample_game_clip`, but (unless the padding runs past the end of
+        the game's slot) the returned arrays are views of the memory-mapped files, without copying.
+
+        NOTE: the views are overwritten when their game is evicted.
+        """
+
+        with self._lock:
+            games, lengths, start_frames, _ = self._sample_clip_starts(1, clip_length)
+
+        slot_frame = int(start_frames[0])
+        num_frames = min(clip_length, int(lengths[0]) - slot_frame)
+        num_empty_frames = clip_length - num_frames
+        end_frame = slot_frame + (clip_length if pad_to_num_frames else num_frames)
+
+        start = self._starts[games[0]] + slot_frame
+        stop = start + min(end_frame, self.max_game_length) - slot_frame
+        clip = [np.asarray(getattr(self, name)[start:stop]) for name in _ARRAY_NAMES]
+
+        missing_frames = end_frame - self.max_game_length
+        if missing_frames > 0:
+            clip = [
+                np.concatenate((array, np.zeros((missing_frames, *array.shape[1:]), array.dtype)))
+                for array in clip
+            ]
+
+        return (*clip, num_empty_frames)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for name in (*_ARRAY_NAMES, "_lengths", "priorities"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        for name in _ARRAY_NAMES:
+            setattr(self, name, None)
+        self.priorities = None
+        if self.config.prioritized_replay:
+            self.priorities = SumTree(self.capacity * self.max_game_length)
+        self._load()
@@ -0,0 +1,196 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import perf_counter
+from typing import List
+
+import torch
+
+from fractal_zero.data.data_handler import DataHandler
+
+
+class BatchPrefetcher:
+    """Builds batches from a `DataHandler` in a background thread, keeping up to `num_batches`
+    of them ready in a bounded queue, so sampling overlaps with training.
+
+    Every queued batch lives in its own set of tensors (pinned when training on a GPU), which
+    are reused once the batch after it is requested. The replay buffer locks itself, so games can
+    be appended by self-play while batches are prefetched. While a prefetcher is running, batches
+    should only be taken from it (not from `DataHandler.get_batch`).
+
+    NOTE: a thread is used rather than a process, because sampling is dominated by numpy gathers
+    (which release the GIL) and the replay buffer doesn't have to be shared between processes.
+    """
+
+    def __init__(
+        self,
+        data_handler: DataHandler,
+        num_frames: int,
+        num_batches: int = 2,
+        pin_memory: bool = None,
+    ):
+        if num_batches < 1:
+            raise ValueError(f"Expected at least 1 prefetched batch, got {num_batches}.")
+
+        self.data_handler = data_handler
+        self.num_frames = num_frames
+        self.num_batches = num_batches
+
+        device = torch.device(self.data_handler.config.device)
+        self.pin_memory = (
+            pin_memory if pin_memory is not None else device.type == "cuda"
+        )
+
+        self._thread = None
+        self._reset_metrics()
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device(self.data_handler.config.device)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _reset_metrics(self):
+        self.num_batches_taken = 0
+        self.num_starved = 0
+        self.total_wait_time = 0.0
+
+    def start(self):
+        if self.running:
+            return
+
+        # one more slot than the queue can hold, for the batch that's currently being used.
+        self._slots: List[List[torch.Tensor]] = [None] * (self.num_batches + 1)
+        self._free_slots = Queue()
+        for slot in range(len(self._slots)):
+            self._free_slots.put(slot)
+        self._ready = Queue(maxsize=self.num_batches)
+        self._slot_in_use = None
+
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if getattr(self, "_thread", None) is None:
+            return
+
+        self._stop.set()
+        # unblock the worker if it's waiting for a free slot.
+        self._free_slots.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _copy_to_slot(self, slot: int, batch: tuple) -> tuple:
+        tensors = [item for item in batch if isinstance(item, torch.Tensor)]
+        slot_tensors = self._slots[slot]
+
+        # dynamic batch sizes grow with the replay buffer, so slots may need to be reallocated.
+        if slot_tensors is None or any(
+            s.shape != t.shape for s, t in zip(slot_tensors, tensors)
+        ):
+            slot_tensors = [
+                torch.empty(t.shape, dtype=t.dtype, pin_memory=self.pin_memory)
+                for t in tensors
+            ]
+            self._slots[slot] = slot_tensors
+
+        for slot_tensor, tensor in zip(slot_tensors, tensors):
+            slot_tensor.copy_(tensor)
+
+        # everything else (i.e. the number of empty frames) is passed along as is.
+        slot_tensors = iter(slot_tensors)
+        return tuple(
+            next(slot_tensors) if isinstance(item, torch.Tensor) else item
+            for item in batch
+        )
+
+    def _run(self):
+        replay_buffer = self.data_handler.replay_buffer
+
+        while not self._stop.is_set():
+            slot = self._free_slots.get()
+            if slot is None:
+                return
+
+            # wait for self-play to add the first games.
+            while len(replay_buffer) == 0:
+                if self._stop.wait(0.01):
+                    return
+
+            try:
+                batch = self.data_handler.get_batch(self.num_frames)
+                item = (slot, self._copy_to_slot(slot, batch))
+            except BaseException as e:
+                self._put_ready((slot, e))
+                return
+            self._put_ready(item)
+
+    def _put_ready(self, item):
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def get(self) -> tuple:
+        """The next batch, in the same format as `DataHandler.get_batch`. The previous batch's
+        tensors may be reused after this is called.
+        """
+
+        self.start()
+
+        if self._slot_in_use is not None:
+            self._free_slots.put(self._slot_in_use)
+            self._slot_in_use = None
+
+        start = perf_counter()
+        try:
+            slot, batch = self._ready.get_nowait()
+        except Empty:
+            # training is waiting on sampling.
+            self.num_starved += 1
+            slot, batch = self._ready.get()
+        self.total_wait_time += perf_counter() - start
+        self.num_batches_taken += 1
+
+        if isinstance(batch, BaseException):
+            self._thread = None
+            raise batch
+
+        self._slot_in_use = slot
+        return tuple(
+            item.to(self.device, non_blocking=self.pin_memory)
+            if isinstance(item, torch.Tensor)
+            else item
+            for item in batch
+        )
+
+    def get_metrics(self) -> dict:
+        """Queue starvation metrics since the last call."""
+
+        taken = max(self.num_batches_taken, 1)
+        metrics = {
+            "data/prefetch_starvation_rate": self.num_starved / taken,
+            "data/prefetch_wait_time": self.total_wait_time / taken,
+            "data/prefetch_queue_size": self._ready.qsize() if self.running else 0,
+        }
+        self._reset_metrics()
+        return metrics
+
+    def __getstate__(self):
+        # the thread and queues can't be pickled (i.e. when checkpointing), the prefetcher is
+        # restarted by the next `get` instead.
+        state = self.__dict__.copy()
+        for attr in ("_thread", "_slots", "_free_slots", "_ready", "_stop", "_slot_in_use"):
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread = None
+
+    def __del__(self):
+        self.close()
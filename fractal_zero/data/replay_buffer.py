@@ -1,6 +1,9 @@
+from threading import RLock
 import numpy as np
 
 from fractal_zero.config import FractalZeroConfig
+from fractal_zero.data.sum_tree import SumTree
+from fractal_zero.utils import RNGSeed, get_rng
 
 
 class GameHistory:
@@ -51,86 +54,281 @@ class GameHistory:
 
 
 class ReplayBuffer:
-    def __init__(self, config: FractalZeroConfig):
-        # TODO: prioritized experience replay (PER) https://arxiv.org/abs/1511.05952
-
+    """Ring buffer of game histories. All frames are stored in preallocated flat arrays, and
+    every game owns a fixed slot of `max_game_steps + 1` frames, so evicting a game (either the
+    oldest or a random one) is O(1) and never moves any data. Each slot's start frame and the
+    length of the game in it are kept in index arrays, which lets clips be sampled with a single
+    vectorized gather.
+
+    The arrays are allocated on the first `append`, using the shapes of that game's observations
+    and actions. Appending and sampling are thread-safe.
+
+    With `prioritized_replay`, clips are sampled proportionally to the priority of their start
+    frame (https://arxiv.org/abs/1511.05952), kept in a sum tree with one leaf per frame. New games
+    get the highest priority seen so far, and priorities are updated through `update_priorities`.
+    Start frames are then sampled directly by priority, so `minimize_batch_padding` doesn't apply.
+    """
+
+    def __init__(self, config: FractalZeroConfig, seed: RNGSeed = None):
         self.config = config
-
-        self.game_histories = []
+        self.rng = get_rng(seed)
+
+        self.capacity = self.config.max_replay_buffer_size
+        self.max_game_length = self.config.max_game_steps + 1
+
+        self._starts = np.arange(self.capacity) * self.max_game_length
+        self._lengths = np.zeros(self.capacity, dtype=np.int64)
+        # bumped every time a slot is written, so priority updates for evicted games are dropped.
+        self._generations = np.zeros(self.capacity, dtype=np.int64)
+        self._num_games = 0
+        self._next_slot = 0
+
+        self.observations = None
+        self.actions = None
+        self.rewards = None
+        self.values = None
+
+        self.priorities = None
+        if self.config.prioritized_replay:
+            self.priorities = SumTree(self.capacity * self.max_game_length)
+            self._max_priority = 1.0
+
+        self._lock = RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = RLock()
+
+    def _allocate(self, observations: np.ndarray, actions: np.ndarray):
+        num_frames = self.capacity * self.max_game_length
+        self.observations = np.zeros(
+            (num_frames, *observations.shape[1:]), dtype=np.float32
+        )
+        self.actions = np.zeros((num_frames, *actions.shape[1:]), dtype=np.float32)
+        self.rewards = np.zeros(num_frames, dtype=np.float32)
+        self.values = np.zeros(num_frames, dtype=np.float32)
+
+    def _get_slot_to_fill(self) -> int:
+        if len(self) < self.capacity:
+            return self._num_games
+
+        strat = self.config.replay_buffer_pop_strategy
+        if strat == "oldest":
+            # slots are filled in order, so the next slot always holds the oldest game.
+            return self._next_slot
+        if strat == "random":
+            return int(self.rng.integers(0, self.capacity))
+        raise NotImplementedError(
+            f'Replay buffer pop strategy "{strat}" is not supported.'
+        )
 
     def append(self, game_history: GameHistory):
         """Add a trajectory/episode to the replay buffer. If the buffer is full, a trajectory will be popped according
         to the pop strategy specified in the config.
         """
 
-        if len(self) >= self.config.max_replay_buffer_size:
-            strat = self.config.replay_buffer_pop_strategy
-
-            if strat == "oldest":
-                i = 0
-            elif strat == "random":
-                i = np.random.randint(0, len(self))
-            else:
-                raise NotImplementedError(
-                    f'Replay buffer pop strategy "{strat}" is not supported.'
-                )
-
-            self.game_histories.pop(i)
-
-        self.game_histories.append(game_history)
-
-        if len(self) > self.config.max_replay_buffer_size:
-            raise ValueError
+        length = len(game_history)
+        if length > self.max_game_length:
+            raise ValueError(
+                f"Games can have at most {self.max_game_length} frames, got {length}."
+            )
+
+        observations = np.stack([np.asarray(obs) for obs in game_history.observations])
+        actions = np.stack([np.asarray(action) for action in game_history.actions])
+        rewards = [float(r) for r in game_history.environment_reward_signals]
+        values = [float(v) for v in game_history.values]
+
+        with self._lock:
+            if self.observations is None:
+                self._allocate(observations, actions)
+
+            slot = self._get_slot_to_fill()
+            self._write_game(slot, observations, actions, rewards, values)
+
+            self._num_games = min(self._num_games + 1, self.capacity)
+            self._next_slot = (slot + 1) % self.capacity
+
+    def _write_game(self, slot: int, observations, actions, rewards, values):
+        start = self._starts[slot]
+        end = start + len(observations)
+
+        self.observations[start:end] = observations
+        self.actions[start:end] = actions
+        self.rewards[start:end] = rewards
+        self.values[start:end] = values
+        self._lengths[slot] = len(observations)
+        self._generations[slot] += 1
+
+        if self.priorities is not None:
+            self._reset_slot_priorities(slot)
+
+    def _reset_slot_priorities(self, slot: int):
+        start = self._starts[slot]
+        slot_priorities = np.zeros(self.max_game_length)
+        slot_priorities[: self._lengths[slot]] = (
+            self._max_priority**self.config.priority_alpha
+        )
+        self.priorities.update(np.arange(start, start + self.max_game_length), slot_priorities)
 
     def sample_game(self) -> GameHistory:
-        game_index = np.random.randint(0, len(self.game_histories))
-        return self.game_histories[game_index]
+        with self._lock:
+            return self._sample_game()
 
-    def sample_game_clip(
-        self, clip_length: int, pad_to_num_frames: bool = True
-    ) -> tuple:
-        assert clip_length > 0
+    def _sample_game(self) -> GameHistory:
+        game_index = int(self.rng.integers(0, len(self)))
+        start = self._starts[game_index]
+        end = start + self._lengths[game_index]
 
-        game = self.sample_game()
+        game = GameHistory(self.observations[start])
+        for i in range(start + 1, end):
+            game.append(self.actions[i], self.observations[i], self.rewards[i], self.values[i])
+        return game
 
+    def _sample_start_frames(self, lengths: np.ndarray, clip_length: int) -> np.ndarray:
         # minimizing padding means the start frame chosen will result in the least amount of padded frames.
         if self.config.minimize_batch_padding:
-            if len(game) <= clip_length:
-                start_frame = 0
-            else:
-                start_frame = np.random.randint(0, len(game) - clip_length)
+            high = np.where(lengths <= clip_length, 1, lengths - clip_length)
         else:
-            start_frame = np.random.randint(0, len(game))
+            high = lengths
+        return np.floor(self.rng.uniform(size=len(lengths)) * high).astype(np.int64)
+
+    def _sample_prioritized_start_frames(self, batch_size: int) -> tuple:
+        total = self.priorities.total
+        # stratified sampling, one value from each of `batch_size` equal priority ranges.
+        values = (np.arange(batch_size) + self.rng.uniform(size=batch_size)) * (total / batch_size)
+        frames = self.priorities.find(np.minimum(values, np.nextafter(total, 0)))
+
+        probabilities = self.priorities[frames] / total
+        num_frames = self._lengths[: len(self)].sum()
+        weights = (num_frames * probabilities) ** -self.config.priority_beta
+        weights /= weights.max()
+
+        games, start_frames = np.divmod(frames, self.max_game_length)
+        return games, start_frames, weights.astype(np.float32)
+
+    def sample_game_clips(self, batch_size: int, clip_length: int, out: tuple = None) -> tuple:
+        """Sample `batch_size` clips of `clip_length` frames, each from a uniformly sampled game
+        (or by priority, with `prioritized_replay`). Frames past the end of a game are zero padded.
+        Returns the observations, actions, rewards, values and the number of empty frames of each
+        clip, followed by the clips' importance sampling weights (all 1 when sampling uniformly),
+        the indices of their start frames and the generations of their slots (both for
+        `update_priorities`).
+
+        The clips can be gathered into existing `(observations, actions, rewards, values)`
+        arrays given by `out` (see `allocate_clips`), instead of allocating new ones.
+        """
 
-        end_frame = start_frame + clip_length
+        assert clip_length > 0
 
-        actual_frames = game[start_frame:end_frame]
+        with self._lock:
+            return self._sample_game_clips(batch_size, clip_length, out)
 
-        actual_num_frames = len(actual_frames[0])
-        num_frames = clip_length if pad_to_num_frames else actual_num_frames
+    def _sample_clip_starts(self, batch_size: int, clip_length: int) -> tuple:
+        """The slot, game length and start frame of each clip, and the clips' importance
+        sampling weights.
+        """
 
-        observations = np.zeros((num_frames, *game.observation_shape), dtype=float)
-        actions = np.zeros(
-            (
-                num_frames,
-                *game.action_shape,
-            ),
-            dtype=float,
+        if self.priorities is not None:
+            games, start_frames, weights = self._sample_prioritized_start_frames(batch_size)
+            lengths = self._lengths[games]
+        else:
+            games = self.rng.integers(0, len(self), size=batch_size)
+            lengths = self._lengths[games]
+            start_frames = self._sample_start_frames(lengths, clip_length)
+            weights = np.ones(batch_size, dtype=np.float32)
+        return games, lengths, start_frames, weights
+
+    def _sample_game_clips(self, batch_size: int, clip_length: int, out: tuple = None) -> tuple:
+        games, lengths, start_frames, weights = self._sample_clip_starts(
+            batch_size, clip_length
         )
-        rewards = np.zeros((num_frames,), dtype=float)
-        values = np.zeros((num_frames,), dtype=float)
 
-        observations[:actual_num_frames] = actual_frames[0]
-        actions[:actual_num_frames] = actual_frames[1]
-        rewards[:actual_num_frames] = actual_frames[2]
-        values[:actual_num_frames] = actual_frames[3]
+        offsets = start_frames[:, None] + np.arange(clip_length)
+        valid = offsets < lengths[:, None]
+
+        # padded frames point at the first frame of their game, then get zeroed.
+        frames = self._starts[games][:, None] + np.where(valid, offsets, 0)
+
+        if out is None:
+            out = self.allocate_clips(batch_size, clip_length)
+        sources = (self.observations, self.actions, self.rewards, self.values)
+        padding = ~valid
+        for source, array in zip(sources, out):
+            np.take(source, frames, axis=0, out=array)
+            array[padding] = 0
+
+        num_empty_frames = clip_length - valid.sum(axis=1)
+        indices = self._starts[games] + start_frames
+        generations = self._generations[games]
+        return (*out, num_empty_frames, weights, indices, generations)
+
+    def update_priorities(
+        self, indices: np.ndarray, generations: np.ndarray, priorities: np.ndarray
+    ):
+        """Set the priorities (i.e. the losses) of the clips starting at `indices`, with the
+        `generations` of their slots, as returned by `sample_game_clips`. Clips whose game was
+        evicted since sampling (the slot was written again) are ignored.
+        """
+
+        if self.priorities is None:
+            raise ValueError("Priorities can only be updated with `prioritized_replay`.")
+
+        indices = np.asarray(indices, dtype=np.int64)
+        generations = np.asarray(generations, dtype=np.int64)
+        priorities = np.abs(np.asarray(priorities, dtype=np.float64))
+        priorities = priorities + self.config.priority_epsilon
+
+        # the same clip may be sampled more than once per batch, keep its last priority.
+        indices, last = np.unique(indices[::-1], return_index=True)
+        generations = generations[::-1][last]
+        priorities = priorities[::-1][last]
+
+        with self._lock:
+            slots, frames = np.divmod(indices, self.max_game_length)
+            is_stored = (generations == self._generations[slots]) & (
+                frames < self._lengths[slots]
+            )
+            indices, priorities = indices[is_stored], priorities[is_stored]
+
+            self.priorities.update(indices, priorities**self.config.priority_alpha)
+            if len(priorities) > 0:
+                self._max_priority = max(self._max_priority, float(priorities.max()))
+
+    def allocate_clips(self, batch_size: int, clip_length: int) -> tuple:
+        """Empty arrays that can hold `batch_size` clips, for `sample_game_clips(out=...)`."""
+
+        shape = (batch_size, clip_length)
+        return (
+            np.empty((*shape, *self.observations.shape[1:]), dtype=self.observations.dtype),
+            np.empty((*shape, *self.actions.shape[1:]), dtype=self.actions.dtype),
+            np.empty(shape, dtype=self.rewards.dtype),
+            np.empty(shape, dtype=self.values.dtype),
+        )
 
-        num_empty_frames = clip_length - actual_num_frames
+    def sample_game_clip(
+        self, clip_length: int, pad_to_num_frames: bool = True
+    ) -> tuple:
+        observations, actions, rewards, values, num_empty_frames, *_ = self.sample_game_clips(
+            1, clip_length
+        )
+        num_empty_frames = int(num_empty_frames[0])
 
-        return observations, actions, rewards, values, num_empty_frames
+        num_frames = clip_length if pad_to_num_frames else clip_length - num_empty_frames
+        return (
+            observations[0, :num_frames],
+            actions[0, :num_frames],
+            rewards[0, :num_frames],
+            values[0, :num_frames],
+            num_empty_frames,
+        )
 
     def get_episode_lengths(self):
-        return [len(history) for history in self.game_histories]
+        return self._lengths[: len(self)].tolist()
 
     def __len__(self):
-        return len(self.game_histories)
+        return self._num_games
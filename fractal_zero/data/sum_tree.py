@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class SumTree:
+    """Binary tree where every node holds the sum of its children, with one leaf per item. Used to
+    sample items proportionally to their priority, and to update priorities, in O(log n). Both
+    operations are vectorized over a batch of items.
+
+    The tree is stored in a flat array (the root at index 1, the children of node `i` at `2i` and
+    `2i + 1`), with the number of leaves rounded up to a power of 2.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+
+        self._num_leaves = 1
+        while self._num_leaves < capacity:
+            self._num_leaves *= 2
+        self._depth = self._num_leaves.bit_length() - 1
+
+        self._tree = np.zeros(2 * self._num_leaves, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self._tree[1])
+
+    def __getitem__(self, indices) -> np.ndarray:
+        return self._tree[np.asarray(indices) + self._num_leaves]
+
+    def update(self, indices, priorities):
+        """Set the priorities of the items at `indices`. Indices should be unique."""
+
+        nodes = np.asarray(indices, dtype=np.int64) + self._num_leaves
+        self._tree[nodes] = priorities
+
+        # recompute the sums (instead of propagating the changes), so errors don't accumulate.
+        for _ in range(self._depth):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+
+    def find(self, values) -> np.ndarray:
+        """The items whose cumulative priority range contains each of `values` (which should be in
+        `[0, total)`). Items with a priority of 0 are never found.
+        """
+
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+
+        for _ in range(self._depth):
+            left = self._tree[2 * nodes]
+
+            # rounding can push a value past the left sum, avoid ending up in an empty subtree.
+            go_right = (values >= left) & (self._tree[2 * nodes + 1] > 0)
+            values -= np.where(go_right, left, 0)
+            nodes = 2 * nodes + go_right
+
+        return nodes - self._num_leaves
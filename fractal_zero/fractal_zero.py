@@ -19,8 +19,10 @@ class FractalZero(torch.nn.Module):
 
         self.model = self.config.joint_model
 
-        # TODO: reuse FMC instance?
+        # the same FMC instance is reused for the whole game. when `reuse_search_tree` is enabled,
+        # the tree is re-rooted after every step instead of searching from scratch.
         self.fmc = None
+        self._search_is_stale = True
 
         self.actual_env = self.config.env
 
@@ -52,12 +54,47 @@ class FractalZero(torch.nn.Module):
             k = self.config.evaluation_lookahead_steps
 
         if self.config.lookahead_steps > 0:
-            self.vectorized_environment.set_all_states(self.actual_env, observation)
-            action = self.fmc.simulate(k, greedy_action=greedy_action)
-            return action, self.fmc.root_value
+            if self.fmc is None or self._search_is_stale or not self.fmc_config.reuse_search_tree:
+                self._start_search(observation)
+                self._search_is_stale = False
+
+            self.fmc.simulate(k)
+
+            action = self.fmc.get_root_actions(greedy=greedy_action)[0]
+            root_value = self.fmc.tree.best_path.total_reward
+            return action, root_value
 
         raise NotImplementedError("Action prediction not yet working.")
 
+    def _start_search(self, observation):
+        # the dynamics model environment shares the actual environment, so it must not be reset.
+        # when searching with copies of the actual environment, they're moved to its current state
+        # instead of being reset.
+        reset_environment = True
+        if self.fmc_config.search_using_actual_environment:
+            self.vectorized_environment.set_all_states(self.actual_env, observation)
+            reset_environment = False
+
+        if self.fmc is None:
+            self.fmc = FMC(
+                self.vectorized_environment,
+                balance=self.fmc_config.balance,
+                root_observations=[observation],
+                reset_environment=reset_environment,
+            )
+        else:
+            self.fmc.reset([observation], reset_environment=reset_environment)
+
+    def _advance_search(self, action):
+        if self.fmc is None or self._search_is_stale or not self.fmc_config.reuse_search_tree:
+            return
+
+        # the tree can only be reused when the search explored the action that was taken.
+        try:
+            self.fmc.reroot([action])
+        except ValueError:
+            self._search_is_stale = True
+
     def play_game(
         self,
         render: bool = False,
@@ -65,16 +102,14 @@ class FractalZero(torch.nn.Module):
         obs = self.actual_env.reset()
         game_history = GameHistory(obs)
 
-        self.fmc = FMC(
-            self.vectorized_environment,
-            self.model.prediction_model,
-            config=self.fmc_config,
-        )
+        # a new game always starts a new search.
+        self._search_is_stale = True
 
         for step in range(self.config.max_game_steps):
             obs = torch.tensor(obs, device=self.config.device)
             action, root_value = self.forward(obs)
             obs, reward, done, info = self.actual_env.step(action)
+            self._advance_search(action)
 
             game_history.append(action, obs, reward, root_value)
 
@@ -0,0 +1,603 @@
+from copy import copy
+from itertools import compress
+from typing import List, Sequence
+import networkx as nx
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+
+
+def _as_numpy(x, dtype=None) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=dtype)
+
+
+class ArrayStateNode:
+    """Lightweight view of a single node stored inside an `ArrayGameTree`. It mirrors the
+    attributes of `StateNode`, but all values are read from (and written to) the tree's arrays.
+    """
+
+    def __init__(self, tree: "ArrayGameTree", index: int):
+        self.tree = tree
+        self.id = int(index)
+
+    @property
+    def observation(self):
+        return self.tree._observations[self.id]
+
+    @property
+    def reward(self) -> float:
+        return float(self.tree._rewards[self.id])
+
+    @property
+    def info(self):
+        return self.tree._infos[self.id]
+
+    @property
+    def terminal(self) -> bool:
+        return bool(self.tree._terminal[self.id])
+
+    @property
+    def num_child_walkers(self) -> int:
+        return int(self.tree._num_child_walkers[self.id])
+
+    @property
+    def visits(self) -> int:
+        return int(self.tree._get_visits()[self.id])
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ArrayStateNode):
+            return False
+        return self.tree is other.tree and self.id == other.id
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.id))
+
+    def __str__(self) -> str:
+        return f"State(nc={self.num_child_walkers}, c={self.visits}, r={self.reward})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class ArrayPath:
+    """View of a walker's path inside an `ArrayGameTree`, identified only by its leaf node. It
+    exposes the same interface as `Path`.
+    """
+
+    def __init__(self, tree: "ArrayGameTree", leaf: int):
+        self.tree = tree
+        self.leaf = int(leaf)
+
+    @property
+    def root(self) -> ArrayStateNode:
+        return self.tree.root
+
+    @property
+    def g(self) -> nx.DiGraph:
+        return self.tree.g
+
+    @property
+    def ordered_states(self) -> List[ArrayStateNode]:
+        return [ArrayStateNode(self.tree, i) for i in self.tree._get_ancestry(self.leaf)]
+
+    def clone_to(self, new_path: "ArrayPath", return_new_path: bool = True):
+        if self.tree is not new_path.tree:
+            raise ValueError("Cannot clone to a path unless they share the same root.")
+
+        self.tree._clone_leaves(np.array([self.leaf]), np.array([new_path.leaf]))
+
+        cloned_path = ArrayPath(self.tree, new_path.leaf)
+        if return_new_path:
+            return cloned_path
+        self.leaf = cloned_path.leaf
+
+    def prune(self):
+        # pruning should only occur on paths that are going to be discarded from the tree.
+        self.tree._prune_leaves(np.array([self.leaf]))
+
+    @property
+    def total_reward(self) -> float:
+        return float(self.tree._cumulative_rewards[self.leaf])
+
+    @property
+    def average_reward(self) -> float:
+        return self.total_reward / len(self)
+
+    @property
+    def last_node(self) -> ArrayStateNode:
+        return ArrayStateNode(self.tree, self.leaf)
+
+    @property
+    def last_action(self):
+        if len(self) < 2:
+            return None
+        return self.tree._actions[self.leaf]
+
+    def get_action_between(self, state: ArrayStateNode, next_state: ArrayStateNode):
+        if self.tree._parents[next_state.id] != state.id:
+            raise ValueError(f"No edge exists between {state} and {next_state}.")
+        return self.tree._actions[next_state.id]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ArrayPath):
+            return False
+        return self.tree is other.tree and self.leaf == other.leaf
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.leaf))
+
+    def __str__(self):
+        return f"Path(len={len(self)}, total_reward={self.total_reward})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __len__(self):
+        return int(self.tree._depths[self.leaf]) + 1
+
+    def __iter__(self):
+        # stop one early because the last state should have no child nodes
+        # therefore there won't be any actions registered for that state for this path.
+        ancestry = self.tree._get_ancestry(self.leaf)
+        for i in range(len(ancestry) - 2):
+            state = ArrayStateNode(self.tree, ancestry[i])
+            action = self.tree._actions[ancestry[i + 1]]
+            yield state, action
+
+
+class ArrayGameTree:
+    """Drop-in alternative to `GameTree` that stores every node's parent index, depth, action,
+    reward, visits and number of child walkers in preallocated (growable) numpy arrays instead of
+    a networkx graph. A whole level is added in a single vectorized call, and cloning finds the
+    common ancestors of all cloned walkers at once by walking the parent pointers level by level.
+
+    Nodes are identified by their integer index. `walker_paths`, `best_path` and the nodes
+    returned by them are lightweight views into the arrays, and `g` builds a networkx graph on
+    demand (for rendering and `TreeSampler`). The indices of pruned nodes are reused by the next
+    nodes that are added, so the arrays only grow with the number of live nodes.
+
+    NOTE: rewards are stored as detached floats, so unlike `GameTree` this tree won't retain
+    gradients for rewards produced by a model.
+    """
+
+    def __init__(
+        self,
+        num_walkers: int,
+        root_observation=None,
+        prune: bool = True,
+        initial_capacity: int = 1024,
+    ):
+        self.num_walkers = num_walkers
+        self.prune = prune
+
+        self._capacity = 0
+        self._size = 0
+        self._version = 0
+        self._cached_graph = None
+        self._cached_visits = None
+
+        self._parents = np.empty(0, dtype=np.int64)
+        self._depths = np.empty(0, dtype=np.int64)
+        self._rewards = np.empty(0, dtype=np.float64)
+        self._cumulative_rewards = np.empty(0, dtype=np.float64)
+        self._hits = np.empty(0, dtype=np.int64)
+        self._num_child_walkers = np.empty(0, dtype=np.int64)
+        self._terminal = np.empty(0, dtype=bool)
+        self._alive = np.empty(0, dtype=bool)
+
+        # non-numeric node data is index-addressed.
+        self._observations = []
+        self._actions = []
+        self._infos = []
+
+        # slots of pruned nodes, reused by the next nodes that are added.
+        self._free_nodes: List[int] = []
+
+        self._ensure_capacity(max(initial_capacity, num_walkers + 1))
+
+        # the root node always lives at index 0 and has no parent.
+        self._parents[0] = -1
+        self._depths[0] = 0
+        self._rewards[0] = 0
+        self._cumulative_rewards[0] = 0
+        self._hits[0] = 0
+        self._num_child_walkers[0] = self.num_walkers
+        self._terminal[0] = False
+        self._alive[0] = True
+        self._observations.append(root_observation)
+        self._actions.append(None)
+        self._infos.append(None)
+        self._size = 1
+
+        self.root = ArrayStateNode(self, 0)
+        self.walker_leaves = np.zeros(self.num_walkers, dtype=np.int64)
+
+    @property
+    def num_nodes(self) -> int:
+        return int(self._alive[: self._size].sum())
+
+    def _ensure_capacity(self, capacity: int):
+        if capacity <= self._capacity:
+            return
+
+        new_capacity = max(capacity, 2 * self._capacity)
+        for attr in (
+            "_parents",
+            "_depths",
+            "_rewards",
+            "_cumulative_rewards",
+            "_hits",
+            "_num_child_walkers",
+            "_terminal",
+            "_alive",
+        ):
+            old = getattr(self, attr)
+            new = np.empty(new_capacity, dtype=old.dtype)
+            new[: self._size] = old[: self._size]
+            setattr(self, attr, new)
+
+        self._capacity = new_capacity
+
+    def _get_ancestry(self, leaf: int) -> List[int]:
+        """Node indices from the root to `leaf` (inclusive)."""
+
+        ancestry = []
+        node = int(leaf)
+        while node >= 0:
+            ancestry.append(node)
+            node = int(self._parents[node])
+        ancestry.reverse()
+        return ancestry
+
+    def build_next_level(
+        self,
+        actions: Sequence,
+        new_observations: Sequence,
+        rewards: Sequence,
+        infos: Sequence = None,
+        freeze_mask=None,
+        walker_indices: Sequence = None,
+    ):
+        """Add a new node to the end of every non-frozen walker's path. When `walker_indices` is
+        given, only those walkers are extended and all other arguments have one entry per given
+        walker (`freeze_mask` is ignored).
+        """
+
+        if walker_indices is None:
+            if freeze_mask is None:
+                freeze_mask = np.zeros(self.num_walkers, dtype=bool)
+            if infos is None:
+                infos = [None] * self.num_walkers
+
+            assert (
+                len(actions)
+                == len(new_observations)
+                == len(rewards)
+                == len(freeze_mask)
+                == self.num_walkers
+            )
+
+            active = ~_as_numpy(freeze_mask, dtype=bool)
+            walker_indices = np.flatnonzero(active)
+
+            active_list = active.tolist()
+            actions = list(compress(actions, active_list))
+            new_observations = list(compress(new_observations, active_list))
+            rewards = _as_numpy(rewards, dtype=np.float64).reshape(self.num_walkers)[active]
+            infos = list(compress(infos, active_list))
+        else:
+            walker_indices = _as_numpy(walker_indices, dtype=np.int64)
+            if infos is None:
+                infos = [None] * len(walker_indices)
+
+            assert (
+                len(actions)
+                == len(new_observations)
+                == len(rewards)
+                == len(infos)
+                == len(walker_indices)
+            )
+
+        num_new = len(walker_indices)
+        if num_new == 0:
+            return
+
+        num_reused = min(num_new, len(self._free_nodes))
+        num_appended = num_new - num_reused
+        reused_nodes = self._free_nodes[len(self._free_nodes) - num_reused :]
+        del self._free_nodes[len(self._free_nodes) - num_reused :]
+
+        self._ensure_capacity(self._size + num_appended)
+        new_nodes = np.concatenate(
+            (
+                np.array(reused_nodes, dtype=np.int64),
+                np.arange(self._size, self._size + num_appended),
+            )
+        )
+        parents = self.walker_leaves[walker_indices]
+        new_rewards = _as_numpy(rewards, dtype=np.float64).reshape(num_new)
+
+        self._parents[new_nodes] = parents
+        self._depths[new_nodes] = self._depths[parents] + 1
+        self._rewards[new_nodes] = new_rewards
+        self._cumulative_rewards[new_nodes] = (
+            self._cumulative_rewards[parents] + new_rewards
+        )
+        self._hits[new_nodes] = 0
+        self._num_child_walkers[new_nodes] = 1
+        # TODO: denote terminal states
+        self._terminal[new_nodes] = False
+        self._alive[new_nodes] = True
+
+        new_actions = [copy(a) for a in actions]
+        for node, observation, action, info in zip(
+            reused_nodes, new_observations, new_actions, infos
+        ):
+            self._observations[node] = observation
+            self._actions[node] = action
+            self._infos[node] = info
+        self._observations.extend(new_observations[num_reused:])
+        self._actions.extend(new_actions[num_reused:])
+        self._infos.extend(infos[num_reused:])
+
+        self._size += num_appended
+        self.walker_leaves[walker_indices] = new_nodes
+        self._version += 1
+
+    def _clone_leaves(self, leaves: np.ndarray, target_leaves: np.ndarray):
+        """Move walkers sitting at `leaves` over to `target_leaves`. The child walker counts are
+        decremented below the common ancestor along the old paths and incremented below it along
+        the new paths. Every node along the new paths (up to the root) is visited once more, which
+        is only recorded as a hit on the target leaves (see `_get_visits`).
+        """
+
+        a = leaves.copy()
+        b = target_leaves.copy()
+
+        def _step_a(mask):
+            np.subtract.at(self._num_child_walkers, a[mask], 1)
+            a[mask] = self._parents[a[mask]]
+
+        def _step_b(mask):
+            np.add.at(self._num_child_walkers, b[mask], 1)
+            b[mask] = self._parents[b[mask]]
+
+        # bring both sides to the same depth, then walk up in lockstep until they meet.
+        while True:
+            mask = self._depths[a] > self._depths[b]
+            if not mask.any():
+                break
+            _step_a(mask)
+
+        while True:
+            mask = self._depths[b] > self._depths[a]
+            if not mask.any():
+                break
+            _step_b(mask)
+
+        while True:
+            mask = a != b
+            if not mask.any():
+                break
+            _step_a(mask)
+            _step_b(mask)
+
+        np.add.at(self._hits, target_leaves, 1)
+        self._version += 1
+
+    def _prune_leaves(self, leaves: np.ndarray):
+        pruned = []
+        nodes = np.unique(leaves)
+        while len(nodes) > 0:
+            should_prune = self._alive[nodes] & (self._num_child_walkers[nodes] <= 0)
+            nodes = nodes[should_prune]
+
+            # NOTE: the root is never pruned, it always has all walkers as children.
+            self._alive[nodes] = False
+            for node in nodes.tolist():
+                self._observations[node] = None
+                self._actions[node] = None
+                self._infos[node] = None
+                self._free_nodes.append(node)
+            pruned.append(nodes)
+
+            nodes = np.unique(self._parents[nodes])
+            nodes = nodes[nodes >= 0]
+
+        # the visits of the pruned nodes still count for the nodes above them, so their hits are
+        # passed on to their parents, deepest first.
+        pruned = np.concatenate(pruned)
+        pruned = pruned[np.argsort(-self._depths[pruned], kind="stable")]
+        for level in np.split(pruned, np.flatnonzero(np.diff(self._depths[pruned])) + 1):
+            np.add.at(self._hits, self._parents[level], self._hits[level])
+            self._hits[level] = 0
+
+        self._version += 1
+
+    def _get_visits(self) -> np.ndarray:
+        """The visits of every node: 1 (for creating it), plus the hits of all nodes below it
+        (including itself). Recomputed only when the tree changes.
+        """
+
+        if self._cached_visits is not None and self._cached_visits[0] == self._version:
+            return self._cached_visits[1]
+
+        size = self._size
+        depths = self._depths[:size]
+        parents = self._parents[:size]
+
+        nodes = np.flatnonzero(self._alive[:size])
+        nodes = nodes[np.argsort(-depths[nodes], kind="stable")]
+        visits = np.zeros(size, dtype=np.int64)
+        visits[nodes] = self._hits[nodes]
+        for level in np.split(nodes, np.flatnonzero(np.diff(depths[nodes])) + 1):
+            level = level[parents[level] >= 0]
+            np.add.at(visits, parents[level], visits[level])
+        visits[nodes] += 1
+
+        self._cached_visits = (self._version, visits)
+        return visits
+
+    def clone(self, partners: Sequence, clone_mask: Sequence):
+        clone_mask = _as_numpy(clone_mask, dtype=bool)
+        partners = _as_numpy(partners, dtype=np.int64)
+
+        walker_indices = np.flatnonzero(clone_mask)
+        if len(walker_indices) == 0:
+            return
+
+        old_leaves = self.walker_leaves[walker_indices]
+        new_leaves = self.walker_leaves[partners[walker_indices]]
+
+        self._clone_leaves(old_leaves, new_leaves)
+        self.walker_leaves[walker_indices] = new_leaves
+
+        if self.prune:
+            self._prune_leaves(old_leaves)
+
+    def _get_ancestors_at_depth(self, nodes: np.ndarray, depth: int) -> np.ndarray:
+        nodes = nodes.copy()
+        while True:
+            deeper = self._depths[nodes] > depth
+            if not deeper.any():
+                return nodes
+            nodes[deeper] = self._parents[nodes[deeper]]
+
+    def get_root_children(self) -> List[ArrayStateNode]:
+        """The child of the root that each walker's path goes through (None if still at the root)."""
+
+        children = self._get_ancestors_at_depth(self.walker_leaves, 1)
+        return [
+            ArrayStateNode(self, child) if child != 0 else None
+            for child in children.tolist()
+        ]
+
+    def reroot(self, new_root: ArrayStateNode):
+        """Make a child of the root the new root, discarding every node that isn't below it (and
+        all pruned nodes). All walkers' paths must go through `new_root`. Rewards and depths become
+        relative to the new root.
+
+        NOTE: the remaining nodes are compacted, so node views taken before rerooting are invalid.
+        """
+
+        new_root_index = new_root.id
+        children = self._get_ancestors_at_depth(self.walker_leaves, 1)
+        if self._depths[new_root_index] != 1 or (children != new_root_index).any():
+            raise ValueError("All walkers must go through the new root.")
+
+        size = self._size
+        depths = self._depths[:size]
+        parents = self._parents[:size]
+
+        # parents are always one level above their children, so keeping the descendants of the new
+        # root can be propagated level by level.
+        nodes = np.flatnonzero(self._alive[:size])
+        nodes = nodes[np.argsort(depths[nodes], kind="stable")]
+        level_starts = np.searchsorted(depths[nodes], np.arange(2, depths[nodes].max() + 2))
+
+        keep = np.zeros(size, dtype=bool)
+        keep[new_root_index] = True
+        for start, end in zip(level_starts[:-1], level_starts[1:]):
+            level = nodes[start:end]
+            keep[level] = keep[parents[level]]
+
+        # the new root moves to index 0 (reused indices of its descendants may be lower).
+        kept = np.flatnonzero(keep)
+        kept = np.concatenate(([new_root_index], kept[kept != new_root_index]))
+        remap = np.full(size, -1, dtype=np.int64)
+        remap[kept] = np.arange(len(kept))
+
+        reward = self._cumulative_rewards[new_root_index]
+        num_kept = len(kept)
+        new_parents = remap[np.maximum(parents[kept], 0)]
+        new_parents[parents[kept] < 0] = -1
+        self._parents[:num_kept] = new_parents
+        for attr in (
+            "_depths",
+            "_rewards",
+            "_cumulative_rewards",
+            "_hits",
+            "_num_child_walkers",
+            "_terminal",
+            "_alive",
+        ):
+            array = getattr(self, attr)
+            array[:num_kept] = array[kept]
+
+        self._depths[:num_kept] -= 1
+        self._cumulative_rewards[:num_kept] -= reward
+        self._rewards[0] = 0
+
+        kept_list = kept.tolist()
+        self._observations = [self._observations[i] for i in kept_list]
+        self._actions = [self._actions[i] for i in kept_list]
+        self._infos = [self._infos[i] for i in kept_list]
+        self._actions[0] = None
+
+        self._size = num_kept
+        self._free_nodes = []
+        self.walker_leaves = remap[self.walker_leaves]
+        self._version += 1
+
+    @property
+    def walker_paths(self) -> List[ArrayPath]:
+        return [ArrayPath(self, leaf) for leaf in self.walker_leaves.tolist()]
+
+    @property
+    def best_path(self) -> ArrayPath:
+        totals = self._cumulative_rewards[self.walker_leaves]
+        return ArrayPath(self, self.walker_leaves[totals.argmax()])
+
+    @property
+    def last_actions(self):
+        return [p.last_action for p in self.walker_paths]
+
+    def get_depths(self) -> torch.Tensor:
+        return torch.tensor(self._depths[self.walker_leaves] + 1, dtype=float)
+
+    def get_total_rewards(self) -> torch.Tensor:
+        return torch.tensor(self._cumulative_rewards[self.walker_leaves], dtype=float)
+
+    @property
+    def g(self) -> nx.DiGraph:
+        """A networkx view of all nodes that haven't been pruned. It is rebuilt only when the
+        tree changes.
+        """
+
+        if self._cached_graph is not None and self._cached_graph[0] == self._version:
+            return self._cached_graph[1]
+
+        g = nx.DiGraph()
+        nodes = np.flatnonzero(self._alive[: self._size])
+        views = {i: ArrayStateNode(self, i) for i in nodes.tolist()}
+        g.add_nodes_from(views.values())
+        for i, node in views.items():
+            parent = int(self._parents[i])
+            if parent >= 0:
+                g.add_edge(views[parent], node, action=self._actions[i])
+
+        self._cached_graph = (self._version, g)
+        return g
+
+    def render(self, label_type: str = "reward"):
+        g = self.g
+
+        colors = []
+        labels = {}
+        for node in g.nodes:
+            if node == self.root:
+                colors.append("green")
+            else:
+                colors.append("red")
+
+            if label_type == "reward":
+                labels[node] = f"{node.reward:.1f}"
+            elif label_type == "num_child_walkers":
+                labels[node] = f"{node.num_child_walkers}"
+            else:
+                raise NotImplementedError(label_type)
+
+        nx.draw(g, labels=labels, with_labels=True, node_color=colors, node_size=80)
+        plt.show()
@@ -1,77 +1,248 @@
-from typing import Callable
+from typing import Callable, List, Sequence, Type, Union
+import networkx as nx
 import torch
 import numpy as np
 
 from tqdm import tqdm
+from fractal_zero.search.similarity import get_similarity_function, l2_distance
 from fractal_zero.search.tree import GameTree
-from fractal_zero.utils import cloning_primitive, normalize_and_log_exp
+from fractal_zero.search.walker_state import WalkerState
+from fractal_zero.utils import RNGSeed, as_float, get_rng, normalize_and_log_exp, select_indices
 
 from fractal_zero.vectorized_environment import VectorizedEnvironment
 
-_ATTRIBUTES_TO_CLONE = (
-    "states",
-    "observations",
-    "rewards",
-    "dones",
-    "scores",
-    "average_scores",
-    "actions",
-    "infos",
-)
+def _walker_field(name: str):
+    """A per-walker field stored in the FMC's `WalkerState`."""
+
+    return property(
+        lambda self: self.walkers.get(name),
+        lambda self, values: self.walkers.set(name, values),
+    )
+
 
 class FMC:
+    # all per-walker fields are cloned together when walkers are cloned.
+    states = _walker_field("states")
+    observations = _walker_field("observations")
+    rewards = _walker_field("rewards")
+    dones = _walker_field("dones")
+    scores = _walker_field("scores")
+    average_scores = _walker_field("average_scores")
+    actions = _walker_field("actions")
+    infos = _walker_field("infos")
+
     def __init__(
         self,
         vectorized_environment: VectorizedEnvironment,
         balance: float = 1.0,
         disable_cloning: bool = False,
         use_average_rewards: bool = False,
-        similarity_function: Callable = torch.dist,
+        similarity_function: Union[str, Callable] = l2_distance,
         freeze_best: bool = True,
         track_tree: bool = True,
         prune_tree: bool = True,
+        tree_class: Type[GameTree] = GameTree,
+        recycle_terminal_walkers: bool = False,
+        num_groups: int = 1,
+        root_observations: Sequence = None,
+        reset_environment: bool = True,
+        validate: bool = False,
+        seed: RNGSeed = None,
     ):
         self.vec_env = vectorized_environment
         self.balance = balance
         self.disable_cloning = disable_cloning
         self.use_average_rewards = use_average_rewards
-        self.similarity_function = similarity_function
+        # maps the walkers' and their partners' states to one distance per walker (see
+        # `fractal_zero.search.similarity`), can also be given by name.
+        self.similarity_function = get_similarity_function(similarity_function)
 
         self.freeze_best = freeze_best
         self.track_tree = track_tree
         self.prune_tree = prune_tree
+        self.tree_class = tree_class
+
+        # when enabled, walkers that reach a terminal state are immediately cloned to live walkers
+        # and stepped again in the same simulation step, instead of waiting for the cloning phase.
+        self.recycle_terminal_walkers = recycle_terminal_walkers
+
+        # the walkers can be split into multiple groups of equal size, each running an independent
+        # search (with its own tree, cloning partners, relativization and frozen walker). all groups
+        # are stepped together by the vectorized environment.
+        if self.num_walkers % num_groups != 0:
+            raise ValueError(
+                f"Can't split {self.num_walkers} walkers into {num_groups} groups."
+            )
+        self.num_groups = num_groups
 
-        self.reset()
+        # debug mode: check that the scores match the trees and that the trees are well formed
+        # after every simulation step. this is expensive, so it's off by default.
+        self.validate = validate
+
+        # all of FMC's randomness (clone partners and clone masks) is drawn from this generator.
+        # the vectorized environment has its own generator for actions and resets.
+        self.rng = get_rng(seed)
+
+        self.reset(root_observations, reset_environment=reset_environment)
     
     @property
     def num_walkers(self):
         return self.vec_env.n
 
-    def reset(self):
-        # TODO: may need to make this decision of root observations more effectively for stochastic environments.
-        self.observations = self.vec_env.batch_reset()
-        root_obs = self.observations[0]
+    @property
+    def group_size(self) -> int:
+        return self.num_walkers // self.num_groups
 
-        self.dones = torch.zeros(self.num_walkers).bool()
-        self.states, self.observations, self.rewards, self.infos = (
-            None,
-            None,
-            None,
-            None,
-        )
+    @property
+    def tree(self) -> GameTree:
+        if self.trees is None:
+            return None
+        if self.num_groups != 1:
+            raise ValueError("Searching with multiple groups, use `trees` instead.")
+        return self.trees[0]
+
+    def reset(self, root_observations: Sequence = None, reset_environment: bool = True):
+        """Reset the search. Multiple `root_observations` (one for each group) can only be given if
+        the vectorized environment supports `set_root_observations`, otherwise the environment is
+        reset and every group starts from the same root.
+
+        With `reset_environment=False`, the walkers are assumed to already be at the root (i.e.
+        after `set_all_states`), and the `root_observations` are only used as the trees' roots.
+        """
+
+        if not reset_environment:
+            if root_observations is None or len(root_observations) != self.num_groups:
+                raise ValueError(
+                    f"Expected {self.num_groups} root observations when not resetting the environment."
+                )
+        elif root_observations is None:
+            # TODO: may need to make this decision of root observations more effectively for stochastic environments.
+            observations = self.vec_env.batch_reset()
+            root_observations = [
+                observations[g * self.group_size] for g in range(self.num_groups)
+            ]
+        else:
+            if len(root_observations) != self.num_groups:
+                raise ValueError(
+                    f"Expected {self.num_groups} root observations, got {len(root_observations)}."
+                )
+            self.vec_env.set_root_observations(root_observations)
 
+        self.walkers = WalkerState(self.num_walkers)
+        self.dones = torch.zeros(self.num_walkers).bool()
         self.scores = torch.zeros(self.num_walkers, dtype=float)
         self.average_scores = torch.zeros(self.num_walkers, dtype=float)
+        self.similarities = torch.zeros(self.num_walkers, dtype=float)
         self.clone_mask = torch.zeros(self.num_walkers, dtype=bool)
         self.freeze_mask = torch.zeros((self.num_walkers), dtype=bool)
 
-        self.tree = (
-            GameTree(self.num_walkers, prune=self.prune_tree, root_observation=root_obs)
+        self.trees: List[GameTree] = (
+            [
+                self.tree_class(
+                    self.group_size, prune=self.prune_tree, root_observation=root_obs
+                )
+                for root_obs in root_observations
+            ]
             if self.track_tree
             else None
         )
         self.did_early_exit = False
 
+        # number of walker steps that were simulated, skipped because the walker was at a
+        # terminal state, and recovered by recycling terminal walkers.
+        self.num_walker_steps = 0
+        self.num_dead_walker_steps = 0
+        self.num_recycled_walker_steps = 0
+
+    def get_root_actions(self, greedy: bool = True) -> list:
+        """The first action along the best path of every group's tree. Walkers that are still at
+        the root (i.e. a frozen walker after rerooting) are skipped.
+
+        When not `greedy`, the child of the root is instead sampled proportionally to its visits.
+        """
+
+        if not self.trees:
+            raise ValueError("Root actions require tracking the tree.")
+
+        actions = []
+        for tree in self.trees:
+            children = tree.get_root_children()
+            stepped = torch.tensor([child is not None for child in children])
+            if not stepped.any():
+                raise ValueError("The search hasn't taken any steps yet.")
+
+            if greedy:
+                total_rewards = tree.get_total_rewards()
+                best = int(torch.where(stepped, total_rewards, -np.inf).argmax())
+            else:
+                # one walker through each distinct child of the root.
+                child_walkers = {}
+                for i, child in enumerate(children):
+                    if child is not None:
+                        child_walkers.setdefault(child, i)
+                walkers = list(child_walkers.values())
+                visits = np.array([children[i].visits for i in walkers], dtype=float)
+                best = walkers[self.rng.choice(len(walkers), p=visits / visits.sum())]
+
+            path = tree.walker_paths[best]
+            actions.append(path.get_action_between(tree.root, children[best]))
+        return actions
+
+    def reroot(self, actions: Sequence = None):
+        """Warm-start the next search after `actions` (one for each group, by default the root
+        actions) were taken. Every walker that didn't go through the reached child of the root is
+        cloned to a random walker that did, then each tree is re-rooted at that child, keeping the
+        whole subtree below it. Scores become relative to the new root.
+
+        NOTE: this assumes the (vectorized) environment is deterministic, because the states below
+        the reached child are reused as if they came from the actual environment.
+        """
+
+        if not self.trees:
+            raise ValueError("Rerooting requires tracking the tree.")
+        if actions is None:
+            actions = self.get_root_actions()
+        if len(actions) != self.num_groups:
+            raise ValueError(f"Expected {self.num_groups} actions, got {len(actions)}.")
+
+        new_roots = []
+        on_new_root = torch.zeros(self.num_walkers, dtype=bool)
+        for group, (tree, action) in enumerate(zip(self.trees, actions)):
+            children = tree.get_root_children()
+            paths = tree.walker_paths
+            candidates = [
+                i
+                for i, child in enumerate(children)
+                if child is not None
+                and np.array_equal(paths[i].get_action_between(tree.root, child), action)
+            ]
+            if not candidates:
+                raise ValueError(f"No walker in group {group} took the action {action}.")
+
+            # the same action may lead to multiple children, so keep the best walker's.
+            total_rewards = tree.get_total_rewards()
+            new_root = children[max(candidates, key=lambda i: total_rewards[i])]
+            new_roots.append(new_root)
+
+            offset = group * self.group_size
+            for i, child in enumerate(children):
+                on_new_root[offset + i] = child == new_root
+
+        clone_mask = ~on_new_root
+        if clone_mask.any():
+            partners, _ = self._sample_group_partners(on_new_root)
+            partners = torch.where(clone_mask, partners, torch.arange(self.num_walkers))
+            self._clone_to_partners(partners, clone_mask)
+
+        for group, (tree, new_root) in enumerate(zip(self.trees, new_roots)):
+            reward = as_float(new_root.reward)
+            tree.reroot(new_root)
+            self.scores[group * self.group_size : (group + 1) * self.group_size] -= reward
+
+        self.average_scores = self.scores / self._get_tree_depths()
+        self._set_freeze_mask()
+        self.did_early_exit = False
+
     def simulate(self, steps: int, use_tqdm: bool = False):
         if self.did_early_exit:
             raise ValueError("Already early exited.")
@@ -85,6 +256,9 @@ class FMC:
             
             self._clone_walkers()
 
+            if self.validate:
+                self._validate()
+
     def _perturbate(self):
         """
         Perturbate the walkers by sampling actions from the action space and
@@ -94,67 +268,194 @@ class FMC:
         # What if done is 1 and freeze_mask is 1?
         freeze_steps = torch.logical_or(self.freeze_mask, self.dones)
 
-        # TODO: don't sample actions for frozen environments? (make sure to remove the comments about this)
-        # will make it more legible.
-        self.actions = self.vec_env.batched_action_space_sample()
+        # only the active walkers have actions sampled, are stepped and are added to the tree, so
+        # the amount of work scales with the number of live walkers. frozen walkers keep their
+        # previous actions and return values (with 0 reward), which also keeps FMC's actions in
+        # line with the last actions in the tree.
+        active = np.flatnonzero(~freeze_steps.cpu().numpy())
+        self.num_dead_walker_steps += int(self.dones.sum())
 
+        if self.rewards is None:
+            self.rewards = torch.zeros(self.num_walkers, dtype=float)
+        else:
+            self.rewards.zero_()
+        if len(active) > 0:
+            self._step_walkers(active)
+
+        self._set_freeze_mask()
+
+        if self.recycle_terminal_walkers:
+            self._recycle_terminal_walkers()
+
+    def _step_walkers(self, walker_indices: np.ndarray):
+        actions = self.vec_env.batched_action_space_sample(len(walker_indices))
         (
-            self.states,
-            self.observations,
-            self.rewards,
-            self.dones,
-            self.infos,
-        ) = self.vec_env.batch_step(self.actions, freeze_steps)
-        self.scores += self.rewards
-        self.average_scores = self.scores / self.tree.get_depths()
-
-        if self.tree:
-            # NOTE: the actions that are in the tree will diverge slightly from
-            # those being represented by FMC's internal state. The reason for this is
-            # that when we freeze certain environments in the vectorized environment
-            # object, the actions that are sampled will not be enacted, and the previous
-            # return values will be provided.
-            self.tree.build_next_level(
-                self.actions,
-                self.observations,
-                self.rewards,
-                self.infos,
-                freeze_steps,
-            )
+            states,
+            observations,
+            rewards,
+            dones,
+            infos,
+        ) = self.vec_env.batch_step_walkers(walker_indices, actions)
 
+        self.walkers.scatter("actions", walker_indices, actions)
+        self.walkers.scatter("states", walker_indices, states)
+        self.walkers.scatter("observations", walker_indices, observations)
+        self.walkers.scatter("rewards", walker_indices, rewards)
+        self.walkers.scatter("dones", walker_indices, dones)
+        self.walkers.scatter("infos", walker_indices, infos)
+
+        if self.trees:
+            for tree, group_indices, local_indices in self._split_groups(walker_indices):
+                group_values = [actions, observations, rewards, infos]
+                if group_indices is not None:
+                    group_values = [select_indices(v, group_indices) for v in group_values]
+                tree.build_next_level(*group_values, walker_indices=local_indices)
+
+        indices = torch.from_numpy(walker_indices)
+        self.scores[indices] += self.rewards[indices]
+        self.average_scores = self.scores / self._get_tree_depths()
+        self.num_walker_steps += len(walker_indices)
+
+    def _recycle_terminal_walkers(self):
+        """Walkers that just reached a terminal state are cloned to random live walkers and
+        stepped again right away, so the whole population keeps simulating live states. The frozen
+        (best) walker is never recycled.
+        """
+
+        dead = self.dones & ~self.freeze_mask
+        live = ~self.dones
+        if not dead.any() or not live.any():
+            return
+
+        # walkers in groups without any live walkers are left alone.
+        partners, has_partner = self._sample_group_partners(live)
+        dead = dead & has_partner
+        dead_indices = np.flatnonzero(dead.cpu().numpy())
+        if len(dead_indices) == 0:
+            return
+
+        partners = torch.where(dead, partners, torch.arange(self.num_walkers))
+        self._clone_to_partners(partners, dead)
+        self._step_walkers(dead_indices)
+        self.num_recycled_walker_steps += len(dead_indices)
+
+        # the recycled walkers may have overtaken the best walker.
         self._set_freeze_mask()
-    
+
     def _clone_walkers(self):
         self._set_clone_variables()
 
         if self.disable_cloning:
             return
-        self.vec_env.clone(self.clone_partners, self.clone_mask)
-        if self.tree:
-            self.tree.clone(self.clone_partners, self.clone_mask)
-
-        # doing this allows the GameTree to retain gradients in case training a model on FMC outputs.
-        # it also is required to keep the cloning mechanism in-tact (because of inplace updates).
-        self.rewards = self.rewards.clone()
-        if isinstance(self.observations, torch.Tensor):
-            self.observations = self.observations.clone()
-        if isinstance(self.infos, torch.Tensor):
-            self.infos = self.infos.clone()
-
-        # What is this for? 
-        for attr in _ATTRIBUTES_TO_CLONE:
-            self._clone_variable(attr)
-
-        # sanity checks (TODO: maybe remove this?)
-        if not torch.allclose(self.scores, self.tree.get_total_rewards(), rtol=0.001):
-            raise ValueError(self.scores, self.tree.get_total_rewards())
+        self._clone_to_partners(self.clone_partners, self.clone_mask)
         # if self.rewards[self.freeze_mask].sum().item() != 0:
         #     raise ValueError(self.rewards[self.freeze_mask], self.rewards[self.freeze_mask].sum())
+
+    def _validate(self):
+        if not self.trees:
+            return
+
+        total_rewards = self._get_tree_total_rewards()
+        if not torch.allclose(self.scores, total_rewards, rtol=0.001):
+            raise ValueError(self.scores, total_rewards)
+
+        for tree in self.trees:
+            g = tree.g
+            if g.in_degree(tree.root) != 0:
+                raise ValueError("The root can't have a parent.")
+            if not nx.is_tree(g):
+                raise ValueError("The game tree is no longer a tree.")
+
+            if self.prune_tree:
+                for node in g.nodes:
+                    if node.num_child_walkers <= 0:
+                        raise ValueError(f"{node} should have been pruned.")
+
+            for path in tree.walker_paths:
+                states = path.ordered_states
+                if states[0] != tree.root:
+                    raise ValueError(f"{path} doesn't start at the root.")
+                for state, next_state in zip(states[:-1], states[1:]):
+                    if not g.has_edge(state, next_state):
+                        raise ValueError(f"No edge exists between {state} and {next_state}.")
     
+    def _clone_to_partners(self, partners: torch.Tensor, clone_mask: torch.Tensor):
+        self.vec_env.clone(partners, clone_mask)
+        if self.trees:
+            # partners are always in the same group.
+            group_partners = partners.reshape(self.num_groups, -1) - torch.arange(
+                0, self.num_walkers, self.group_size
+            ).unsqueeze(-1)
+            group_clone_masks = clone_mask.reshape(self.num_groups, -1)
+            for tree, tree_partners, tree_clone_mask in zip(
+                self.trees, group_partners, group_clone_masks
+            ):
+                tree.clone(tree_partners, tree_clone_mask)
+
+        # the tree holds the values returned by the environment, which allows the GameTree to retain
+        # gradients in case training a model on FMC outputs. the walker state holds its own
+        # (detached) copies, so they can be cloned in-place without affecting the tree.
+        self.walkers.clone(partners, clone_mask)
+
+    def _split_groups(self, walker_indices: np.ndarray):
+        """Yields the tree, positions within `walker_indices` (None for all) and indices within the
+        group, for every group that has any of the given walkers.
+        """
+
+        if self.num_groups == 1:
+            yield self.trees[0], None, walker_indices
+            return
+
+        groups = walker_indices // self.group_size
+        for group in np.unique(groups).tolist():
+            group_indices = np.flatnonzero(groups == group)
+            local_indices = walker_indices[group_indices] - group * self.group_size
+            yield self.trees[group], group_indices, local_indices
+
+    def _get_tree_depths(self) -> torch.Tensor:
+        return torch.cat([tree.get_depths() for tree in self.trees])
+
+    def _get_tree_total_rewards(self) -> torch.Tensor:
+        return torch.cat([tree.get_total_rewards() for tree in self.trees])
+
+    def _relativize(self, vector: torch.Tensor) -> torch.Tensor:
+        if self.num_groups == 1:
+            return normalize_and_log_exp(vector)
+        return normalize_and_log_exp(
+            vector.reshape(self.num_groups, self.group_size), dim=-1
+        ).reshape(self.num_walkers)
+
+    def _sample_group_partners(self, valid: torch.Tensor):
+        """Sample a random valid partner for every walker, from within its own group. Also returns
+        which walkers have any valid partner at all.
+        """
+
+        valid = valid.cpu().numpy()
+        groups = np.arange(self.num_walkers) // self.group_size
+
+        valid_indices = np.flatnonzero(valid)
+        counts = np.bincount(groups[valid_indices], minlength=self.num_groups)
+        offsets = np.cumsum(counts) - counts
+
+        walker_counts = counts[groups]
+        choices = np.floor(self.rng.uniform(size=self.num_walkers) * walker_counts)
+        positions = np.minimum(
+            offsets[groups] + choices.astype(int), max(len(valid_indices) - 1, 0)
+        )
+
+        has_partner = walker_counts > 0
+        partners = np.where(
+            has_partner,
+            valid_indices[positions] if len(valid_indices) > 0 else 0,
+            np.arange(self.num_walkers),
+        )
+        return torch.from_numpy(partners).long(), torch.from_numpy(has_partner)
+
     def _set_freeze_mask(self):
         self.freeze_mask = torch.zeros((self.num_walkers), dtype=bool)
         if self.freeze_best:
-            self.freeze_mask[self._score_walkers().argmax()] = 1
+            best = self._score_walkers().reshape(self.num_groups, -1).argmax(dim=-1)
+            self.freeze_mask[best + torch.arange(0, self.num_walkers, self.group_size)] = 1
     
     def _set_clone_variables(self):
         self._set_valid_clone_partners()
@@ -163,23 +464,23 @@ class FMC:
 
     def _set_valid_clone_partners(self):
         # cannot clone to walkers at terminal states
-        valid_clone_partners = np.arange(self.num_walkers)[
-            (self.dones == False).numpy()
-        ]
-
         # TODO: make it so walkers cannot clone to themselves
-        clone_partners = np.random.choice(valid_clone_partners, size=self.num_walkers)
-        self.clone_partners = torch.tensor(clone_partners, dtype=int).long()
+        self.clone_partners, self._has_clone_partner = self._sample_group_partners(
+            self.dones == False
+        )
     
     def _set_clone_mask(self):
         values = self._get_walker_values()
-        self.clone_mask: torch.Tensor[bool] = (values >= torch.rand(1)).bool()
+        self.clone_mask: torch.Tensor[bool] = (values >= self.rng.uniform()).bool()
 
         # clone all walkers at terminal states and not frozen walkers
         self.clone_mask[
             self.dones
         ] = True  # NOTE: sometimes done might be a preferable terminal state (winning)... deal with this.
         self.clone_mask[self.freeze_mask] = False
+
+        # groups where all walkers are at terminal states are finished.
+        self.clone_mask[~self._has_clone_partner] = False
     
     def _get_walker_values(self) -> torch.Tensor:
         """
@@ -188,14 +489,19 @@ class FMC:
         walker_partner_similarities: torch.Tensor = self.similarity_function(
             self.states, self.states[self.clone_partners]
         )
+        if walker_partner_similarities.shape != (self.num_walkers,):
+            raise ValueError(
+                f"Similarity functions must return one value per walker, got shape {tuple(walker_partner_similarities.shape)}."
+            )
+        self.similarities = walker_partner_similarities
 
-        relativized_walker_similarity_scores: torch.Tensor = normalize_and_log_exp(
+        relativized_walker_similarity_scores: torch.Tensor = self._relativize(
             walker_partner_similarities
         )
         relativized_walker_scores: torch.Tensor = (
-            normalize_and_log_exp(self.average_scores)
+            self._relativize(self.average_scores)
             if self.use_average_rewards
-            else normalize_and_log_exp(self.scores)
+            else self._relativize(self.scores)
         )
 
         # Why do we power the walker exploitation scores?
@@ -216,12 +522,3 @@ class FMC:
     
     def _can_early_exit(self) -> torch.Tensor:
         return torch.all(self.dones)
-
-    def _clone_variable(self, subject_var_name: str):
-        subject = getattr(self, subject_var_name)
-        # note: this will be cloned in-place!
-        cloned_subject = cloning_primitive(
-            subject, self.clone_partners, self.clone_mask
-        )
-        setattr(self, subject_var_name, cloned_subject)
-        return cloned_subject
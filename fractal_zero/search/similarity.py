@@ -0,0 +1,94 @@
+"""
+Similarity functions are used by FMC to measure how far each walker is from its clone partner.
+
+Every function takes the walkers' states and their partners' states (both with the walkers along
+the first dimension, i.e. `(N, ...)`) and returns a tensor of shape `(N,)` with one distance per
+walker, computed in a single batched call. Larger values mean the walkers are more different
+(more valuable for exploration).
+"""
+
+from typing import Callable, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _as_matrix(states) -> torch.Tensor:
+    """Flatten states into a detached `(N, D)` tensor. Scalar states become `(N, 1)`."""
+
+    if not isinstance(states, torch.Tensor):
+        states = torch.as_tensor(np.asarray(states))
+    states = states.detach()
+    return states.reshape(len(states), -1)
+
+
+def _as_float_matrix(states) -> torch.Tensor:
+    states = _as_matrix(states)
+    if not torch.is_floating_point(states):
+        states = states.float()
+    return states
+
+
+def l2_distance(states, partner_states) -> torch.Tensor:
+    return torch.linalg.vector_norm(
+        _as_float_matrix(states) - _as_float_matrix(partner_states), ord=2, dim=-1
+    )
+
+
+def l1_distance(states, partner_states) -> torch.Tensor:
+    return torch.linalg.vector_norm(
+        _as_float_matrix(states) - _as_float_matrix(partner_states), ord=1, dim=-1
+    )
+
+
+def cosine_distance(states, partner_states) -> torch.Tensor:
+    # zero vectors have a similarity of 0 (a distance of 1) to everything.
+    return 1 - F.cosine_similarity(
+        _as_float_matrix(states), _as_float_matrix(partner_states), dim=-1
+    )
+
+
+def hamming_distance(states, partner_states) -> torch.Tensor:
+    """Fraction of differing elements, for discrete observations."""
+
+    return (_as_matrix(states) != _as_matrix(partner_states)).float().mean(dim=-1)
+
+
+class EmbeddingDistance:
+    """Distance between learned embeddings of the states. Both the walkers' and their partners'
+    states are embedded with a single forward pass of `embedding_model`.
+    """
+
+    def __init__(
+        self, embedding_model: Callable, distance_function: Callable = l2_distance
+    ):
+        self.embedding_model = embedding_model
+        self.distance_function = distance_function
+
+    @torch.no_grad()
+    def __call__(self, states, partner_states) -> torch.Tensor:
+        states = _as_float_matrix(states)
+        partner_states = _as_float_matrix(partner_states)
+
+        embeddings = self.embedding_model(torch.cat((states, partner_states)))
+        return self.distance_function(embeddings[: len(states)], embeddings[len(states) :])
+
+
+SIMILARITY_FUNCTIONS = {
+    "l2": l2_distance,
+    "l1": l1_distance,
+    "cosine": cosine_distance,
+    "hamming": hamming_distance,
+}
+
+
+def get_similarity_function(similarity_function: Union[str, Callable]) -> Callable:
+    if callable(similarity_function):
+        return similarity_function
+
+    if similarity_function not in SIMILARITY_FUNCTIONS:
+        raise ValueError(
+            f"Unknown similarity function {similarity_function}, expected one of {list(SIMILARITY_FUNCTIONS)}."
+        )
+    return SIMILARITY_FUNCTIONS[similarity_function]
@@ -6,14 +6,30 @@ from uuid import UUID, uuid4
 import numpy as np
 import torch
 
-from fractal_zero.utils import cloning_primitive
+from fractal_zero.utils import as_float, cloning_primitive
+
+
+def _as_tensor(x, dtype) -> torch.Tensor:
+    if isinstance(x, torch.Tensor):
+        return x.detach().to(dtype)
+    return torch.tensor(np.asarray(x), dtype=dtype)
 
 
 class StateNode:
     def __init__(
-        self, observation, reward, info, num_child_walkers: int = 1, terminal: bool = False
+        self,
+        observation,
+        reward,
+        info,
+        num_child_walkers: int = 1,
+        terminal: bool = False,
+        parent: "StateNode" = None,
     ):
         self.id = uuid4()
+        self.parent = parent
+        self.children: List[StateNode] = []
+        if parent is not None:
+            parent.children.append(self)
 
         # NOTE: these may hold references to elements within a tensors. in that case, cloning
         # could be compromised if the original tensors are modified in-place.
@@ -24,90 +40,121 @@ class StateNode:
         self.terminal = terminal
 
         self.num_child_walkers = num_child_walkers
-        self.visits = 1
+
+        # cloning a walker to a path visits every state along it. instead of walking up to the
+        # root, the visit is only recorded on the path's last state and summed up when read.
+        self._hits = 0
+
+    @property
+    def visits(self) -> int:
+        """1 (for creating the state), plus the number of times a walker was cloned to a path
+        going through it.
+        """
+
+        visits = 1
+        states = [self]
+        while states:
+            state = states.pop()
+            visits += state._hits
+            states.extend(state.children)
+        return visits
 
     def __str__(self) -> str:
         return f"State(nc={self.num_child_walkers}, c={self.visits}, r={self.reward})"
 
 
 class Path:
-    ordered_states: List[StateNode]
-
     def __init__(self, root: StateNode, g: nx.Graph):
         self.root = root
         self.g = g
-        self.ordered_states = [self.root]
+
+        # only the last state is kept, the others are reached through the parent pointers. this
+        # way paths share their common states, and cloning doesn't need to copy them.
+        self._last_node = root
+        self._length = 1
+        self._total_reward = as_float(self.root.reward)
+
+    @property
+    def ordered_states(self) -> List[StateNode]:
+        states = []
+        state = self._last_node
+        for _ in range(self._length):
+            states.append(state)
+            state = state.parent
+        states.reverse()
+        return states
+
+    def get_state_at_depth(self, depth: int) -> StateNode:
+        state = self._last_node
+        for _ in range(self._length - 1 - depth):
+            state = state.parent
+        return state
 
     def add_node(self, node: StateNode):
-        self.ordered_states.append(node)
+        self._last_node = node
+        self._length += 1
+        self._total_reward += as_float(node.reward)
 
     def clone_to(self, new_path: "Path", return_new_path: bool = True):
         if self.root != new_path.root:
             raise ValueError("Cannot clone to a path unless they share the same root.")
 
-        common_state = None
-
-        # backpropagate
-        for state in reversed(self.ordered_states):
-            # will break at root or the closest common state
-            if state in new_path.ordered_states:
-                common_state = state
-                break
+        # walk back from both last states until reaching the closest common state (at worst the
+        # root). only the states after it are updated.
+        state, depth = self._last_node, len(self)
+        new_state, new_depth = new_path._last_node, len(new_path)
+        while depth > new_depth or state is not new_state:
+            if depth >= new_depth:
+                state.num_child_walkers -= 1
+                state = state.parent
+                depth -= 1
+            if new_depth > depth:
+                new_state.num_child_walkers += 1
+                new_state = new_state.parent
+                new_depth -= 1
 
-            # only decrement BEFORE the common state.
-            state.num_child_walkers -= 1
+        # every state along the new path is visited once more, including the shared ones.
+        new_path._last_node._hits += 1
 
-        # TODO: maybe don't clear, don't loop through all new path ordered states, begin at the common node.
         cloning_path = self
         if return_new_path:
             cloning_path = Path(self.root, self.g)
 
-        # don't copy, just update reference
-        saw_common = False
-        cloning_path.ordered_states.clear()
-        last_state = None
-        for new_state in new_path.ordered_states:
-            if new_state is common_state:
-                saw_common = True
-            elif saw_common:
-                # only increment AFTER the common state.
-                new_state.num_child_walkers += 1
-
-            # sanity check
-            if last_state and not cloning_path.g.has_edge(last_state, new_state):
-                raise ValueError(
-                    f"No edge exists between {last_state} and {new_state}."
-                )
-
-            new_state.visits += 1
-            cloning_path.add_node(new_state)
-            last_state = new_state
-
-        assert len(cloning_path) == len(new_path)
-        assert cloning_path.total_reward == new_path.total_reward
+        cloning_path._last_node = new_path._last_node
+        cloning_path._length = new_path._length
+        cloning_path._total_reward = new_path._total_reward
 
         if return_new_path:
             return cloning_path
 
     def prune(self):
         # pruning should only occur on paths that are going to be discarded from the tree.
-        for state in reversed(self.ordered_states):
-            should_prune = state.num_child_walkers <= 0 and self.g.has_node(state)
-            if should_prune:
+        state = self._last_node
+        hits = 0
+        while state is not None:
+            if not self.g.has_node(state):
+                # if a state was already pruned, it's safe to assume their parents were as well,
+                # so we can break. unless hits still need to be passed on to the remaining states.
+                if hits == 0:
+                    break
+            elif state.num_child_walkers <= 0:
                 self.g.remove_node(state)
+                state.parent.children.remove(state)
+                hits += state._hits
             else:
                 # if any states have > 0 num child walkers, all of their parents should as well.
-                # also, if a state was already pruned, it's safe to assume their parents were as well,
-                # so we can break.
+                # the visits of the pruned states still count for the ones above them.
+                state._hits += hits
                 break
+            state = state.parent
 
         # clear just so this path doesn't get used again.
-        self.ordered_states.clear()
-        self.ordered_states = None
+        self._last_node = None
 
     @property
     def total_reward(self) -> float:
-        return float(sum([s.reward for s in self.ordered_states]))
+        # accumulated as nodes are added, so this doesn't depend on the path length.
+        return self._total_reward
 
     @property
     def average_reward(self) -> float:
@@ -115,14 +162,13 @@ class Path:
 
     @property
     def last_node(self):
-        return self.ordered_states[-1]
+        return self._last_node
 
     @property
     def last_action(self):
-        if len(self.ordered_states) < 2:
+        if len(self) < 2:
             return None
-        u, v = self.ordered_states[-2], self.ordered_states[-1]
-        return self.get_action_between(u, v)
+        return self.get_action_between(self._last_node.parent, self._last_node)
 
     def get_action_between(self, state, next_state):
         edge_data = self.g.get_edge_data(state, next_state)
@@ -135,10 +181,11 @@ class Path:
         return self.__str__()
 
     def __len__(self):
-        return len(self.ordered_states)
+        return self._length
 
     def __iter__(self):
         self._iter = 0
+        self._iter_states = self.ordered_states
         return self
 
     def __next__(self):
@@ -147,8 +194,8 @@ class Path:
         if self._iter >= len(self) - 2:
             raise StopIteration
 
-        state = self.ordered_states[self._iter]
-        next_state = self.ordered_states[self._iter + 1]
+        state = self._iter_states[self._iter]
+        next_state = self._iter_states[self._iter + 1]
 
         action = self.get_action_between(state, next_state)
 
@@ -175,39 +222,76 @@ class GameTree:
 
         self.walker_paths = [Path(self.root, self.g) for _ in range(self.num_walkers)]
 
+        # per-walker path statistics, kept up to date by `build_next_level` and `clone`.
+        self.total_rewards = torch.zeros(self.num_walkers, dtype=float)
+        self.depths = torch.ones(self.num_walkers, dtype=float)
+
     def build_next_level(
         self,
         actions: Sequence,
         new_observations: Sequence,
         rewards: Sequence,
-        infos: Sequence,
+        infos: Sequence = None,
         freeze_mask=None,
+        walker_indices: Sequence = None,
     ):
-        if freeze_mask is None:
-            freeze_mask = np.zeros(self.num_walkers, dtype=bool)
-
-        assert (
-            len(actions)
-            == len(new_observations)
-            == len(rewards)
-            == len(freeze_mask)
-            == self.num_walkers
-        )
+        """Add a new node to the end of every non-frozen walker's path. When `walker_indices` is
+        given, only those walkers are extended and all other arguments have one entry per given
+        walker (`freeze_mask` is ignored).
+        """
+
+        if walker_indices is None:
+            if freeze_mask is None:
+                freeze_mask = np.zeros(self.num_walkers, dtype=bool)
+            if infos is None:
+                infos = [None] * self.num_walkers
+
+            assert (
+                len(actions)
+                == len(new_observations)
+                == len(rewards)
+                == len(freeze_mask)
+                == self.num_walkers
+            )
+
+            active = ~_as_tensor(freeze_mask, dtype=bool)
+            walker_indices = active.nonzero().flatten().tolist()
+            reward_values = _as_tensor(rewards, dtype=float).reshape(self.num_walkers)[active]
+            actions = [actions[i] for i in walker_indices]
+            new_observations = [new_observations[i] for i in walker_indices]
+            rewards = [rewards[i] for i in walker_indices]
+            infos = [infos[i] for i in walker_indices]
+        else:
+            walker_indices = _as_tensor(walker_indices, dtype=torch.long).tolist()
+            reward_values = _as_tensor(rewards, dtype=float).reshape(len(walker_indices))
+            if infos is None:
+                infos = [None] * len(walker_indices)
+
+            assert (
+                len(actions)
+                == len(new_observations)
+                == len(rewards)
+                == len(infos)
+                == len(walker_indices)
+            )
 
         # TODO: how can we detect duplicate observations / action transitions to save memory? (might not be super important)
-        it = zip(self.walker_paths, actions, new_observations, rewards, infos, freeze_mask)
-        for path, action, new_observation, reward, info, frozen in it:
-            if frozen:
-                continue
-
+        it = zip(walker_indices, actions, new_observations, rewards, infos)
+        for i, action, new_observation, reward, info in it:
+            path = self.walker_paths[i]
             last_node = path.last_node
 
             # TODO: denote terminal states
-            new_node = StateNode(new_observation, reward, info, terminal=False)
+            new_node = StateNode(
+                new_observation, reward, info, terminal=False, parent=last_node
+            )
             path.add_node(new_node)
 
             self.g.add_edge(last_node, new_node, action=copy(action))
 
+        self.total_rewards[walker_indices] += reward_values
+        self.depths[walker_indices] += 1
+
     def clone(self, partners: Sequence, clone_mask: Sequence):
         old_paths: List[Path] = []
 
@@ -219,29 +303,65 @@ class GameTree:
             self.walker_paths, partners, clone_mask, clone_func=_clone_func
         )
 
+        partners = _as_tensor(partners, dtype=torch.long)
+        clone_mask = _as_tensor(clone_mask, dtype=bool)
+        cloning_primitive(self.total_rewards, partners, clone_mask)
+        cloning_primitive(self.depths, partners, clone_mask)
+
         # yes, loop after.
         if self.prune:
             for path in old_paths:
                 path.prune()
 
+    def get_root_children(self) -> List[StateNode]:
+        """The child of the root that each walker's path goes through (None if still at the root)."""
+
+        return [
+            path.get_state_at_depth(1) if len(path) > 1 else None
+            for path in self.walker_paths
+        ]
+
+    def reroot(self, new_root: StateNode):
+        """Make a child of the root the new root, discarding every node that isn't below it. All
+        walkers' paths must go through `new_root`. Rewards and depths become relative to the new
+        root.
+        """
+
+        if any(child is not new_root for child in self.get_root_children()):
+            raise ValueError("All walkers must go through the new root.")
+
+        keep = nx.descendants(self.g, new_root)
+        keep.add(new_root)
+        self.g.remove_nodes_from([node for node in list(self.g.nodes) if node not in keep])
+
+        reward = as_float(new_root.reward)
+        new_root.parent = None
+        new_root.reward = 0
+        self.root = new_root
+
+        # walkers may share the same path object.
+        for path in {id(path): path for path in self.walker_paths}.values():
+            path.root = new_root
+            path._length -= 1
+            path._total_reward -= reward
+
+        self.total_rewards -= reward
+        self.depths -= 1
+
     @property
     def best_path(self):
-        return max(
-            self.walker_paths, key=lambda p: p.total_reward
-        )  # best path of current walker
+        # best path of current walker
+        return self.walker_paths[int(self.total_rewards.argmax())]
 
     @property
     def last_actions(self):
         return [p.last_action for p in self.walker_paths]
 
-    def get_depths(self) -> np.ndarray:
-        depths = torch.zeros(self.num_walkers, dtype=float)
-        for i, path in enumerate(self.walker_paths):
-            depths[i] = len(path)
-        return depths
+    def get_depths(self) -> torch.Tensor:
+        return self.depths.clone()
 
-    def get_total_rewards(self):
-        return torch.tensor([p.total_reward for p in self.walker_paths], dtype=float)
+    def get_total_rewards(self) -> torch.Tensor:
+        return self.total_rewards.clone()
 
     def render(self, label_type: str="reward"):
         colors = []
@@ -0,0 +1,188 @@
+from typing import Any, Dict, List, Union
+import numpy as np
+import torch
+
+from fractal_zero.utils import select_indices
+
+_Array = Union[torch.Tensor, np.ndarray]
+
+
+class WalkerState:
+    """Struct-of-arrays container for per-walker fields (states, rewards, scores, actions, ...).
+
+    Tensors and numpy arrays are kept in preallocated buffers of shape `(num_walkers, ...)`, that
+    are updated in place. Any other values (i.e. lists of observations or infos) are kept in an
+    index-addressed side table: the values are appended to a list, and every walker only holds an
+    index into that list.
+
+    Cloning gathers every field with a single index operation into a preallocated scratch buffer,
+    which is then swapped with the field's buffer, so no memory is allocated while cloning.
+
+    NOTE: values are stored detached from the autograd graph. also, because buffers are swapped
+    when cloning, references to a field's buffer should not be kept across clones.
+    """
+
+    def __init__(self, num_walkers: int):
+        self.num_walkers = num_walkers
+
+        # name -> [buffer, scratch buffer]
+        self._arrays: Dict[str, List[_Array]] = {}
+
+        # name -> (values, [indices into values, scratch indices])
+        self._tables: Dict[str, tuple] = {}
+
+        self._walker_indices = np.arange(num_walkers)
+        self._source = np.empty(num_walkers, dtype=np.int64)
+        self._torch_sources: Dict[torch.device, torch.Tensor] = {}
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._arrays.keys()) + list(self._tables.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._arrays or name in self._tables
+
+    def get(self, name: str) -> Any:
+        """The field's buffer (for arrays) or a list of each walker's value (for the side table).
+        Returns None for fields that were never set.
+        """
+
+        if name in self._arrays:
+            return self._arrays[name][0]
+
+        if name in self._tables:
+            values, (indices, _) = self._tables[name]
+            return [values[i] for i in indices.tolist()]
+
+        return None
+
+    def set(self, name: str, values: Any):
+        """Set the values of all walkers. Arrays are copied into the existing buffer when it has
+        the same shape and dtype. Setting None removes the field.
+        """
+
+        if values is None:
+            self._arrays.pop(name, None)
+            self._tables.pop(name, None)
+            return
+
+        if len(values) != self.num_walkers:
+            raise ValueError(
+                f"Expected {self.num_walkers} values for {name}, got {len(values)}."
+            )
+
+        if isinstance(values, torch.Tensor):
+            values = values.detach()
+            buffers = self._arrays.get(name)
+            if buffers is not None and _is_compatible(buffers[0], values):
+                buffers[0].copy_(values)
+            else:
+                self._tables.pop(name, None)
+                self._arrays[name] = [values.clone(), torch.empty_like(values)]
+            return
+
+        if isinstance(values, np.ndarray):
+            buffers = self._arrays.get(name)
+            if buffers is not None and _is_compatible(buffers[0], values):
+                buffers[0][:] = values
+            else:
+                self._tables.pop(name, None)
+                self._arrays[name] = [values.copy(), np.empty_like(values)]
+            return
+
+        self._arrays.pop(name, None)
+        self._tables[name] = (
+            list(values),
+            [np.arange(self.num_walkers), np.empty(self.num_walkers, dtype=np.int64)],
+        )
+
+    def scatter(self, name: str, walker_indices: np.ndarray, values: Any):
+        """Set the values of the walkers at `walker_indices` in place. If the field doesn't exist
+        yet, all walkers must be given.
+        """
+
+        if name not in self:
+            if len(walker_indices) != self.num_walkers:
+                raise ValueError(f"{name} must be set for all walkers first.")
+            values = select_indices(values, np.argsort(walker_indices))
+            self.set(name, values)
+            return
+
+        if name in self._arrays:
+            buffer = self._arrays[name][0]
+            if isinstance(buffer, torch.Tensor):
+                values = torch.as_tensor(values).detach()
+                buffer[torch.from_numpy(walker_indices).to(buffer.device)] = values.to(
+                    dtype=buffer.dtype, device=buffer.device
+                )
+            else:
+                buffer[walker_indices] = values
+            return
+
+        values_list, (indices, _) = self._tables[name]
+        start = len(values_list)
+        values_list.extend(values)
+        indices[walker_indices] = np.arange(start, len(values_list))
+
+        # drop the values that no walker points to anymore.
+        if len(values_list) > 4 * self.num_walkers:
+            self._compact(name)
+
+    def _compact(self, name: str):
+        values, buffers = self._tables[name]
+        values = [values[i] for i in buffers[0].tolist()]
+        buffers[0] = np.arange(self.num_walkers)
+        self._tables[name] = (values, buffers)
+
+    def _get_torch_source(self, device: torch.device) -> torch.Tensor:
+        if device not in self._torch_sources:
+            if device.type == "cpu":
+                # shares memory with the numpy source indices.
+                self._torch_sources[device] = torch.from_numpy(self._source)
+            else:
+                self._torch_sources[device] = torch.empty(
+                    self.num_walkers, dtype=torch.long, device=device
+                )
+
+        source = self._torch_sources[device]
+        if device.type != "cpu":
+            source.copy_(torch.from_numpy(self._source))
+        return source
+
+    def clone(self, partners, clone_mask):
+        """Every walker in `clone_mask` takes all values of its partner."""
+
+        partners = _as_numpy(partners)
+        clone_mask = _as_numpy(clone_mask).astype(bool, copy=False)
+        np.copyto(self._source, self._walker_indices)
+        np.copyto(self._source, partners, where=clone_mask)
+
+        for buffers in self._arrays.values():
+            buffer, scratch = buffers
+            if isinstance(buffer, torch.Tensor):
+                torch.index_select(
+                    buffer, 0, self._get_torch_source(buffer.device), out=scratch
+                )
+            else:
+                np.take(buffer, self._source, axis=0, out=scratch)
+            buffers[0], buffers[1] = scratch, buffer
+
+        for _, buffers in self._tables.values():
+            indices, scratch = buffers
+            np.take(indices, self._source, out=scratch)
+            buffers[0], buffers[1] = scratch, indices
+
+
+def _is_compatible(buffer: _Array, values: _Array) -> bool:
+    if isinstance(buffer, torch.Tensor) != isinstance(values, torch.Tensor):
+        return False
+    if buffer.shape != values.shape or buffer.dtype != values.dtype:
+        return False
+    return not isinstance(buffer, torch.Tensor) or buffer.device == values.device
+
+
+def _as_numpy(x) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        return x.cpu().numpy()
+    return np.asarray(x)
+
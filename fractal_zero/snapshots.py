@@ -0,0 +1,135 @@
+from copy import copy
+from typing import Any, Dict, Optional, Tuple
+import gym
+from gym.envs.classic_control import (
+    AcrobotEnv,
+    CartPoleEnv,
+    Continuous_MountainCarEnv,
+    MountainCarEnv,
+    PendulumEnv,
+)
+from gym.wrappers import OrderEnforcing, StepAPICompatibility, TimeLimit
+from gym.wrappers.env_checker import PassiveEnvChecker
+
+
+class Snapshotter:
+    """Captures and restores the minimal simulator state of an environment. Used for cloning
+    walkers without having to deepcopy the whole environment (action spaces, RNGs, wrappers,
+    renderers, etc.).
+
+    Snapshots must be independent of the environment they were taken from, and restoring the
+    same snapshot into multiple environments must be safe.
+    """
+
+    def get_snapshot(self, env) -> Any:
+        raise NotImplementedError
+
+    def restore_snapshot(self, env, snapshot: Any):
+        raise NotImplementedError
+
+
+class AttributeSnapshotter(Snapshotter):
+    """Snapshots a fixed set of attributes (shallow copied, so numpy arrays are copied)."""
+
+    def __init__(self, *attributes: str):
+        self.attributes = attributes
+
+    def get_snapshot(self, env) -> Tuple:
+        return tuple(copy(getattr(env, attr)) for attr in self.attributes)
+
+    def restore_snapshot(self, env, snapshot: Tuple):
+        for attr, value in zip(self.attributes, snapshot):
+            setattr(env, attr, copy(value))
+
+
+class HookSnapshotter(Snapshotter):
+    """Defers to the environment's own `get_snapshot`/`restore_snapshot` methods."""
+
+    def get_snapshot(self, env) -> Any:
+        return env.get_snapshot()
+
+    def restore_snapshot(self, env, snapshot: Any):
+        env.restore_snapshot(snapshot)
+
+
+class _WrappedSnapshotter(Snapshotter):
+    def __init__(self, wrapper_snapshotters, core_snapshotter: Snapshotter):
+        self.wrapper_snapshotters = wrapper_snapshotters
+        self.core_snapshotter = core_snapshotter
+
+    def get_snapshot(self, env) -> Tuple:
+        wrapper_snapshots = []
+        for snapshotter in self.wrapper_snapshotters:
+            wrapper_snapshots.append(snapshotter.get_snapshot(env))
+            env = env.env
+        return tuple(wrapper_snapshots), self.core_snapshotter.get_snapshot(env)
+
+    def restore_snapshot(self, env, snapshot: Tuple):
+        wrapper_snapshots, core_snapshot = snapshot
+        for snapshotter, wrapper_snapshot in zip(
+            self.wrapper_snapshotters, wrapper_snapshots
+        ):
+            snapshotter.restore_snapshot(env, wrapper_snapshot)
+            env = env.env
+        self.core_snapshotter.restore_snapshot(env, core_snapshot)
+
+
+SNAPSHOTTERS: Dict[type, Snapshotter] = {
+    CartPoleEnv: AttributeSnapshotter("state", "steps_beyond_terminated"),
+    MountainCarEnv: AttributeSnapshotter("state"),
+    Continuous_MountainCarEnv: AttributeSnapshotter("state"),
+    PendulumEnv: AttributeSnapshotter("state", "last_u"),
+    AcrobotEnv: AttributeSnapshotter("state"),
+}
+
+WRAPPER_SNAPSHOTTERS: Dict[type, Snapshotter] = {
+    TimeLimit: AttributeSnapshotter("_elapsed_steps"),
+    OrderEnforcing: AttributeSnapshotter("_has_reset"),
+    StepAPICompatibility: AttributeSnapshotter(),
+    PassiveEnvChecker: AttributeSnapshotter(),
+}
+
+
+def register_snapshotter(env_class: type, snapshotter: Snapshotter):
+    SNAPSHOTTERS[env_class] = snapshotter
+
+
+def register_wrapper_snapshotter(wrapper_class: type, snapshotter: Snapshotter):
+    WRAPPER_SNAPSHOTTERS[wrapper_class] = snapshotter
+
+
+def _has_snapshot_hook(env) -> bool:
+    # NOTE: checking the type avoids `gym.Wrapper.__getattr__` forwarding to the inner env.
+    return callable(getattr(type(env), "get_snapshot", None)) and callable(
+        getattr(type(env), "restore_snapshot", None)
+    )
+
+
+def _get_core_snapshotter(env) -> Optional[Snapshotter]:
+    if _has_snapshot_hook(env):
+        return HookSnapshotter()
+    return SNAPSHOTTERS.get(type(env), None)
+
+
+def get_snapshotter(env) -> Optional[Snapshotter]:
+    """Find a snapshotter for the environment (including all of its wrappers). An environment
+    can define its own `get_snapshot`/`restore_snapshot` methods, otherwise the registry is
+    used. Returns None if any part of the environment isn't supported, in which case the
+    environment should be deepcopied instead.
+    """
+
+    wrapper_snapshotters = []
+    while isinstance(env, gym.Wrapper) and not _has_snapshot_hook(env):
+        snapshotter = WRAPPER_SNAPSHOTTERS.get(type(env), None)
+        if snapshotter is None:
+            return None
+        wrapper_snapshotters.append(snapshotter)
+        env = env.env
+
+    core_snapshotter = _get_core_snapshotter(env)
+    if core_snapshotter is None:
+        return None
+
+    if len(wrapper_snapshotters) == 0:
+        return core_snapshotter
+    return _WrappedSnapshotter(wrapper_snapshotters, core_snapshotter)
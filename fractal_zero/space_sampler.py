@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import numpy as np
+
+import gym.spaces as spaces
+
+from fractal_zero.utils import RNGSeed, get_rng
+
+
+class SpaceSampler:
+    """Draws a whole batch of samples from a space at once, using a single generator. The
+    samples follow the same distribution as `space.sample()`, but there is no per-sample python
+    overhead and the space's own RNG is never reseeded.
+    """
+
+    def __init__(self, space: spaces.Space, seed: RNGSeed = None):
+        self.space = space
+        self.rng = get_rng(seed)
+
+    def sample(self, n: int):
+        raise NotImplementedError
+
+
+class DiscreteSpaceSampler(SpaceSampler):
+    def sample(self, n: int) -> np.ndarray:
+        return self.space.start + self.rng.integers(self.space.n, size=n)
+
+
+class BoxSpaceSampler(SpaceSampler):
+    def __init__(self, space: spaces.Box, seed: RNGSeed = None):
+        super().__init__(space, seed)
+
+        # classify the coordinates according to their interval type (same as `Box.sample`).
+        self.unbounded = ~space.bounded_below & ~space.bounded_above
+        self.upp_bounded = ~space.bounded_below & space.bounded_above
+        self.low_bounded = space.bounded_below & ~space.bounded_above
+        self.bounded = space.bounded_below & space.bounded_above
+
+        self.high = (
+            space.high if space.dtype.kind == "f" else space.high.astype("int64") + 1
+        )
+
+    def sample(self, n: int) -> np.ndarray:
+        samples = np.empty((n, *self.space.shape))
+
+        samples[:, self.unbounded] = self.rng.normal(size=(n, self.unbounded.sum()))
+        samples[:, self.low_bounded] = (
+            self.rng.exponential(size=(n, self.low_bounded.sum()))
+            + self.space.low[self.low_bounded]
+        )
+        samples[:, self.upp_bounded] = (
+            -self.rng.exponential(size=(n, self.upp_bounded.sum()))
+            + self.space.high[self.upp_bounded]
+        )
+        samples[:, self.bounded] = self.rng.uniform(
+            low=self.space.low[self.bounded],
+            high=self.high[self.bounded],
+            size=(n, self.bounded.sum()),
+        )
+
+        if self.space.dtype.kind == "i":
+            np.floor(samples, out=samples)
+        return samples.astype(self.space.dtype)
+
+
+class MultiDiscreteSpaceSampler(SpaceSampler):
+    def sample(self, n: int) -> np.ndarray:
+        nvec = self.space.nvec
+        samples = self.rng.random((n, *nvec.shape))
+        samples *= nvec
+        return samples.astype(self.space.dtype)
+
+
+class MultiBinarySpaceSampler(SpaceSampler):
+    def sample(self, n: int) -> np.ndarray:
+        return self.rng.integers(
+            low=0, high=2, size=(n, *self.space.shape), dtype=self.space.dtype
+        )
+
+
+class DictSpaceSampler(SpaceSampler):
+    def __init__(self, space: spaces.Dict, seed: RNGSeed = None):
+        super().__init__(space, seed)
+
+        # all subspaces share the same generator.
+        self.samplers = OrderedDict(
+            (key, get_space_sampler(subspace, self.rng))
+            for key, subspace in space.spaces.items()
+        )
+
+    def sample(self, n: int) -> np.ndarray:
+        batches = {key: sampler.sample(n) for key, sampler in self.samplers.items()}
+
+        # each walker's action is a dict of views into the batched subspace samples.
+        samples = np.empty(n, dtype=object)
+        for i in range(n):
+            samples[i] = OrderedDict((key, batch[i]) for key, batch in batches.items())
+        return samples
+
+
+class FallbackSpaceSampler(SpaceSampler):
+    """Used for spaces without a batched sampler. The space is seeded once, then sampled `n`
+    times.
+    """
+
+    def __init__(self, space: spaces.Space, seed: RNGSeed = None):
+        super().__init__(space, seed)
+        self.space.seed(int(self.rng.integers(2**31)))
+
+    def sample(self, n: int) -> list:
+        return [self.space.sample() for _ in range(n)]
+
+
+SAMPLER_CLASSES = {
+    spaces.Discrete: DiscreteSpaceSampler,
+    spaces.Box: BoxSpaceSampler,
+    spaces.MultiDiscrete: MultiDiscreteSpaceSampler,
+    spaces.MultiBinary: MultiBinarySpaceSampler,
+    spaces.Dict: DictSpaceSampler,
+}
+
+
+def get_space_sampler(
+    space: spaces.Space, seed: RNGSeed = None
+) -> SpaceSampler:
+    sampler_class = SAMPLER_CLASSES.get(type(space), FallbackSpaceSampler)
+    return sampler_class(space, seed)
@@ -6,13 +6,22 @@ from tqdm import tqdm
 
 # from fractal_zero.search.fmc import FMC
 from fractal_zero.search.fmc import FMC
-from fractal_zero.search.tree import Path
+from fractal_zero.search.array_tree import ArrayGameTree
+from fractal_zero.search.tree import GameTree, Path
 from fractal_zero.vectorized_environment import (
+    AsyncVectorizedEnvironment,
+    CartPoleVectorizedEnvironment,
     RayVectorizedEnvironment,
     SerialVectorizedEnvironment,
+    ThreadPoolVectorizedEnvironment,
     VectorizedDynamicsModelEnvironment,
 )
 
+from fractal_zero.models.dynamics import FullyConnectedDynamicsModel
+from fractal_zero.models.joint_model import JointModel
+from fractal_zero.models.prediction import FullyConnectedPredictionModel
+from fractal_zero.models.representation import FullyConnectedRepresentationModel
+
 import pytest
 
 
@@ -20,23 +29,27 @@ USE_TQDM = False
 
 
 with_vec_envs = pytest.mark.parametrize(
-    "vec_env_class", [SerialVectorizedEnvironment, RayVectorizedEnvironment]
+    "vec_env_class",
+    [
+        SerialVectorizedEnvironment,
+        RayVectorizedEnvironment,
+        CartPoleVectorizedEnvironment,
+        ThreadPoolVectorizedEnvironment,
+        AsyncVectorizedEnvironment,
+    ],
 )
 cloning = pytest.mark.parametrize("disable_cloning", [True, False])
+with_tree_classes = pytest.mark.parametrize("tree_class", [GameTree, ArrayGameTree])
 
-# def _check_last_actions(fmc: FMC):
-#     last_actions = fmc.tree.last_actions
-#     for last_action, expected_action in zip(last_actions, fmc.actions):
-#         assert last_action == expected_action
+def _check_last_actions(fmc: FMC):
+    last_actions = fmc.tree.last_actions
+    for last_action, expected_action in zip(last_actions, fmc.actions):
+        assert last_action == expected_action
 
 
 def _assert_tree_equivalence(fmc: FMC):
-    # NOTE: the actions that are in the tree will diverge slightly from
-    # those being represented by FMC's internal state. The reason for this is
-    # that when we freeze certain environments in the vectorized environment
-    # object, the actions that are sampled will not be enacted, and the previous
-    # return values will be provided.
-    # _check_last_actions(fmc)
+    # frozen walkers keep their previous actions, so FMC's actions always match the tree.
+    _check_last_actions(fmc)
 
     # check rewards are properly matching scores
     # total_rewards = np.array([p.total_reward for p in fmc.tree.walker_paths])
@@ -122,8 +135,9 @@ def _tree_structural_assertions(fmc: FMC, steps: int):
 @cloning
 @pytest.mark.parametrize("with_freeze", [True, False])
 @pytest.mark.parametrize("prune", [False, True])
+@with_tree_classes
 # @with_vec_envs
-def test_cloning(with_freeze, prune, disable_cloning):
+def test_cloning(with_freeze, prune, disable_cloning, tree_class):
     class DummyEnvironment:
         def __init__(self):
             self.reset()
@@ -147,6 +161,8 @@ def test_cloning(with_freeze, prune, disable_cloning):
         freeze_best=with_freeze,
         prune_tree=prune,
         disable_cloning=disable_cloning,
+        tree_class=tree_class,
+        validate=True,
     )
 
     np.testing.assert_allclose(fmc.scores.numpy(), fmc.tree.get_total_rewards())
@@ -162,8 +178,7 @@ def test_cloning(with_freeze, prune, disable_cloning):
         assert len(fmc.scores) == fmc.num_walkers
         assert len(fmc.actions) == fmc.num_walkers
 
-        if disable_cloning and not with_freeze:
-            assert fmc.actions == fmc.tree.last_actions
+        np.testing.assert_equal(fmc.actions, fmc.tree.last_actions)
 
         assert fmc.states.tolist() == fmc.observations
         np.testing.assert_allclose(fmc.scores.numpy(), fmc.states.numpy())
@@ -196,12 +211,15 @@ def test_cloning(with_freeze, prune, disable_cloning):
 
 @cloning
 @with_vec_envs
-def test_cartpole_actual_environment(vec_env_class, disable_cloning):
+@with_tree_classes
+def test_cartpole_actual_environment(vec_env_class, disable_cloning, tree_class):
     env = gym.make("CartPole-v0")
 
     n = 16
     vec_env = vec_env_class(env, n=n)
-    fmc = FMC(vec_env, disable_cloning=disable_cloning)
+    fmc = FMC(
+        vec_env, disable_cloning=disable_cloning, tree_class=tree_class, validate=True
+    )
 
     if disable_cloning:
         _assert_mean_total_rewards(fmc, 64, 20)
@@ -209,6 +227,228 @@ def test_cartpole_actual_environment(vec_env_class, disable_cloning):
         _assert_mean_total_rewards(fmc, 64, 50)
 
 
+@cloning
+@with_tree_classes
+def test_recycle_terminal_walkers(disable_cloning, tree_class):
+    n = 16
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=n, seed=0)
+    fmc = FMC(
+        vec_env,
+        disable_cloning=disable_cloning,
+        tree_class=tree_class,
+        recycle_terminal_walkers=True,
+    )
+
+    # step manually, so the walkers that died can be checked before they're recycled.
+    fmc.recycle_terminal_walkers = False
+    for _ in range(64):
+        fmc._perturbate()
+        dead = fmc.dones & ~fmc.freeze_mask
+        any_alive = not fmc.dones.all()
+
+        recycled_before = fmc.num_recycled_walker_steps
+        walker_steps_before = fmc.num_walker_steps
+        fmc._recycle_terminal_walkers()
+        num_recycled = fmc.num_recycled_walker_steps - recycled_before
+
+        # every dead walker (other than the frozen one) is recycled and stepped right away, unless
+        # every walker died at once, leaving none to recycle onto.
+        if any_alive:
+            assert num_recycled == dead.sum()
+            assert fmc.num_walker_steps - walker_steps_before == num_recycled
+
+        if fmc._can_early_exit():
+            break
+        fmc._clone_walkers()
+        _assert_tree_equivalence(fmc)
+
+    assert fmc.num_recycled_walker_steps > 0
+    assert fmc.num_walker_steps > 0
+
+    if disable_cloning:
+        # without recycling, dead walkers would be stuck at terminal states forever.
+        fmc = FMC(vec_env, disable_cloning=True, tree_class=tree_class)
+        fmc.simulate(64)
+        assert fmc.num_recycled_walker_steps == 0
+        assert fmc.num_dead_walker_steps > 0
+
+
+@with_tree_classes
+def test_reroot_warm_start(tree_class):
+    n = 16
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=n, seed=0)
+    fmc = FMC(vec_env, tree_class=tree_class)
+    fmc.simulate(8)
+
+    action = fmc.get_root_actions()[0]
+    best_path = fmc.tree.best_path
+    new_root_observation = best_path.ordered_states[1].observation
+    expected_best_score = best_path.total_reward - best_path.ordered_states[1].reward
+    num_nodes = fmc.tree.g.number_of_nodes()
+
+    fmc.reroot()
+    assert fmc.tree.g.number_of_nodes() < num_nodes
+    assert torch.equal(
+        torch.as_tensor(fmc.tree.root.observation), torch.as_tensor(new_root_observation)
+    )
+    assert np.isclose(fmc.scores.max().item(), expected_best_score)
+    _assert_tree_equivalence(fmc)
+    _tree_structural_assertions(fmc, steps=8)
+    for path in fmc.tree.walker_paths:
+        assert path.ordered_states[0] == fmc.tree.root
+
+    # the next search continues from the reused tree.
+    fmc.simulate(8)
+    _assert_tree_equivalence(fmc)
+    assert fmc.tree.get_depths().max() > 8
+    assert fmc.get_root_actions()[0] in (0, 1)
+
+    # one action is needed for every group.
+    with pytest.raises(ValueError):
+        fmc.reroot([action, action])
+
+
+@with_tree_classes
+def test_sampled_root_actions(tree_class):
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=16, seed=0)
+    fmc = FMC(vec_env, tree_class=tree_class, seed=0)
+    fmc.simulate(8)
+
+    # sampled actions come from the root's children, proportionally to their visits.
+    child_actions = {}
+    for path, child in zip(fmc.tree.walker_paths, fmc.tree.get_root_children()):
+        if child is not None:
+            child_actions[child] = path.get_action_between(fmc.tree.root, child)
+    visits = {}
+    for child, action in child_actions.items():
+        visits[action] = visits.get(action, 0) + child.visits
+    assert visits
+
+    counts = {action: 0 for action in visits}
+    for _ in range(200):
+        counts[fmc.get_root_actions(greedy=False)[0]] += 1
+    if len(visits) > 1:
+        expected = {a: v / sum(visits.values()) for a, v in visits.items()}
+        for action, count in counts.items():
+            assert abs(count / 200 - expected[action]) < 0.15
+
+
+@with_tree_classes
+def test_validate(tree_class):
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=8, seed=0)
+    fmc = FMC(vec_env, tree_class=tree_class, validate=True)
+    fmc.simulate(4)
+
+    fmc.scores[0] += 1
+    with pytest.raises(ValueError):
+        fmc.simulate(1)
+
+    # validation is skipped by default.
+    fmc = FMC(vec_env, tree_class=tree_class)
+    fmc.simulate(4)
+    fmc.scores[0] += 1
+    fmc.simulate(1)
+
+
+@with_tree_classes
+def test_seeded_search_is_reproducible(tree_class):
+    def _search(seed):
+        vec_env = SerialVectorizedEnvironment("CartPole-v0", n=16, seed=seed)
+        fmc = FMC(vec_env, tree_class=tree_class, seed=seed)
+        fmc.simulate(16)
+        return fmc
+
+    fmc = _search(seed=0)
+    same_fmc = _search(seed=0)
+    torch.testing.assert_close(fmc.scores, same_fmc.scores)
+    torch.testing.assert_close(fmc.clone_partners, same_fmc.clone_partners)
+    np.testing.assert_equal(fmc.actions, same_fmc.actions)
+    assert fmc.tree.g.number_of_nodes() == same_fmc.tree.g.number_of_nodes()
+
+    other_fmc = _search(seed=1)
+    assert not torch.equal(fmc.clone_partners, other_fmc.clone_partners)
+
+
+def _assert_groups_are_independent(fmc: FMC):
+    groups = torch.arange(fmc.num_walkers) // fmc.group_size
+    assert torch.equal(groups[fmc.clone_partners], groups)
+    assert torch.equal(
+        fmc.freeze_mask.reshape(fmc.num_groups, -1).sum(dim=-1),
+        torch.ones(fmc.num_groups, dtype=torch.long),
+    )
+
+    torch.testing.assert_close(
+        torch.cat([tree.get_total_rewards() for tree in fmc.trees]), fmc.scores
+    )
+    for tree in fmc.trees:
+        assert tree.num_walkers == fmc.group_size
+
+
+@with_tree_classes
+def test_grouped_search(tree_class):
+    num_groups = 4
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=8 * num_groups, seed=0)
+    fmc = FMC(vec_env, num_groups=num_groups, tree_class=tree_class, validate=True)
+    assert len(fmc.trees) == num_groups
+
+    with pytest.raises(ValueError):
+        fmc.tree
+
+    for _ in range(32):
+        fmc.simulate(1)
+        if fmc.did_early_exit:
+            break
+        _assert_groups_are_independent(fmc)
+
+    for tree in fmc.trees:
+        assert tree.best_path.total_reward > 8
+
+
+def test_multi_root_dynamics_model_search():
+    env = gym.make("CartPole-v0")
+    embedding_size = 8
+    joint_model = JointModel(
+        FullyConnectedRepresentationModel(env, embedding_size),
+        FullyConnectedDynamicsModel(env, embedding_size, out_features=1),
+        FullyConnectedPredictionModel(env, embedding_size),
+    )
+
+    num_groups = 3
+    group_size = 8
+    vec_env = VectorizedDynamicsModelEnvironment(
+        env, n=num_groups * group_size, joint_model=joint_model
+    )
+    root_observations = [env.reset(seed=i) for i in range(num_groups)]
+
+    fmc = FMC(vec_env, num_groups=num_groups, root_observations=root_observations)
+    for tree, root_observation in zip(fmc.trees, root_observations):
+        np.testing.assert_equal(tree.root.observation, root_observation)
+
+    # every group starts from its own embedded root.
+    roots = joint_model.representation_model(torch.tensor(np.stack(root_observations)))
+    torch.testing.assert_close(
+        joint_model.dynamics_model.state, roots.repeat_interleave(group_size, dim=0)
+    )
+
+    # all groups are stepped with a single dynamics forward pass.
+    num_forwards = 0
+    forward = joint_model.dynamics_model.forward
+
+    def counting_forward(action):
+        nonlocal num_forwards
+        num_forwards += 1
+        return forward(action)
+
+    joint_model.dynamics_model.forward = counting_forward
+
+    steps = 8
+    with torch.no_grad():
+        fmc.simulate(steps)
+        _assert_groups_are_independent(fmc)
+
+    assert num_forwards == steps
+
+
 # def test_cartpole_dynamics_function():
 #     alphazero_style = False
 
@@ -0,0 +1,67 @@
+import gym
+import numpy as np
+import torch
+
+from fractal_zero.config import FMCConfig, FractalZeroConfig
+from fractal_zero.fractal_zero import FractalZero
+from fractal_zero.models.dynamics import FullyConnectedDynamicsModel
+from fractal_zero.models.joint_model import JointModel
+from fractal_zero.models.prediction import FullyConnectedPredictionModel
+from fractal_zero.models.representation import FullyConnectedRepresentationModel
+
+
+def _build_fractal_zero(search_using_actual_environment: bool) -> FractalZero:
+    env = gym.make("CartPole-v0")
+    joint_model = JointModel(
+        FullyConnectedRepresentationModel(env, 4),
+        FullyConnectedDynamicsModel(env, 4, out_features=1),
+        FullyConnectedPredictionModel(env, 4),
+    )
+    fmc_config = FMCConfig(
+        num_walkers=4, search_using_actual_environment=search_using_actual_environment
+    )
+    config = FractalZeroConfig(
+        env, joint_model, fmc_config=fmc_config, lookahead_steps=4, max_game_steps=8
+    )
+    return FractalZero(config)
+
+
+def test_search_starts_from_actual_environment():
+    fractal_zero = _build_fractal_zero(search_using_actual_environment=True)
+    env = fractal_zero.actual_env
+
+    env.seed(0)
+    obs = env.reset()
+    for _ in range(3):
+        obs, *_ = env.step(0)
+
+    # the search's root is the actual environment's current state, not a reset one.
+    obs = torch.tensor(obs)
+    fractal_zero._start_search(obs)
+    assert torch.equal(torch.as_tensor(fractal_zero.fmc.tree.root.observation), obs)
+
+    fractal_zero.fmc.simulate(1)
+    tree = fractal_zero.fmc.tree
+    for path, child in zip(tree.walker_paths, tree.get_root_children()):
+        expected_env = env.unwrapped.__class__()
+        expected_env.reset()
+        expected_env.state = env.unwrapped.state
+        expected_obs, *_ = expected_env.step(path.get_action_between(tree.root, child))
+        np.testing.assert_allclose(child.observation, expected_obs, rtol=1e-6)
+
+    # a second search (i.e. after the game moved on) also starts from the actual environment.
+    obs, *_ = env.step(1)
+    obs = torch.tensor(obs)
+    fractal_zero._start_search(obs)
+    assert torch.equal(torch.as_tensor(fractal_zero.fmc.tree.root.observation), obs)
+
+
+def test_play_game():
+    fractal_zero = _build_fractal_zero(search_using_actual_environment=False)
+
+    fractal_zero.train()
+    game_history = fractal_zero.play_game()
+    assert 1 < len(game_history) <= 9
+
+    fractal_zero.eval()
+    assert len(fractal_zero.play_game()) > 1
@@ -0,0 +1,331 @@
+import pickle
+
+import gym
+import numpy as np
+import torch
+
+from fractal_zero.config import FractalZeroConfig
+from fractal_zero.data.data_handler import DataHandler
+from fractal_zero.data.memory_mapped_replay_buffer import MemoryMappedReplayBuffer
+from fractal_zero.data.prefetcher import BatchPrefetcher
+from fractal_zero.data.replay_buffer import GameHistory, ReplayBuffer
+from fractal_zero.data.sum_tree import SumTree
+from fractal_zero.models.dynamics import FullyConnectedDynamicsModel
+from fractal_zero.models.joint_model import JointModel
+from fractal_zero.models.prediction import FullyConnectedPredictionModel
+from fractal_zero.models.representation import FullyConnectedRepresentationModel
+
+import pytest
+
+
+def _build_config(**kwargs) -> FractalZeroConfig:
+    env = gym.make("CartPole-v0")
+    joint_model = JointModel(
+        FullyConnectedRepresentationModel(env, 4),
+        FullyConnectedDynamicsModel(env, 4, out_features=1),
+        FullyConnectedPredictionModel(env, 4),
+    )
+    return FractalZeroConfig(env, joint_model, **kwargs)
+
+
+def _build_game(game_id: int, length: int) -> GameHistory:
+    # every frame's values encode the game and frame index, so gathered clips can be checked.
+    game = GameHistory(np.full(4, game_id * 1000, dtype=float))
+    for frame in range(1, length):
+        value = game_id * 1000 + frame
+        game.append(value % 2, np.full(4, value, dtype=float), value, value + 0.5)
+    return game
+
+
+@pytest.mark.parametrize("strategy", ["oldest", "random"])
+def test_eviction(strategy):
+    config = _build_config(
+        max_replay_buffer_size=4, max_game_steps=16, replay_buffer_pop_strategy=strategy
+    )
+    replay_buffer = ReplayBuffer(config, seed=0)
+
+    for game_id in range(10):
+        replay_buffer.append(_build_game(game_id, length=game_id + 2))
+        assert len(replay_buffer) == min(game_id + 1, 4)
+
+    game_ids = sorted(
+        int(replay_buffer.observations[start, 0]) // 1000 for start in replay_buffer._starts
+    )
+    if strategy == "oldest":
+        assert game_ids == [6, 7, 8, 9]
+    else:
+        assert 9 in game_ids
+    assert sorted(replay_buffer.get_episode_lengths()) == sorted(i + 2 for i in game_ids)
+
+    with pytest.raises(ValueError):
+        replay_buffer.append(_build_game(0, length=18))
+
+
+@pytest.mark.parametrize("minimize_batch_padding", [True, False])
+def test_sample_game_clips(minimize_batch_padding):
+    config = _build_config(
+        max_replay_buffer_size=8,
+        max_game_steps=32,
+        minimize_batch_padding=minimize_batch_padding,
+    )
+    replay_buffer = ReplayBuffer(config, seed=0)
+    lengths = [3, 10, 33]
+    for game_id, length in enumerate(lengths):
+        replay_buffer.append(_build_game(game_id, length))
+
+    clip_length = 8
+    clips = replay_buffer.sample_game_clips(64, clip_length)
+    observations, actions, rewards, values, num_empty_frames, weights, indices, _ = clips
+    assert (weights == 1).all()
+    np.testing.assert_allclose(observations[:, 0], replay_buffer.observations[indices])
+    assert observations.shape == (64, clip_length, 4)
+    assert actions.shape == rewards.shape == values.shape == (64, clip_length)
+
+    for i in range(64):
+        num_frames = clip_length - num_empty_frames[i]
+        game_id = int(observations[i, 0, 0]) // 1000
+        start_frame = int(observations[i, 0, 0]) % 1000
+        expected = game_id * 1000 + start_frame + np.arange(num_frames)
+
+        assert start_frame + num_frames == min(start_frame + clip_length, lengths[game_id])
+        if minimize_batch_padding:
+            assert num_empty_frames[i] == max(clip_length - lengths[game_id], 0)
+
+        np.testing.assert_allclose(observations[i, :num_frames, 0], expected)
+
+        # the first frame of every game has no reward or value.
+        is_first_frame = start_frame + np.arange(num_frames) == 0
+        np.testing.assert_allclose(
+            rewards[i, :num_frames], np.where(is_first_frame, 0, expected)
+        )
+        np.testing.assert_allclose(
+            values[i, :num_frames], np.where(is_first_frame, 0, expected + 0.5)
+        )
+        assert (observations[i, num_frames:] == 0).all()
+        assert (values[i, num_frames:] == 0).all()
+
+    clip = replay_buffer.sample_game_clip(clip_length, pad_to_num_frames=False)
+    assert len(clip[0]) == clip_length - clip[4]
+    clip = replay_buffer.sample_game_clip(clip_length)
+    assert len(clip[0]) == clip_length
+
+    game = replay_buffer.sample_game()
+    assert len(game) in lengths
+
+
+def test_get_batch():
+    config = _build_config(max_replay_buffer_size=8, max_game_steps=32, max_batch_size=6)
+    data_handler = DataHandler(config)
+    for game_id, length in enumerate([3, 10, 33]):
+        data_handler.replay_buffer.append(_build_game(game_id, length))
+
+    batch = data_handler.get_batch(8)
+    (
+        observations,
+        actions,
+        auxiliaries,
+        values,
+        num_empty_frames,
+        weights,
+        indices,
+        generations,
+    ) = batch
+
+    # dynamic batch sizes are limited by the number of games.
+    assert observations.shape == (3, 8, 4)
+    assert actions.shape == (3, 8, 1)
+    assert auxiliaries.shape == values.shape == (3, 8, 1)
+    assert observations.dtype == actions.dtype == values.dtype == torch.float32
+    assert weights.shape == indices.shape == generations.shape == (3,)
+
+    # padded frames are empty.
+    num_frames = (observations[..., 0] != 0).sum() + (observations[:, 0, 0] == 0).sum()
+    assert num_empty_frames == 3 * 8 - num_frames
+
+    # the batch arrays are reused.
+    data_ptr = observations.data_ptr()
+    assert data_handler.get_batch(8)[0].data_ptr() == data_ptr
+
+
+def test_batch_prefetcher():
+    config = _build_config(max_replay_buffer_size=8, max_game_steps=32, max_batch_size=6)
+    data_handler = DataHandler(config)
+    prefetcher = BatchPrefetcher(data_handler, 8, num_batches=2)
+
+    data_handler.replay_buffer.append(_build_game(0, 10))
+    observations, actions, auxiliaries, values, _, weights, *_ = prefetcher.get()
+    assert observations.shape == (1, 8, 4)
+    assert actions.shape == auxiliaries.shape == values.shape == (1, 8, 1)
+    assert weights.shape == (1,)
+
+    # games can be appended while batches are prefetched.
+    for game_id in range(1, 12):
+        data_handler.replay_buffer.append(_build_game(game_id, 10 + game_id))
+        observations = prefetcher.get()[0]
+        assert observations.shape[1:] == (8, 4)
+        assert (observations[:, 0, 0] // 1000 <= game_id).all()
+
+    metrics = prefetcher.get_metrics()
+    assert 0 <= metrics["data/prefetch_starvation_rate"] <= 1
+    assert metrics["data/prefetch_queue_size"] <= 2
+
+    # the worker thread isn't pickled, and is restarted by the next `get`.
+    restored = pickle.loads(pickle.dumps(prefetcher))
+    assert not restored.running
+    assert restored.get()[0].shape == (6, 8, 4)
+    restored.close()
+
+    prefetcher.close()
+    assert not prefetcher.running
+
+
+def test_sum_tree():
+    rng = np.random.default_rng(0)
+    tree = SumTree(100)
+    priorities = rng.uniform(size=100)
+    priorities[::7] = 0
+    tree.update(np.arange(100), priorities)
+    assert np.isclose(tree.total, priorities.sum())
+
+    # every value maps to the item whose cumulative priority range contains it.
+    values = rng.uniform(size=1000) * tree.total
+    cumulative = np.cumsum(priorities)
+    expected = np.searchsorted(cumulative, values, side="right")
+    np.testing.assert_array_equal(tree.find(values), expected)
+    assert (tree[tree.find(values)] > 0).all()
+
+    # empty items are never found, even at the edges.
+    assert tree[tree.find([0.0, tree.total])].min() > 0
+
+    tree.update([3, 50], [10.0, 0.0])
+    priorities[[3, 50]] = [10.0, 0.0]
+    assert np.isclose(tree.total, priorities.sum())
+    np.testing.assert_allclose(tree[np.arange(100)], priorities)
+
+
+def test_prioritized_replay():
+    config = _build_config(
+        max_replay_buffer_size=4,
+        max_game_steps=16,
+        prioritized_replay=True,
+        priority_alpha=1.0,
+        priority_beta=1.0,
+    )
+    replay_buffer = ReplayBuffer(config, seed=0)
+    for game_id in range(4):
+        replay_buffer.append(_build_game(game_id, 10))
+
+    # new frames all have the same priority, and padding frames are never sampled.
+    *_, weights, indices, generations = replay_buffer.sample_game_clips(256, 4)
+    np.testing.assert_allclose(weights, 1)
+    assert (generations == 1).all()
+    assert (indices % replay_buffer.max_game_length < 10).all()
+
+    # nearly all of the priority goes to a single clip.
+    frame = replay_buffer._starts[2] + 5
+    replay_buffer.update_priorities(indices, generations, np.ones(len(indices)))
+    replay_buffer.update_priorities([frame], [1], [1000.0])
+    observations, *_, weights, indices, _ = replay_buffer.sample_game_clips(256, 4)
+    assert (indices == frame).mean() > 0.9
+    assert (observations[indices == frame, 0, 0] == 2005).all()
+
+    # rarely sampled clips get the largest weights.
+    assert weights[indices == frame].max() < weights[indices != frame].min()
+    assert weights.max() == 1
+
+    # new games get the highest priority seen so far.
+    replay_buffer.append(_build_game(4, 10))
+    slot = int(np.flatnonzero(replay_buffer.observations[replay_buffer._starts, 0] == 4000)[0])
+    np.testing.assert_allclose(
+        replay_buffer.priorities[replay_buffer._starts[slot] + np.arange(10)], 1000 + 1e-6
+    )
+    assert (replay_buffer.priorities[replay_buffer._starts[slot] + np.arange(10, 17)] == 0).all()
+
+    # updates for games that were evicted since sampling are ignored, even when the new game in
+    # their slot is as long (i.e. while batches are prefetched).
+    all_frames = np.arange(replay_buffer.capacity * replay_buffer.max_game_length)
+    all_generations = replay_buffer._generations[all_frames // replay_buffer.max_game_length]
+    replay_buffer.update_priorities(all_frames, all_generations, np.ones(len(all_frames)))
+    # frames past the end of a game are never given a priority.
+    assert replay_buffer.priorities.total == pytest.approx(4 * 10 * (1 + 1e-6))
+    *_, indices, generations = replay_buffer.sample_game_clips(256, 4)
+    next_slot = replay_buffer._next_slot
+    in_next_slot = indices // replay_buffer.max_game_length == next_slot
+    assert in_next_slot.any()
+    replay_buffer.append(_build_game(5, 10))
+    fresh_priorities = replay_buffer.priorities[indices[in_next_slot]]
+    replay_buffer.update_priorities(indices, generations, np.full(len(indices), 5.0))
+    np.testing.assert_array_equal(
+        replay_buffer.priorities[indices[in_next_slot]], fresh_priorities
+    )
+    assert (replay_buffer.priorities[indices[~in_next_slot]] == 5 + 1e-6).all()
+
+    with pytest.raises(ValueError):
+        ReplayBuffer(_build_config()).update_priorities([0], [1], [1.0])
+
+
+def test_memory_mapped_replay_buffer(tmp_path):
+    config = _build_config(max_replay_buffer_size=4, max_game_steps=16)
+    directory = str(tmp_path / "replay_buffer")
+    replay_buffer = MemoryMappedReplayBuffer(config, directory, seed=0)
+    assert len(replay_buffer) == 0
+
+    for game_id in range(6):
+        replay_buffer.append(_build_game(game_id, length=game_id + 8))
+    assert len(replay_buffer) == 4
+    assert isinstance(replay_buffer.observations, np.memmap)
+
+    # clips are views of the memory-mapped files, zero padded past the end of their game.
+    for _ in range(32):
+        observations, actions, rewards, values, num_empty_frames = (
+            replay_buffer.sample_game_clip(12)
+        )
+        assert observations.shape == (12, 4) and values.shape == (12,)
+        assert np.shares_memory(observations, replay_buffer.observations)
+        assert (observations[12 - num_empty_frames :] == 0).all()
+        assert len(replay_buffer.sample_game_clip(12, pad_to_num_frames=False)[0]) <= 12
+
+    # resuming from the same directory.
+    resumed = MemoryMappedReplayBuffer(config, directory)
+    assert len(resumed) == 4
+    assert resumed.get_episode_lengths() == replay_buffer.get_episode_lengths()
+    np.testing.assert_array_equal(resumed.observations, replay_buffer.observations)
+    assert resumed.sample_game_clips(8, 4)[0].shape == (8, 4, 4)
+
+    # pickling only keeps the directory.
+    restored = pickle.loads(pickle.dumps(replay_buffer))
+    assert not any(isinstance(v, np.memmap) for v in replay_buffer.__getstate__().values())
+    np.testing.assert_array_equal(restored.observations, replay_buffer.observations)
+
+    with pytest.raises(ValueError):
+        MemoryMappedReplayBuffer(_build_config(max_replay_buffer_size=8), directory)
+
+
+def test_memory_mapped_replay_buffer_crash_recovery(tmp_path):
+    config = _build_config(max_replay_buffer_size=4, max_game_steps=16)
+    directory = str(tmp_path / "replay_buffer")
+    replay_buffer = MemoryMappedReplayBuffer(config, directory)
+    for game_id in range(3):
+        replay_buffer.append(_build_game(game_id, length=10))
+
+    # the process dies while the game in slot 0 is being overwritten.
+    replay_buffer._save_state(pending_slot=0)
+    replay_buffer.observations[: replay_buffer.max_game_length] = -1
+
+    resumed = MemoryMappedReplayBuffer(config, directory)
+    assert len(resumed) == 2
+    game_ids = resumed.observations[resumed._starts[:2], 0] // 1000
+    assert sorted(game_ids.tolist()) == [1, 2]
+    assert (resumed.observations >= 0).all()
+
+    resumed.append(_build_game(3, length=5))
+    resumed.append(_build_game(4, length=5))
+    assert len(resumed) == 4
+    assert sorted(resumed.get_episode_lengths()) == [5, 5, 10, 10]
+
+    # with a directory in the config, the data handler uses a memory-mapped buffer.
+    config.replay_buffer_directory = directory
+    data_handler = DataHandler(config)
+    assert isinstance(data_handler.replay_buffer, MemoryMappedReplayBuffer)
+    assert len(data_handler.replay_buffer) == 4
+    assert data_handler.get_batch(4)[0].shape == (4, 4, 4)
@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+
+from fractal_zero.search.similarity import (
+    EmbeddingDistance,
+    cosine_distance,
+    get_similarity_function,
+    hamming_distance,
+    l1_distance,
+    l2_distance,
+)
+
+import pytest
+
+
+def test_distances_are_per_walker():
+    states = torch.tensor([[0.0, 0.0], [1.0, 0.0], [3.0, 4.0]])
+    partner_states = torch.tensor([[0.0, 0.0], [0.0, 1.0], [0.0, 0.0]])
+
+    torch.testing.assert_close(
+        l2_distance(states, partner_states), torch.tensor([0.0, 2**0.5, 5.0])
+    )
+    torch.testing.assert_close(
+        l1_distance(states, partner_states), torch.tensor([0.0, 2.0, 7.0])
+    )
+    torch.testing.assert_close(
+        cosine_distance(states, partner_states), torch.tensor([1.0, 1.0, 1.0])
+    )
+    torch.testing.assert_close(
+        cosine_distance(states, 2 * states)[1:], torch.tensor([0.0, 0.0])
+    )
+
+    discrete_states = np.array([[0, 1, 2, 3], [1, 1, 1, 1]])
+    discrete_partner_states = np.array([[0, 1, 0, 0], [1, 1, 1, 1]])
+    torch.testing.assert_close(
+        hamming_distance(discrete_states, discrete_partner_states),
+        torch.tensor([0.5, 0.0]),
+    )
+
+
+def test_scalar_and_image_states():
+    # scalar states (one per walker) and multi-dimensional observations are flattened.
+    torch.testing.assert_close(
+        l1_distance(torch.tensor([1, 2, 3]), torch.tensor([3, 2, 1])),
+        torch.tensor([2.0, 0.0, 2.0]),
+    )
+
+    states = torch.rand(8, 3, 4, 4)
+    partner_states = torch.rand(8, 3, 4, 4)
+    torch.testing.assert_close(
+        l2_distance(states, partner_states),
+        torch.stack([torch.dist(s, p) for s, p in zip(states, partner_states)]),
+    )
+
+
+def test_embedding_distance():
+    embedding_model = torch.nn.Linear(4, 2)
+    states = torch.rand(8, 4)
+    partner_states = torch.rand(8, 4)
+
+    distances = EmbeddingDistance(embedding_model)(states, partner_states)
+    expected_distances = l2_distance(embedding_model(states), embedding_model(partner_states))
+    torch.testing.assert_close(distances, expected_distances)
+    assert not distances.requires_grad
+
+
+def test_get_similarity_function():
+    assert get_similarity_function("cosine") is cosine_distance
+    assert get_similarity_function(l1_distance) is l1_distance
+
+    with pytest.raises(ValueError):
+        get_similarity_function("l3")
@@ -0,0 +1,73 @@
+import gym.spaces as spaces
+import numpy as np
+
+from fractal_zero.space_sampler import FallbackSpaceSampler, get_space_sampler
+
+import pytest
+
+
+SPACES = [
+    spaces.Discrete(5),
+    spaces.Discrete(3, start=-1),
+    spaces.Box(low=0, high=2, shape=(5, 3)),
+    spaces.Box(
+        low=np.array([-np.inf, 0, -np.inf, -1]), high=np.array([np.inf, np.inf, 1, 1])
+    ),
+    spaces.Box(low=-3, high=3, shape=(2,), dtype=np.int64),
+    spaces.MultiDiscrete([2, 5, 3]),
+    spaces.MultiBinary(4),
+    spaces.Dict(
+        {
+            "x": spaces.Discrete(4),
+            "y": spaces.Box(low=0, high=1, shape=(2,)),
+        }
+    ),
+]
+
+
+@pytest.mark.parametrize("space", SPACES)
+def test_samples_are_contained(space):
+    sampler = get_space_sampler(space, seed=0)
+    assert not isinstance(sampler, FallbackSpaceSampler)
+
+    n = 256
+    samples = sampler.sample(n)
+    assert len(samples) == n
+    for sample in samples:
+        assert space.contains(sample), sample
+
+
+@pytest.mark.parametrize("space", SPACES)
+def test_seeded_samples_are_reproducible(space):
+    samples0 = get_space_sampler(space, seed=1).sample(16)
+    samples1 = get_space_sampler(space, seed=1).sample(16)
+
+    if isinstance(space, spaces.Dict):
+        for s0, s1 in zip(samples0, samples1):
+            for key in space.spaces.keys():
+                np.testing.assert_equal(s0[key], s1[key])
+    else:
+        np.testing.assert_equal(samples0, samples1)
+
+
+@pytest.mark.parametrize("space", SPACES[:7])
+def test_distribution_matches_space_sample(space):
+    n = 20_000
+
+    space.seed(0)
+    expected = np.array([space.sample() for _ in range(n)], dtype=float)
+    actual = get_space_sampler(space, seed=0).sample(n).astype(float)
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual.mean(0), expected.mean(0), atol=0.1)
+    np.testing.assert_allclose(actual.std(0), expected.std(0), atol=0.1)
+
+
+def test_fallback_sampler():
+    space = spaces.Tuple((spaces.Discrete(2), spaces.Discrete(3)))
+    sampler = get_space_sampler(space, seed=0)
+    assert isinstance(sampler, FallbackSpaceSampler)
+
+    samples = sampler.sample(8)
+    assert len(samples) == 8
+    assert all(space.contains(sample) for sample in samples)
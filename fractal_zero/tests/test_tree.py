@@ -1,11 +1,19 @@
+import warnings
+
 import numpy as np
+import torch
 
+from fractal_zero.search.array_tree import ArrayGameTree
 from fractal_zero.search.tree import GameTree
 import pytest
 
 
+with_tree_classes = pytest.mark.parametrize("tree_class", [GameTree, ArrayGameTree])
+
+
 @pytest.mark.parametrize("prune", [True, False])
-def test_tree(prune):
+@with_tree_classes
+def test_tree(prune, tree_class):
     n = 8
     root_observation = 0
     walker_states = np.ones(n) * root_observation
@@ -16,7 +24,7 @@ def test_tree(prune):
         rewards = np.ones(n)
         return actions, rewards
 
-    tree = GameTree(n, root_observation=root_observation, prune=prune)
+    tree = tree_class(n, root_observation=root_observation, prune=prune)
     for _ in range(4):
         actions, rewards = _step(walker_states)
         tree.build_next_level(actions, walker_states, rewards)
@@ -44,3 +52,199 @@ def test_tree(prune):
 
     assert tree.g.in_degree(tree.root) == 0
     assert tree.root.num_child_walkers == n
+
+
+@pytest.mark.parametrize("prune", [True, False])
+def test_array_tree_matches_game_tree(prune):
+    rng = np.random.default_rng(0)
+    n = 16
+
+    tree = GameTree(n, root_observation=0, prune=prune)
+    array_tree = ArrayGameTree(n, root_observation=0, prune=prune, initial_capacity=4)
+
+    for _ in range(32):
+        actions = rng.integers(0, 3, size=n)
+        rewards = actions.astype(float)
+        freeze_mask = rng.uniform(size=n) < 0.2
+        tree.build_next_level(actions, actions, rewards, freeze_mask=freeze_mask)
+        array_tree.build_next_level(actions, actions, rewards, freeze_mask=freeze_mask)
+
+        partners = rng.integers(0, n, size=n)
+        clone_mask = rng.uniform(size=n) < 0.5
+        tree.clone(partners, clone_mask)
+        array_tree.clone(partners, clone_mask)
+
+        np.testing.assert_allclose(
+            tree.get_total_rewards(), array_tree.get_total_rewards()
+        )
+        np.testing.assert_allclose(tree.get_depths(), array_tree.get_depths())
+        assert tree.best_path.total_reward == array_tree.best_path.total_reward
+        assert tree.g.number_of_nodes() == array_tree.g.number_of_nodes()
+        assert tree.g.number_of_edges() == array_tree.g.number_of_edges()
+
+        for path, array_path in zip(tree.walker_paths, array_tree.walker_paths):
+            assert len(path) == len(array_path)
+            for state, array_state in zip(
+                path.ordered_states, array_path.ordered_states
+            ):
+                assert state.num_child_walkers == array_state.num_child_walkers
+                assert state.visits == array_state.visits
+                assert state.reward == array_state.reward
+            assert [a for _, a in path] == [a for _, a in array_path]
+
+
+def test_array_tree_reuses_pruned_nodes():
+    rng = np.random.default_rng(3)
+    n = 16
+
+    tree = ArrayGameTree(n, root_observation=0, prune=True, initial_capacity=4)
+    max_num_nodes = 0
+    for _ in range(64):
+        actions = rng.integers(0, 3, size=n)
+        tree.build_next_level(actions, actions, actions * 1.0)
+        max_num_nodes = max(max_num_nodes, tree.num_nodes)
+        tree.clone(rng.integers(0, n, size=n), rng.uniform(size=n) < 0.5)
+
+    # new nodes only take up new slots once all pruned ones are reused.
+    assert tree._size <= max_num_nodes < n * 64
+    assert tree._size == tree.num_nodes + len(tree._free_nodes)
+
+
+@pytest.mark.parametrize("prune", [True, False])
+@with_tree_classes
+def test_incremental_path_statistics(prune, tree_class):
+    rng = np.random.default_rng(1)
+    n = 8
+
+    tree = tree_class(n, root_observation=0, prune=prune)
+    for _ in range(16):
+        actions = rng.integers(0, 3, size=n)
+        freeze_mask = rng.uniform(size=n) < 0.2
+        tree.build_next_level(actions, actions, actions * 0.5, freeze_mask=freeze_mask)
+        tree.clone(rng.integers(0, n, size=n), rng.uniform(size=n) < 0.3)
+
+        expected_rewards = [
+            sum(s.reward for s in p.ordered_states) for p in tree.walker_paths
+        ]
+        expected_depths = [len(p.ordered_states) for p in tree.walker_paths]
+        np.testing.assert_allclose(tree.get_total_rewards(), expected_rewards)
+        np.testing.assert_allclose(tree.get_depths(), expected_depths)
+
+
+@pytest.mark.parametrize("prune", [True, False])
+def test_reroot_matches_game_tree(prune):
+    rng = np.random.default_rng(2)
+    n = 16
+
+    trees = [
+        GameTree(n, root_observation=0, prune=prune),
+        ArrayGameTree(n, root_observation=0, prune=prune, initial_capacity=4),
+    ]
+
+    def _step(steps):
+        for _ in range(steps):
+            actions = rng.integers(0, 3, size=n)
+            freeze_mask = rng.uniform(size=n) < 0.2
+            partners = rng.integers(0, n, size=n)
+            clone_mask = rng.uniform(size=n) < 0.5
+            for tree in trees:
+                tree.build_next_level(actions, actions, actions + 1.0, freeze_mask=freeze_mask)
+                tree.clone(partners, clone_mask)
+
+    _step(8)
+
+    # move every walker under the best walker's child of the root.
+    best = int(trees[0].get_total_rewards().argmax())
+    children = trees[0].get_root_children()
+    on_new_root = np.array([child is children[best] for child in children])
+    partners = np.where(on_new_root, np.arange(n), best)
+    for tree in trees:
+        with pytest.raises(ValueError):
+            tree.reroot(tree.get_root_children()[best])
+
+        tree.clone(partners, ~on_new_root)
+        new_root = tree.get_root_children()[best]
+        reward = new_root.reward
+        depths = tree.get_depths()
+        total_rewards = tree.get_total_rewards()
+
+        tree.reroot(new_root)
+        assert tree.root.reward == 0
+        assert tree.g.in_degree(tree.root) == 0
+        np.testing.assert_allclose(tree.get_depths(), depths - 1)
+        np.testing.assert_allclose(tree.get_total_rewards(), total_rewards - reward)
+
+    # the re-rooted trees keep growing the same way.
+    _step(8)
+    tree, array_tree = trees
+    np.testing.assert_allclose(tree.get_total_rewards(), array_tree.get_total_rewards())
+    np.testing.assert_allclose(tree.get_depths(), array_tree.get_depths())
+    assert tree.g.number_of_nodes() == array_tree.g.number_of_nodes()
+    for path, array_path in zip(tree.walker_paths, array_tree.walker_paths):
+        assert path.ordered_states[0] is tree.root
+        assert [a for _, a in path] == [a for _, a in array_path]
+        assert path.total_reward == array_path.total_reward
+
+
+@with_tree_classes
+def test_clone_visits(tree_class):
+    tree = tree_class(2, root_observation=0, prune=False)
+
+    tree.build_next_level([0, 1], [0, 1], [0.0, 0.0])
+    a = tree.walker_paths[0].ordered_states[1]
+    b = tree.walker_paths[1].ordered_states[1]
+
+    # every state along the partner's path is visited again, including the root.
+    tree.clone([0, 0], [False, True])
+    assert tree.root.visits == 2
+    assert a.visits == 2
+    assert b.visits == 1
+
+    tree.build_next_level([2, 3], [2, 3], [0.0, 0.0])
+    c = tree.walker_paths[0].ordered_states[2]
+    d = tree.walker_paths[1].ordered_states[2]
+
+    # also when both paths share more than the root.
+    tree.clone([1, 1], [True, False])
+    assert tree.root.visits == 3
+    assert a.visits == 3
+    assert d.visits == 2
+    assert c.visits == 1
+
+
+@with_tree_classes
+def test_clone_visits_after_pruning(tree_class):
+    tree = tree_class(3, root_observation=0, prune=True)
+
+    tree.build_next_level([0, 1, 2], [0, 1, 2], [0.0, 0.0, 0.0])
+    a = tree.walker_paths[0].ordered_states[1]
+    b = tree.walker_paths[1].ordered_states[1]
+    tree.clone([0, 1, 1], [False, False, True])
+    assert b.visits == 2
+
+    # the visits of pruned states still count for the states above them.
+    tree.clone([0, 0, 0], [False, True, True])
+    assert tree.g.number_of_nodes() == 2
+    assert a.visits == 3
+    assert tree.root.visits == 4
+
+
+@with_tree_classes
+def test_rewards_requiring_grad(tree_class):
+    tree = tree_class(2, root_observation=0)
+    rewards = torch.ones(2, requires_grad=True) * 2
+
+    # running totals are tracked detached, without warnings.
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        tree.build_next_level([0, 1], [0, 1], rewards)
+        tree.clone([1, 1], [True, False])
+        tree.build_next_level([0], [0], rewards[:1], walker_indices=[1])
+        assert tree.best_path.total_reward == 4
+        tree.reroot(tree.get_root_children()[1])
+
+    np.testing.assert_allclose(tree.get_total_rewards(), [0, 2])
+
+    if tree_class is GameTree:
+        # the GameTree's nodes keep the rewards as passed in, so they retain gradients.
+        assert tree.best_path.last_node.reward.requires_grad
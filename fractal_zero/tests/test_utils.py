@@ -2,7 +2,7 @@
 import numpy as np
 import torch
 
-from fractal_zero.utils import cloning_primitive
+from fractal_zero.utils import cloning_primitive, normalize_and_log_exp
 
 
 def test_cloning_primitive():
@@ -30,3 +30,16 @@ def test_cloning_primitive():
         assert th_cloned.tolist() == list_cloned
 
     np.random.seed()
+
+
+def test_grouped_normalize_and_log_exp():
+    torch.manual_seed(0)
+
+    groups = torch.randn((4, 16), dtype=float)
+    groups[2] = 3  # constant groups are all ones.
+
+    relativized = normalize_and_log_exp(groups, dim=-1)
+    for group, expected in zip(groups, relativized):
+        torch.testing.assert_close(
+            expected, normalize_and_log_exp(group), check_dtype=False
+        )
@@ -0,0 +1,564 @@
+import asyncio
+from copy import deepcopy
+import time
+import gym
+import numpy as np
+import torch
+
+from fractal_zero.vectorized_environment import (
+    AsyncVectorizedEnvironment,
+    CartPoleVectorizedEnvironment,
+    ProcessVectorizedEnvironment,
+    RayVectorizedEnvironment,
+    SerialVectorizedEnvironment,
+    ThreadPoolVectorizedEnvironment,
+)
+
+import pytest
+
+
+@pytest.mark.parametrize("env_id", ["CartPole-v0", "CartPole-v1"])
+def test_cartpole_matches_gym(env_id):
+    n = 8
+    rng = np.random.default_rng(0)
+
+    vec_env = CartPoleVectorizedEnvironment(env_id, n=n, seed=0)
+    vec_env.batch_reset()
+
+    envs = [gym.make(env_id) for _ in range(n)]
+    for i, env in enumerate(envs):
+        env.reset()
+        env.unwrapped.state = vec_env._state[i].copy()
+
+    done_mask = np.zeros(n, dtype=bool)
+    for _ in range(600):
+        actions = rng.integers(0, 2, size=n)
+        states, observations, rewards, dones, infos = vec_env.batch_step(
+            actions, done_mask
+        )
+
+        assert len(infos) == n
+        assert torch.equal(states, observations)
+
+        for i, env in enumerate(envs):
+            if done_mask[i]:
+                assert rewards[i] == 0
+                assert dones[i]
+                continue
+
+            obs, reward, done, _ = env.step(actions[i])
+            np.testing.assert_allclose(observations[i].numpy(), obs, rtol=1e-5)
+            assert rewards[i] == reward
+            assert dones[i] == done
+
+        done_mask = dones.numpy()
+        if done_mask.all():
+            break
+
+    assert done_mask.all()
+
+
+def test_cartpole_clone_and_freeze():
+    n = 4
+    vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=n, seed=1)
+    vec_env.batch_reset()
+
+    frozen_mask = np.array([True, False, False, False])
+    frozen_state = vec_env._state[0].copy()
+    actions = vec_env.batched_action_space_sample()
+    _, _, rewards, _, _ = vec_env.batch_step(actions, frozen_mask)
+
+    np.testing.assert_equal(vec_env._state[0], frozen_state)
+    assert rewards.tolist() == [0, 1, 1, 1]
+
+    partners = np.array([0, 0, 3, 3])
+    clone_mask = np.array([False, True, True, False])
+    vec_env.clone(partners, clone_mask)
+
+    np.testing.assert_equal(vec_env._state[1], vec_env._state[0])
+    np.testing.assert_equal(vec_env._state[2], vec_env._state[3])
+    assert vec_env._elapsed_steps.tolist() == [0, 0, 1, 1]
+
+
+@pytest.mark.parametrize(
+    "env_id",
+    [
+        "CartPole-v0",
+        "MountainCar-v0",
+        "MountainCarContinuous-v0",
+        "Pendulum-v1",
+        "Acrobot-v1",
+    ],
+)
+def test_snapshot_clone_matches_deepcopy(env_id):
+    n = 8
+    rng = np.random.default_rng(0)
+
+    snapshot_env = SerialVectorizedEnvironment(env_id, n=n)
+    deepcopy_env = SerialVectorizedEnvironment(env_id, n=n, use_snapshots=False)
+    assert snapshot_env.use_snapshots
+    assert not deepcopy_env.use_snapshots
+
+    observations = snapshot_env.batch_reset(seed=0)
+    assert np.allclose(observations, deepcopy_env.batch_reset(seed=0))
+
+    frozen_mask = np.zeros(n, dtype=bool)
+    for _ in range(32):
+        actions = snapshot_env.batched_action_space_sample()
+        ret0 = snapshot_env.batch_step(actions, frozen_mask)
+        ret1 = deepcopy_env.batch_step(actions, frozen_mask)
+
+        torch.testing.assert_close(ret0[0], ret1[0])
+        torch.testing.assert_close(ret0[2], ret1[2])
+        assert torch.equal(ret0[3], ret1[3])
+
+        frozen_mask = ret0[3].numpy()
+        partners = rng.integers(0, n, size=n)
+        clone_mask = rng.uniform(size=n) < 0.5
+        snapshot_env.clone(partners, clone_mask)
+        deepcopy_env.clone(partners, clone_mask)
+        frozen_mask = frozen_mask.copy()
+        frozen_mask[clone_mask] = frozen_mask[partners][clone_mask]
+
+
+def test_snapshot_hook_and_fallback():
+    class HookEnvironment(gym.Env):
+        action_space = gym.spaces.Discrete(3)
+
+        def reset(self):
+            self.position = 0
+            return self.position
+
+        def step(self, action):
+            self.position += action
+            return self.position, action, False, {}
+
+        def get_snapshot(self):
+            return self.position
+
+        def restore_snapshot(self, snapshot):
+            self.position = snapshot
+
+    class UnsupportedEnvironment(HookEnvironment):
+        get_snapshot = None
+
+    for env_class, expect_snapshots in (
+        (HookEnvironment, True),
+        (UnsupportedEnvironment, False),
+    ):
+        vec_env = SerialVectorizedEnvironment(env_class(), n=2)
+        assert vec_env.use_snapshots == expect_snapshots
+
+        vec_env.batch_reset()
+        vec_env.batch_step([1, 2], np.zeros(2, dtype=bool))
+        vec_env.clone(np.array([1, 0]), np.array([True, False]))
+
+        assert [env._env.position for env in vec_env.envs] == [2, 2]
+        assert vec_env.envs[0].last_ret == vec_env.envs[1].last_ret
+
+    # the snapshotter follows the environment the walkers are set to.
+    vec_env.set_all_states(HookEnvironment(), None)
+    assert all(env.supports_snapshots for env in vec_env.envs)
+
+
+@pytest.mark.parametrize("use_snapshots", [True, False])
+def test_serial_clone_after_set_all_states(use_snapshots):
+    n = 4
+    vec_env = SerialVectorizedEnvironment("CartPole-v0", n=n, use_snapshots=use_snapshots)
+    vec_env.batch_reset(seed=0)
+
+    actual_env = gym.make("CartPole-v0")
+    actual_env.reset(seed=1)
+    obs, _, _, _ = actual_env.step(0)
+    vec_env.set_all_states(actual_env, obs)
+
+    # every walker continues from the actual environment's state, without changing it.
+    expected_env = deepcopy(actual_env)
+    expected_obs, _, _, _ = expected_env.step(1)
+    states, _, _, _, _ = vec_env.batch_step([1, 0, 0, 0], np.zeros(n, dtype=bool))
+    np.testing.assert_allclose(states[0].numpy(), expected_obs)
+    np.testing.assert_allclose(actual_env.unwrapped.state, obs)
+
+    vec_env.clone(np.array([0, 0, 2, 3]), np.array([False, True, False, False]))
+    states, _, _, _, _ = vec_env.batch_step([1, 1, 0, 0], np.zeros(n, dtype=bool))
+    torch.testing.assert_close(states[0], states[1])
+    torch.testing.assert_close(states[2], states[3])
+
+
+@pytest.mark.parametrize("walkers_per_actor", [1, 3])
+def test_ray_clone_matches_serial(walkers_per_actor):
+    n = 5
+    rng = np.random.default_rng(0)
+
+    ray_env = RayVectorizedEnvironment(
+        "CartPole-v0", n=n, walkers_per_actor=walkers_per_actor
+    )
+    assert ray_env.num_actors == int(np.ceil(n / walkers_per_actor))
+    serial_env = SerialVectorizedEnvironment("CartPole-v0", n=n)
+    ray_env.batch_reset(seed=0)
+    serial_env.batch_reset(seed=0)
+
+    frozen_mask = np.zeros(n, dtype=bool)
+    for _ in range(32):
+        actions = rng.integers(0, 2, size=n).tolist()
+        ray_ret = ray_env.batch_step(actions, frozen_mask)
+        serial_ret = serial_env.batch_step(actions, frozen_mask)
+
+        torch.testing.assert_close(ray_ret[0], serial_ret[0])
+        torch.testing.assert_close(ray_ret[2], serial_ret[2])
+        assert torch.equal(ray_ret[3], serial_ret[3])
+
+        partners = rng.integers(0, n, size=n)
+        clone_mask = rng.uniform(size=n) < 0.5
+        ray_env.clone(partners, clone_mask)
+        serial_env.clone(partners, clone_mask)
+
+        frozen_mask = ray_ret[3].numpy().copy()
+        frozen_mask[clone_mask] = frozen_mask[partners][clone_mask]
+
+
+def test_ray_action_sampling_is_seeded():
+    n = 4
+    samples = []
+    for _ in range(2):
+        ray_env = RayVectorizedEnvironment("CartPole-v0", n=n, walkers_per_actor=n, seed=3)
+        samples.append([ray_env.batched_action_space_sample() for _ in range(4)])
+
+    assert len(samples[0][0]) == n
+    np.testing.assert_equal(samples[0], samples[1])
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 5])
+def test_process_clone_matches_serial(num_workers):
+    n = 5
+    rng = np.random.default_rng(0)
+
+    process_env = ProcessVectorizedEnvironment("CartPole-v0", n=n, num_workers=num_workers)
+    assert process_env.num_workers == num_workers
+    serial_env = SerialVectorizedEnvironment("CartPole-v0", n=n)
+    process_env.batch_reset(seed=0)
+    serial_env.batch_reset(seed=0)
+
+    try:
+        frozen_mask = np.zeros(n, dtype=bool)
+        for _ in range(32):
+            actions = rng.integers(0, 2, size=n)
+            process_ret = process_env.batch_step(actions, frozen_mask)
+            serial_ret = serial_env.batch_step(actions, frozen_mask)
+
+            torch.testing.assert_close(process_ret[0], serial_ret[0], check_dtype=False)
+            torch.testing.assert_close(process_ret[2], serial_ret[2])
+            assert torch.equal(process_ret[3], serial_ret[3])
+            assert process_ret[4] == serial_ret[4]
+
+            # returned observations must not change when the shared buffers are overwritten.
+            assert not np.shares_memory(
+                process_ret[1].numpy(), process_env.observation_buffer
+            )
+
+            partners = rng.integers(0, n, size=n)
+            clone_mask = rng.uniform(size=n) < 0.5
+            process_env.clone(partners, clone_mask)
+            serial_env.clone(partners, clone_mask)
+
+            frozen_mask = process_ret[3].numpy().copy()
+            frozen_mask[clone_mask] = frozen_mask[partners][clone_mask]
+    finally:
+        process_env.close()
+
+
+@pytest.mark.parametrize("use_snapshots", [True, False])
+def test_thread_pool_matches_serial(use_snapshots):
+    n = 7
+    rng = np.random.default_rng(0)
+
+    thread_env = ThreadPoolVectorizedEnvironment(
+        "CartPole-v0", n=n, num_workers=3, use_snapshots=use_snapshots
+    )
+    serial_env = SerialVectorizedEnvironment(
+        "CartPole-v0", n=n, use_snapshots=use_snapshots
+    )
+    thread_env.batch_reset(seed=0)
+    serial_env.batch_reset(seed=0)
+
+    frozen_mask = np.zeros(n, dtype=bool)
+    for _ in range(32):
+        actions = rng.integers(0, 2, size=n)
+        thread_ret = thread_env.batch_step(actions, frozen_mask)
+        serial_ret = serial_env.batch_step(actions, frozen_mask)
+
+        assert torch.equal(thread_ret[0], serial_ret[0])
+        assert torch.equal(thread_ret[2], serial_ret[2])
+        assert torch.equal(thread_ret[3], serial_ret[3])
+
+        partners = rng.integers(0, n, size=n)
+        clone_mask = rng.uniform(size=n) < 0.5
+        thread_env.clone(partners, clone_mask)
+        serial_env.clone(partners, clone_mask)
+
+        frozen_mask = thread_ret[3].numpy().copy()
+        frozen_mask[clone_mask] = frozen_mask[partners][clone_mask]
+
+    thread_env.close()
+
+
+class FakeServer:
+    """Stand-in for a remote simulator, with injected latency. Shared by all of its clients."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __deepcopy__(self, memo):
+        return self
+
+    async def call(self, result):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return result
+
+
+class FakeRemoteEnvironment:
+    action_space = gym.spaces.Discrete(3)
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+        self.position = 0
+
+    async def reset(self):
+        self.position = 0
+        return await self.server.call(np.array([self.position], dtype=float))
+
+    async def step(self, action):
+        self.position += int(action)
+        obs = np.array([self.position], dtype=float)
+        return await self.server.call((obs, float(action), self.position >= 10, {}))
+
+    def get_snapshot(self):
+        return self.position
+
+    def restore_snapshot(self, position):
+        self.position = position
+
+
+def test_async_steps_concurrently():
+    n = 16
+    server = FakeServer(latency=0.05)
+    vec_env = AsyncVectorizedEnvironment(FakeRemoteEnvironment(server), n=n)
+    assert vec_env.use_snapshots
+
+    vec_env.batch_reset()
+    start = time.perf_counter()
+    states, _, rewards, dones, infos = vec_env.batch_step(
+        np.ones(n, dtype=int), np.zeros(n, dtype=bool)
+    )
+    elapsed = time.perf_counter() - start
+
+    assert server.max_in_flight == n
+    assert elapsed < n * server.latency / 4
+    assert torch.equal(states, torch.ones((n, 1), dtype=float))
+    assert torch.equal(rewards, torch.ones(n, dtype=float))
+    assert len(infos) == n
+
+    # frozen walkers aren't stepped, and cloning copies positions.
+    frozen_mask = np.zeros(n, dtype=bool)
+    frozen_mask[0] = True
+    states, _, rewards, _, _ = vec_env.batch_step(np.full(n, 2), frozen_mask)
+    assert states[0, 0] == 1 and rewards[0] == 0
+    assert states[1, 0] == 3 and rewards[1] == 2
+
+    vec_env.clone(np.ones(n, dtype=int), np.arange(n) == 0)
+    states, _, _, _, _ = vec_env.batch_step(np.zeros(n, dtype=int), np.zeros(n, dtype=bool))
+    assert states[0, 0] == 3
+
+    vec_env.close()
+
+
+def test_async_bounded_concurrency_and_timeout():
+    n = 8
+    server = FakeServer(latency=0.02)
+    vec_env = AsyncVectorizedEnvironment(
+        FakeRemoteEnvironment(server), n=n, max_concurrency=3, timeout=1.0
+    )
+    vec_env.batch_reset()
+    vec_env.batch_step(np.ones(n, dtype=int), np.zeros(n, dtype=bool))
+    assert server.max_in_flight == 3
+
+    server.latency = 0.5
+    vec_env.timeout = 0.05
+    with pytest.raises(TimeoutError):
+        vec_env.batch_step(np.ones(n, dtype=int), np.zeros(n, dtype=bool))
+
+    # the timed out calls were cancelled, and rolled back.
+    assert server.in_flight == 0
+    assert [env.get_state().position for env in vec_env.envs] == [1] * n
+
+    vec_env.close()
+
+
+class SlowEnvironment(gym.Env):
+    """Synchronous environment whose steps take `delay` seconds."""
+
+    action_space = gym.spaces.Discrete(3)
+
+    def __init__(self):
+        self.delay = 0
+        self.position = 0
+
+    def reset(self):
+        self.position = 0
+        return np.array([self.position], dtype=float)
+
+    def step(self, action):
+        time.sleep(self.delay)
+        self.position += int(action)
+        return np.array([self.position], dtype=float), float(action), False, {}
+
+    def get_snapshot(self):
+        return self.position
+
+    def restore_snapshot(self, position):
+        self.position = position
+
+
+def test_async_timed_out_calls_finishing_late():
+    n = 3
+    vec_env = AsyncVectorizedEnvironment(SlowEnvironment(), n=n, timeout=0.1)
+    vec_env.batch_reset()
+    vec_env.batch_step(np.ones(n, dtype=int), np.zeros(n, dtype=bool))
+
+    for env in vec_env.envs:
+        env._env.delay = 0.3
+    with pytest.raises(TimeoutError):
+        vec_env.batch_step(np.full(n, 2), np.zeros(n, dtype=bool))
+
+    # the steps keep running in their threads, cloning waits for them before restoring.
+    vec_env.clone(np.array([1, 1, 2]), np.array([True, False, False]))
+    time.sleep(0.5)
+
+    # and the late steps don't change the walkers' states.
+    assert [env.get_state().position for env in vec_env.envs] == [1, 1, 1]
+    states, _, rewards, _, _ = vec_env.batch_step(np.zeros(n, dtype=int), np.ones(n, dtype=bool))
+    assert torch.equal(states, torch.ones((n, 1), dtype=float))
+
+    for env in vec_env.envs:
+        env._env.delay = 0
+    states, _, _, _, _ = vec_env.batch_step(np.ones(n, dtype=int), np.zeros(n, dtype=bool))
+    assert torch.equal(states, torch.full((n, 1), 2, dtype=float))
+
+    vec_env.close()
+
+
+def test_async_matches_serial_for_gym_environments():
+    n = 4
+    rng = np.random.default_rng(0)
+
+    async_env = AsyncVectorizedEnvironment("CartPole-v0", n=n, max_concurrency=2)
+    serial_env = SerialVectorizedEnvironment("CartPole-v0", n=n)
+    async_env.batch_reset(seed=0)
+    serial_env.batch_reset(seed=0)
+
+    frozen_mask = np.zeros(n, dtype=bool)
+    for _ in range(16):
+        actions = rng.integers(0, 2, size=n)
+        async_ret = async_env.batch_step(actions, frozen_mask)
+        serial_ret = serial_env.batch_step(actions, frozen_mask)
+
+        assert torch.equal(async_ret[0], serial_ret[0])
+        assert torch.equal(async_ret[3], serial_ret[3])
+        frozen_mask = async_ret[3].numpy()
+
+    async_env.close()
+
+
+@pytest.mark.parametrize(
+    "vec_env_class",
+    [
+        CartPoleVectorizedEnvironment,
+        ThreadPoolVectorizedEnvironment,
+        AsyncVectorizedEnvironment,
+        ProcessVectorizedEnvironment,
+    ],
+)
+def test_batch_step_walkers_matches_serial(vec_env_class):
+    n = 6
+    rng = np.random.default_rng(0)
+
+    vec_env = vec_env_class("CartPole-v0", n=n)
+    serial_env = SerialVectorizedEnvironment("CartPole-v0", n=n)
+    observations = vec_env.batch_reset(seed=0)
+    serial_env.batch_reset(seed=0)
+    if vec_env_class == CartPoleVectorizedEnvironment:
+        for env, obs in zip(serial_env.envs, observations):
+            env.get_state().unwrapped.state = obs.numpy().astype(np.float64)
+
+    dones = np.zeros(n, dtype=bool)
+    for _ in range(32):
+        walker_indices = np.flatnonzero(~dones & (rng.uniform(size=n) < 0.7))
+        if len(walker_indices) == 0:
+            continue
+        actions = rng.integers(0, 2, size=len(walker_indices))
+
+        ret = vec_env.batch_step_walkers(walker_indices, actions)
+        serial_ret = serial_env.batch_step_walkers(walker_indices, actions)
+
+        assert len(ret[1]) == len(ret[4]) == len(walker_indices)
+        torch.testing.assert_close(ret[0], serial_ret[0], check_dtype=False)
+        torch.testing.assert_close(ret[2], serial_ret[2])
+        assert torch.equal(ret[3], serial_ret[3])
+
+        dones[walker_indices] = ret[3].numpy()
+        if dones.all():
+            break
+
+    if hasattr(vec_env, "close"):
+        vec_env.close()
+
+
+@pytest.mark.parametrize(
+    "vec_env_class",
+    [
+        SerialVectorizedEnvironment,
+        ThreadPoolVectorizedEnvironment,
+        AsyncVectorizedEnvironment,
+        ProcessVectorizedEnvironment,
+    ],
+)
+def test_seeded_backends_are_reproducible(vec_env_class):
+    n = 5
+
+    def _run(vec_env_class, seed):
+        vec_env = vec_env_class("CartPole-v0", n=n, seed=seed)
+        resets = [np.stack(vec_env.batch_reset()) for _ in range(2)]
+        actions = [vec_env.batched_action_space_sample() for _ in range(4)]
+        if hasattr(vec_env, "close"):
+            vec_env.close()
+        return resets, actions
+
+    resets, actions = _run(vec_env_class, seed=7)
+    expected_resets, expected_actions = _run(SerialVectorizedEnvironment, seed=7)
+    np.testing.assert_equal(resets, expected_resets)
+    np.testing.assert_equal(actions, expected_actions)
+
+    # every walker gets its own stream.
+    assert len(np.unique(resets[0], axis=0)) == n
+    assert not np.array_equal(resets[0], resets[1])
+
+    other_resets, _ = _run(vec_env_class, seed=np.random.default_rng(8))
+    assert not np.array_equal(resets[0], other_resets[0])
+
+
+def test_cartpole_is_seeded():
+    resets = []
+    for _ in range(2):
+        seed = torch.Generator().manual_seed(3)
+        vec_env = CartPoleVectorizedEnvironment("CartPole-v0", n=4, seed=seed)
+        resets.append([vec_env.batch_reset(), vec_env.batched_action_space_sample()])
+
+    torch.testing.assert_close(resets[0][0], resets[1][0])
+    np.testing.assert_equal(resets[0][1], resets[1][1])
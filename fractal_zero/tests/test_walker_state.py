@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+
+from fractal_zero.search.walker_state import WalkerState
+from fractal_zero.utils import cloning_primitive
+
+import pytest
+
+
+def test_clone_matches_cloning_primitive():
+    rng = np.random.default_rng(0)
+    n = 16
+
+    fields = {
+        "states": torch.rand(n, 4),
+        "dones": torch.zeros(n, dtype=bool),
+        "actions": rng.integers(0, 3, size=n),
+        "infos": [{"i": i} for i in range(n)],
+    }
+    walkers = WalkerState(n)
+    for name, values in fields.items():
+        walkers.set(name, values)
+
+    buffer_pointers = {
+        walkers._arrays["states"][0].data_ptr(),
+        walkers._arrays["states"][1].data_ptr(),
+    }
+
+    for _ in range(32):
+        partners = rng.integers(0, n, size=n)
+        clone_mask = rng.uniform(size=n) < 0.5
+        walkers.clone(torch.from_numpy(partners), torch.from_numpy(clone_mask))
+        for name, values in fields.items():
+            fields[name] = cloning_primitive(values, partners, clone_mask)
+
+        # walkers are stepped in between clones.
+        indices = np.flatnonzero(rng.uniform(size=n) < 0.5)
+        new_infos = [{"i": int(i), "step": True} for i in indices]
+        walkers.scatter("infos", indices, new_infos)
+        for i, info in zip(indices, new_infos):
+            fields["infos"][i] = info
+
+        torch.testing.assert_close(walkers.get("states"), fields["states"])
+        assert torch.equal(walkers.get("dones"), fields["dones"])
+        np.testing.assert_equal(walkers.get("actions"), fields["actions"])
+        assert walkers.get("infos") == fields["infos"]
+
+    # cloning only swaps the preallocated buffers.
+    assert {
+        walkers._arrays["states"][0].data_ptr(),
+        walkers._arrays["states"][1].data_ptr(),
+    } == buffer_pointers
+
+    # unused side table values are dropped.
+    assert len(walkers._tables["infos"][0]) <= 4 * n
+
+
+def test_set_and_scatter():
+    n = 4
+    walkers = WalkerState(n)
+    assert walkers.get("rewards") is None
+
+    with pytest.raises(ValueError):
+        walkers.scatter("rewards", np.array([0, 1]), torch.ones(2))
+
+    walkers.scatter("rewards", np.array([3, 2, 1, 0]), torch.tensor([3.0, 2.0, 1.0, 0.0]))
+    torch.testing.assert_close(walkers.get("rewards"), torch.tensor([0.0, 1.0, 2.0, 3.0]))
+
+    rewards = walkers.get("rewards")
+    walkers.scatter("rewards", np.array([1]), [5])
+    walkers.set("rewards", walkers.get("rewards") * 2)
+    assert walkers.get("rewards") is rewards
+    torch.testing.assert_close(rewards, torch.tensor([0.0, 10.0, 4.0, 6.0]))
+
+    # values are detached from the graph.
+    walkers.set("states", torch.ones(n, requires_grad=True))
+    assert not walkers.get("states").requires_grad
+
+    walkers.set("states", None)
+    assert "states" not in walkers
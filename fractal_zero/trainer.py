@@ -5,6 +5,7 @@ import wandb
 import os
 
 from fractal_zero.data.data_handler import DataHandler
+from fractal_zero.data.prefetcher import BatchPrefetcher
 from fractal_zero.fractal_zero import FractalZero
 from fractal_zero.utils import mean_min_max_dict
 
@@ -21,6 +22,14 @@ class FractalZeroTrainer:
         self.data_handler = data_handler
         self.fractal_zero = fractal_zero
 
+        self.prefetcher = None
+        if self.config.prefetch_batches > 0:
+            self.prefetcher = BatchPrefetcher(
+                data_handler,
+                self.config.unroll_steps,
+                num_batches=self.config.prefetch_batches,
+            )
+
         self._setup_optimizer()
         self._setup_lr_schedule()
         self._setup_logger()
@@ -76,7 +85,10 @@ class FractalZeroTrainer:
         return self.fractal_zero.model.prediction_model
 
     def _get_batch(self):
-        batch = self.data_handler.get_batch(self.config.unroll_steps)
+        if self.prefetcher is not None:
+            batch = self.prefetcher.get()
+        else:
+            batch = self.data_handler.get_batch(self.config.unroll_steps)
 
         (
             self.observations,
@@ -84,6 +96,9 @@ class FractalZeroTrainer:
             self.target_auxiliaries,
             self.target_values,
             self.num_empty_frames,
+            self.importance_weights,
+            self.sample_indices,
+            self.sample_generations,
         ) = batch
 
         return batch
@@ -113,22 +128,43 @@ class FractalZeroTrainer:
 
             self.unrolled_values[:, unroll_step] = value_predictions
 
-    def _calculate_losses(self):
-        auxiliary_loss = (
-            self.dynamics_model.auxiliary_loss(
-                self.unrolled_auxiliaries,
-                self.target_auxiliaries,
-            )
-            / self.config.unroll_steps
+    def _per_sample_loss(self, loss_function, predictions, targets) -> torch.Tensor:
+        # NOTE: loss functions must support `reduction="none"` (like the torch functional losses).
+        loss = loss_function(predictions, targets, reduction="none")
+        return loss.reshape(len(predictions), -1).mean(dim=1) / self.config.unroll_steps
+
+    def _update_priorities(self, sample_losses: torch.Tensor):
+        if not self.config.prioritized_replay:
+            return
+
+        self.data_handler.replay_buffer.update_priorities(
+            self.sample_indices,
+            self.sample_generations,
+            sample_losses.detach().cpu().numpy(),
         )
 
-        value_loss = (
-            self.prediction_model.value_loss(self.unrolled_values, self.target_values)
-            / self.config.unroll_steps
+    def _calculate_losses(self):
+        sample_auxiliary_losses = self._per_sample_loss(
+            self.dynamics_model.auxiliary_loss,
+            self.unrolled_auxiliaries,
+            self.target_auxiliaries,
+        )
+        sample_value_losses = self._per_sample_loss(
+            self.prediction_model.value_loss,
+            self.unrolled_values,
+            self.target_values,
         )
 
+        # importance sampling weights correct for the bias of prioritized replay (all 1 otherwise).
+        auxiliary_loss = (self.importance_weights * sample_auxiliary_losses).mean()
+        value_loss = (self.importance_weights * sample_value_losses).mean()
+
         composite_loss = auxiliary_loss + value_loss
 
+        self._update_priorities(sample_auxiliary_losses + sample_value_losses)
+
+        prefetch_metrics = self.prefetcher.get_metrics() if self.prefetcher else {}
+
         self.log(
             {
                 "losses/auxiliary": auxiliary_loss.item(),
@@ -143,9 +179,11 @@ class FractalZeroTrainer:
                 ),
                 "data/batch_size": len(self.target_auxiliaries),
                 "data/empty_frames_in_batch": self.num_empty_frames,
+                **mean_min_max_dict("data/importance_weights", self.importance_weights),
                 **mean_min_max_dict(
                     "lr/learning_rates", self.lr_scheduler.get_last_lr()
                 ),
+                **prefetch_metrics,
             }
         )
 
@@ -1,5 +1,5 @@
 from copy import deepcopy
-from typing import Any, Callable, List, Sequence
+from typing import Any, Callable, List, Sequence, Union
 import gym
 import numpy as np
 
@@ -47,7 +47,23 @@ def mean_min_max_dict(name: str, arr) -> dict:
         f"{name}/max": arr.max(),
     }
 
-def normalize_and_log_exp(vector: torch.Tensor) -> torch.Tensor:
+def normalize_and_log_exp(vector: torch.Tensor, dim: int = None) -> torch.Tensor:
+    if dim is not None:
+        # every slice along `dim` is relativized independently (i.e. groups of walkers).
+        mean = torch.mean(vector, dim=dim, keepdim=True)
+        std = torch.std(vector, dim=dim, keepdim=True)
+        constant = std == 0
+        relativized_vector = (vector - mean) / torch.where(constant, 1, std)
+        return torch.where(
+            constant,
+            torch.ones_like(relativized_vector),
+            torch.where(
+                relativized_vector > 0,
+                torch.log1p(relativized_vector) + 1,
+                torch.exp(relativized_vector),
+            ),
+        )
+
     mean = torch.mean(vector)
     std = torch.std(vector)
     if std == 0:
@@ -66,6 +82,44 @@ def normalize_and_log_exp(vector: torch.Tensor) -> torch.Tensor:
     )
 
 
+RNGSeed = Union[int, np.random.Generator, torch.Generator]
+
+
+def get_rng(seed: RNGSeed = None) -> np.random.Generator:
+    """A numpy generator from a seed, an existing generator (returned as is) or a torch
+    generator (which seeds a new numpy generator).
+    """
+
+    if isinstance(seed, np.random.Generator):
+        return seed
+    if isinstance(seed, torch.Generator):
+        seed = int(torch.randint(2**62, (1,), generator=seed))
+    return np.random.default_rng(seed)
+
+
+def spawn_rngs(rng: np.random.Generator, n: int) -> List[np.random.Generator]:
+    """`n` independent generators, derived from `rng`."""
+
+    seed_sequence = np.random.SeedSequence(rng.integers(2**63, size=4))
+    return [np.random.default_rng(child) for child in seed_sequence.spawn(n)]
+
+
+def select_indices(values: Any, indices: np.ndarray):
+    """Index arrays and tensors directly, other sequences item by item."""
+
+    if isinstance(values, (np.ndarray, torch.Tensor)):
+        return values[indices]
+    return [values[i] for i in indices]
+
+
+def as_float(value) -> float:
+    """`float(value)`, detaching tensors first (so rewards that require grad don't warn)."""
+
+    if isinstance(value, torch.Tensor):
+        return value.detach().item()
+    return float(value)
+
+
 def _clone_sequence(
     l: Sequence, clone_partners, clone_mask, clone_func: Callable = None
 ):
@@ -1,13 +1,29 @@
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from typing import Callable, List, Union
+from functools import partial
+from multiprocessing import shared_memory
+from typing import Callable, List, Sequence, Union
+import asyncio
+import inspect
+import multiprocessing
+import os
+import threading
 import gym
 import ray
 import torch
 import numpy as np
 
 from fractal_zero.models.joint_model import JointModel
-from fractal_zero.utils import get_space_shape
+from fractal_zero.snapshots import get_snapshotter
+from fractal_zero.space_sampler import get_space_sampler
+from fractal_zero.utils import (
+    RNGSeed,
+    get_rng,
+    get_space_shape,
+    select_indices,
+    spawn_rngs,
+)
 
 
 def load_environment(env: Union[str, gym.Env], copy: bool = False) -> gym.Env:
@@ -23,20 +39,61 @@ class VectorizedEnvironment(ABC):
     action_space: gym.Space
     n: int
 
-    def __init__(self, env: Union[str, gym.Env], n: int):
+    def __init__(
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        seed: RNGSeed = None,
+    ):
         env = load_environment(env)
         self._action_space = env.action_space
         self.n = n
 
-    def batched_action_space_sample(self):
-        actions = []
-        for _ in range(self.n):
-            actions.append(self._action_space.sample())
-        return actions
+        # actions and environment resets are drawn from independent streams, both derived from
+        # `seed`. all walkers' actions are drawn at once, from a single generator.
+        self.rng = get_rng(seed)
+        action_rng, self._reset_rng = spawn_rngs(self.rng, 2)
+        self._action_sampler = get_space_sampler(deepcopy(self._action_space), action_rng)
+        self._seed_resets = seed is not None
+
+    def _get_reset_kwargs(self, kwargs: dict) -> List[dict]:
+        """Keyword arguments for every walker's reset. If a seed was given, the first reset
+        seeds every walker's environment with its own seed (later resets continue each
+        environment's own RNG, like gym does).
+        """
+
+        if not self._seed_resets or "seed" in kwargs:
+            return [kwargs] * self.n
+
+        self._seed_resets = False
+        seeds = self._reset_rng.integers(2**31, size=self.n).tolist()
+        return [{**kwargs, "seed": seed} for seed in seeds]
+
+    def batched_action_space_sample(self, n: int = None):
+        return self._action_sampler.sample(self.n if n is None else n)
 
     def batch_step(self, actions, frozen_mask):
         raise NotImplementedError
 
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        """Step only the walkers at `walker_indices` (`actions` has one action per given walker),
+        the other walkers are left untouched. Returns the same values as `batch_step`, but only
+        for the given walkers, so the amount of work scales with the number of active walkers.
+
+        By default this falls back to `batch_step` with all other walkers frozen.
+        """
+
+        walker_indices = np.asarray(walker_indices, dtype=np.int64)
+
+        frozen_mask = np.ones(self.n, dtype=bool)
+        frozen_mask[walker_indices] = False
+        all_actions = [None] * self.n
+        for i, action in zip(walker_indices.tolist(), actions):
+            all_actions[i] = action
+
+        ret = self.batch_step(all_actions, frozen_mask, *args, **kwargs)
+        return tuple(select_indices(values, walker_indices) for values in ret)
+
     def batch_reset(self):
         raise NotImplementedError
 
@@ -47,64 +104,130 @@ class VectorizedEnvironment(ABC):
         raise NotImplementedError
 
 
-@ray.remote
-class _RayWrappedEnvironment:
+class _WrappedEnvironment:
     def __init__(self, env: Union[str, gym.Env]):
-        self._env = load_environment(env)
-
-    def set_state(self, env: gym.Env):
+        self._env = load_environment(env, copy=True)
+        self._snapshotter = get_snapshotter(self._env)
         self.last_ret = None
 
-        if not isinstance(env, gym.Env):
-            raise ValueError(f"Expected a gym environment. Got {type(env)}.")
+        # a call that was cancelled (i.e. timed out) while still running in its thread, together
+        # with the snapshot to roll back to once it finished (see `_async_call`).
+        self._abandoned_call = None
 
-        self._env = deepcopy(env)
+    @property
+    def action_space(self):
+        return self._env.action_space
 
-    def get_state(self) -> gym.Env:
-        return self._env
+    @property
+    def supports_snapshots(self) -> bool:
+        return self._snapshotter is not None
 
-    def reset(self, *args, **kwargs):
-        self.last_ret = None
-        return self._env.reset(*args, **kwargs)
+    def _settle(self):
+        """Wait for an abandoned call to finish, and roll back what it did."""
 
-    def step(self, action, *args, **kwargs):
-        self.last_ret = self._env.step(action, *args, **kwargs)
-        return self.last_ret
+        if self._abandoned_call is None:
+            return
 
-    def empty_step(self):
-        obs, _, done, info = self.last_ret
-        return obs, 0, done, info
+        finished, snapshot = self._abandoned_call
+        finished.wait()
+        self._abandoned_call = None
+        self.restore_snapshot(snapshot)
 
-    def get_action_space(self):
-        return self._env.action_space
+    def get_snapshot(self):
+        self._settle()
 
+        # NOTE: the last return is shared rather than copied. environments create new
+        # observations every step, so it's never modified in-place.
+        if self._snapshotter is None:
+            # environments without a snapshotter are sent whole, and copied when restored.
+            return self.last_ret, self._env
+        return self.last_ret, self._snapshotter.get_snapshot(self._env)
 
-class _WrappedEnvironment:
-    def __init__(self, env: Union[str, gym.Env]):
-        self._env = load_environment(env, copy=True)
+    def restore_snapshot(self, snapshot):
+        self._settle()
 
-    @property
-    def action_space(self):
-        return self._env.action_space
+        self.last_ret, env_snapshot = snapshot
+        if self._snapshotter is None:
+            self._env = deepcopy(env_snapshot)
+        else:
+            self._snapshotter.restore_snapshot(self._env, env_snapshot)
 
     def set_state(self, env: gym.Env):
         if not isinstance(env, gym.Env):
             raise ValueError(f"Expected a gym environment. Got {type(env)}.")
 
+        self._settle()
         self.last_ret = None
         self._env = deepcopy(env)
+        self._snapshotter = get_snapshotter(self._env)
 
     def get_state(self) -> gym.Env:
+        self._settle()
         return self._env
 
+    def _set_reset_return(self, ret, return_info: bool = False):
+        # walkers that are frozen before ever being stepped re-emit their reset observation.
+        obs, info = ret if return_info else (ret, {})
+        self.last_ret = obs, 0, False, info
+
     def reset(self, *args, **kwargs):
-        self.last_ret = None
-        return self._env.reset(*args, **kwargs)
+        self._settle()
+        ret = self._env.reset(*args, **kwargs)
+        self._set_reset_return(ret, kwargs.get("return_info", False))
+        return ret
 
     def step(self, action, *args, **kwargs):
+        self._settle()
         self.last_ret = self._env.step(action, *args, **kwargs)
         return self.last_ret
 
+    async def _async_call(self, method: str, *args, **kwargs):
+        """Call the environment's `method`. Synchronous methods are run in a thread, so they don't
+        block the event loop.
+
+        When the call is cancelled (i.e. it timed out), the environment is rolled back to the
+        state from before the call. A synchronous call can't be interrupted and keeps running in
+        its thread though, so until it finished the environment isn't touched again.
+        """
+
+        if self._abandoned_call is not None:
+            await asyncio.to_thread(self._abandoned_call[0].wait)
+        self._settle()
+
+        if self._snapshotter is None:
+            snapshot = self.last_ret, deepcopy(self._env)
+        else:
+            snapshot = self.get_snapshot()
+
+        func = getattr(self._env, method)
+        finished = threading.Event()
+
+        def _call():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finished.set()
+
+        try:
+            if inspect.iscoroutinefunction(func):
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    finished.set()
+            return await asyncio.to_thread(_call)
+        except asyncio.CancelledError:
+            self._abandoned_call = finished, snapshot
+            raise
+
+    async def async_reset(self, *args, **kwargs):
+        ret = await self._async_call("reset", *args, **kwargs)
+        self._set_reset_return(ret, kwargs.get("return_info", False))
+        return ret
+
+    async def async_step(self, action, *args, **kwargs):
+        self.last_ret = await self._async_call("step", action, *args, **kwargs)
+        return self.last_ret
+
     def empty_step(self):
         obs, _, done, info = self.last_ret
         return obs, 0, done, info
@@ -112,94 +235,195 @@ class _WrappedEnvironment:
     def get_action_space(self):
         return self._env.action_space
 
+    def __getstate__(self):
+        # copies never include an abandoned call.
+        self._settle()
+        return self.__dict__.copy()
+
+
+@ray.remote
+class _RayEnvironmentShard:
+    """Ray actor that owns a contiguous block of walkers and steps them in a local loop, so the
+    number of tasks per step scales with the number of actors instead of walkers.
+    """
+
+    def __init__(self, env: Union[str, gym.Env], n: int):
+        self.envs = [_WrappedEnvironment(env) for _ in range(n)]
+
+    def set_state(self, env: gym.Env):
+        for wrapped_env in self.envs:
+            wrapped_env.set_state(env)
+
+    def reset(self, args: tuple, walker_kwargs: List[dict]):
+        return [env.reset(*args, **kwargs) for env, kwargs in zip(self.envs, walker_kwargs)]
+
+    def step(self, actions, frozen_mask, *args, **kwargs):
+        observations = []
+        rewards = np.zeros(len(self.envs), dtype=float)
+        dones = np.zeros(len(self.envs), dtype=bool)
+        infos = []
+        for i, env in enumerate(self.envs):
+            if frozen_mask[i]:
+                ret = env.empty_step()
+            else:
+                ret = env.step(actions[i], *args, **kwargs)
+
+            obs, rewards[i], dones[i], info = ret
+            observations.append(obs)
+            infos.append(info)
+
+        return observations, rewards, dones, infos
+
+    def get_snapshots(self, indices: List[int]):
+        return [self.envs[i].get_snapshot() for i in indices]
+
+    def restore_snapshots(self, indices: List[int], locations: List[tuple], *snapshots):
+        # `snapshots` are the results of `get_snapshots` calls on (possibly) other shards. ray
+        # resolves them before this runs, without a round-trip through the driver.
+        for i, (arg_index, position) in zip(indices, locations):
+            self.envs[i].restore_snapshot(snapshots[arg_index][position])
+
 
 class RayVectorizedEnvironment(VectorizedEnvironment):
-    envs: List[_RayWrappedEnvironment]
+    shards: List[_RayEnvironmentShard]
 
     def __init__(
-        self, env: Union[str, gym.Env], n: int, observation_encoder: Callable = None
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        observation_encoder: Callable = None,
+        walkers_per_actor: int = 1,
+        seed: RNGSeed = None,
     ):
-        super().__init__(env, n)
+        # NOTE: actions are sampled on the driver, instead of asking every actor for its
+        # action space.
+        super().__init__(env, n, seed=seed)
 
         # TODO: explain
         self.observation_encoder = (
             observation_encoder if observation_encoder else torch.tensor
         )
 
-        self.envs = [_RayWrappedEnvironment.remote(env) for _ in range(n)]
+        # each actor owns a contiguous block of walkers.
+        self.walkers_per_actor = walkers_per_actor
+        starts = list(range(0, n, walkers_per_actor))
+        self._shard_bounds = [(start, min(start + walkers_per_actor, n)) for start in starts]
+        self.shards = [
+            _RayEnvironmentShard.remote(env, end - start)
+            for start, end in self._shard_bounds
+        ]
+
+        self._walker_shards = np.repeat(
+            np.arange(len(self.shards)), [end - start for start, end in self._shard_bounds]
+        )
+        self._walker_local_indices = np.arange(n) - np.array(starts)[self._walker_shards]
+
+    @property
+    def num_actors(self) -> int:
+        return len(self.shards)
 
     def batch_reset(self, *args, **kwargs):
-        return ray.get([env.reset.remote(*args, **kwargs) for env in self.envs])
+        walker_kwargs = self._get_reset_kwargs(kwargs)
+        returns = ray.get(
+            [
+                shard.reset.remote(args, walker_kwargs[start:end])
+                for shard, (start, end) in zip(self.shards, self._shard_bounds)
+            ]
+        )
+        return [obs for shard_observations in returns for obs in shard_observations]
 
     def batch_step(self, actions, frozen_mask, *args, **kwargs):
         assert len(actions) == self.n
 
         returns = []
-        for i, env in enumerate(self.envs):
-            if frozen_mask[i]:
-                returns.append(env.empty_step.remote())
-            else:
-                action = actions[i]
-                ret = env.step.remote(action, *args, **kwargs)
-                returns.append(ret)
+        for shard, (start, end) in zip(self.shards, self._shard_bounds):
+            ret = shard.step.remote(
+                actions[start:end], frozen_mask[start:end], *args, **kwargs
+            )
+            returns.append(ret)
 
         observations = []
-        rewards = []
-        dones = []
         infos = []
-        for ret in ray.get(returns):
-            obs, rew, done, info = ret
-            observations.append(obs)
-            rewards.append(rew)
-            dones.append(done)
-            infos.append(info)
+        shard_rewards = []
+        shard_dones = []
+        for shard_observations, rewards, dones, shard_infos in ray.get(returns):
+            observations.extend(shard_observations)
+            infos.extend(shard_infos)
+            shard_rewards.append(rewards)
+            shard_dones.append(dones)
 
         states = self.observation_encoder(observations)
 
         return (
             states,
             observations,
-            torch.tensor(rewards, dtype=float),
-            torch.tensor(dones, dtype=bool),
+            torch.tensor(np.concatenate(shard_rewards), dtype=float),
+            torch.tensor(np.concatenate(shard_dones), dtype=bool),
             infos,
         )
 
     def set_all_states(self, new_env: gym.Env, obs: np.ndarray):
         # NOTE: don't need to call ray.get here.
-        [env.set_state.remote(new_env) for env in self.envs]
+        [shard.set_state.remote(new_env) for shard in self.shards]
 
     def clone(self, partners, clone_mask):
         assert len(clone_mask) == self.n
 
-        new_envs = []
-
-        # TODO: this kind of cloning might not be the same as vectorized cloning!!!
-        for i, do_clone in enumerate(clone_mask):
-            wrapped_env = self.envs[i]
-
-            if do_clone:
-                new_state = self.envs[partners[i]].get_state.remote()
-                wrapped_env.set_state.remote(new_state)
-
-            new_envs.append(wrapped_env)
-
-        self.envs = new_envs
-
-    def batched_action_space_sample(self):
-        actions = []
-        for env in self.envs:
-            action_space = ray.get(env.get_action_space.remote())
-            actions.append(action_space.sample())
-        return actions
+        clone_indices = np.flatnonzero(np.asarray(clone_mask, dtype=bool))
+        if len(clone_indices) == 0:
+            return
+        partners = np.asarray(partners)[clone_indices]
+
+        # every shard is asked once for the snapshots of its walkers that are being cloned to.
+        # a partner shared by multiple cloned walkers is only snapshotted once.
+        snapshot_refs = {}
+        snapshot_positions = {}
+        for partner in np.unique(partners).tolist():
+            shard = int(self._walker_shards[partner])
+            positions = snapshot_positions.setdefault(shard, {})
+            positions[partner] = len(positions)
+        for shard, positions in snapshot_positions.items():
+            local_indices = self._walker_local_indices[list(positions.keys())].tolist()
+            snapshot_refs[shard] = self.shards[shard].get_snapshots.remote(local_indices)
+
+        # the snapshot object refs are passed directly to the restoring shards, so the driver
+        # never waits. all snapshots are requested before any restore, because actors execute
+        # calls in the order they were submitted and partners may be cloned as well.
+        restores = {}
+        for i, partner in zip(clone_indices.tolist(), partners.tolist()):
+            restores.setdefault(int(self._walker_shards[i]), []).append((i, partner))
+
+        for shard, walkers in restores.items():
+            source_shards = sorted({int(self._walker_shards[p]) for _, p in walkers})
+            arg_indices = {source: k for k, source in enumerate(source_shards)}
+
+            local_indices = [int(self._walker_local_indices[i]) for i, _ in walkers]
+            locations = [
+                (
+                    arg_indices[int(self._walker_shards[p])],
+                    snapshot_positions[int(self._walker_shards[p])][p],
+                )
+                for _, p in walkers
+            ]
+            self.shards[shard].restore_snapshots.remote(
+                local_indices,
+                locations,
+                *[snapshot_refs[source] for source in source_shards],
+            )
 
 
 class SerialVectorizedEnvironment(VectorizedEnvironment):
-    envs: List[gym.Env]
+    envs: List[_WrappedEnvironment]
 
     def __init__(
-        self, env: Union[str, gym.Env], n: int, observation_encoder: Callable = None
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        observation_encoder: Callable = None,
+        use_snapshots: bool = True,
+        seed: RNGSeed = None,
     ):
-        super().__init__(env, n)
+        super().__init__(env, n, seed=seed)
 
         # TODO: explain
         self.observation_encoder = (
@@ -208,23 +432,48 @@ class SerialVectorizedEnvironment(VectorizedEnvironment):
 
         self.envs = [_WrappedEnvironment(env) for _ in range(n)]
 
+        # when possible, cloning copies only the minimal simulator state instead of deepcopying
+        # entire environments (see `fractal_zero.snapshots`).
+        self.use_snapshots = use_snapshots and all(
+            env.supports_snapshots for env in self.envs
+        )
+
     def batch_reset(self, *args, **kwargs):
-        return [env.reset(*args, **kwargs) for env in self.envs]
+        return [
+            env.reset(*args, **walker_kwargs)
+            for env, walker_kwargs in zip(self.envs, self._get_reset_kwargs(kwargs))
+        ]
+
+    def _step_walkers(self, walker_indices, actions, frozen_mask, *args, **kwargs):
+        # `actions` has one action per walker in `walker_indices`.
+        returns = []
+        for i, action in zip(walker_indices, actions):
+            env = self.envs[i]
+            if frozen_mask is not None and frozen_mask[i]:
+                ret = env.empty_step()
+            else:
+                ret = env.step(action, *args, **kwargs)
+            returns.append(ret)
+        return returns
 
     def batch_step(self, actions, frozen_mask, *args, **kwargs):
         assert len(actions) == self.n
 
+        returns = self._step_walkers(range(self.n), actions, frozen_mask, *args, **kwargs)
+        return self._collate_returns(returns)
+
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        assert len(walker_indices) == len(actions)
+
+        returns = self._step_walkers(walker_indices, actions, None, *args, **kwargs)
+        return self._collate_returns(returns)
+
+    def _collate_returns(self, returns: list):
         observations = []
         rewards = []
         dones = []
         infos = []
-        for i, env in enumerate(self.envs):
-            if frozen_mask[i]:
-                ret = env.empty_step()
-            else:
-                action = actions[i]
-                ret = env.step(action, *args, **kwargs)
-
+        for ret in returns:
             obs, rew, done, info = ret
             observations.append(obs)
             rewards.append(rew)
@@ -242,11 +491,16 @@ class SerialVectorizedEnvironment(VectorizedEnvironment):
         )
 
     def set_all_states(self, new_env: gym.Env, obs: np.ndarray):
-        self.envs = [deepcopy(new_env) for _ in range(self.n)]
+        for env in self.envs:
+            env.set_state(new_env)
 
     def clone(self, partners, clone_mask):
         assert len(clone_mask) == self.n
 
+        if self.use_snapshots:
+            self._snapshot_clone(partners, clone_mask)
+            return
+
         new_envs = []
         for i, do_clone in enumerate(clone_mask):
             env = self.envs[i]
@@ -255,18 +509,658 @@ class SerialVectorizedEnvironment(VectorizedEnvironment):
             new_envs.append(env)
         self.envs = new_envs
 
-    def batched_action_space_sample(self):
-        actions = []
-        for env in self.envs:
-            action_space = env.action_space
-            action_space.seed(None)  # TODO: better way to do this..
-            actions.append(action_space.sample())
-        return actions
+    def _snapshot_clone(self, partners, clone_mask):
+        clone_indices = np.flatnonzero(np.asarray(clone_mask, dtype=bool)).tolist()
+        partners = np.asarray(partners).tolist()
+
+        # all snapshots are taken before restoring any, because partners may be cloned as well.
+        snapshots = {
+            partners[i]: self.envs[partners[i]].get_snapshot() for i in clone_indices
+        }
+        for i in clone_indices:
+            self.envs[i].restore_snapshot(snapshots[partners[i]])
+
+
+class ThreadPoolVectorizedEnvironment(SerialVectorizedEnvironment):
+    """Steps chunks of walkers concurrently on a thread pool. Nothing is pickled, so this is the
+    cheapest parallel backend for environments that release the GIL while stepping (C
+    extensions, physics engines, etc.). Pure python environments will not get any faster.
+
+    Cloning is the same as `SerialVectorizedEnvironment`.
+    """
+
+    def __init__(
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        observation_encoder: Callable = None,
+        num_workers: int = None,
+        use_snapshots: bool = True,
+        seed: RNGSeed = None,
+    ):
+        super().__init__(
+            env,
+            n,
+            observation_encoder=observation_encoder,
+            use_snapshots=use_snapshots,
+            seed=seed,
+        )
+
+        self.num_workers = min(num_workers if num_workers else os.cpu_count(), n)
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+    def _step_chunks(self, walker_indices, actions, frozen_mask, *args, **kwargs):
+        # each worker steps one contiguous chunk of walkers per call.
+        num_chunks = max(1, min(self.num_workers, len(walker_indices)))
+        bounds = np.cumsum([0] + [len(c) for c in np.array_split(walker_indices, num_chunks)])
+
+        futures = [
+            self._executor.submit(
+                self._step_walkers,
+                walker_indices[start:end],
+                actions[start:end],
+                frozen_mask,
+                *args,
+                **kwargs,
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        returns = [ret for future in futures for ret in future.result()]
+        return self._collate_returns(returns)
+
+    def batch_step(self, actions, frozen_mask, *args, **kwargs):
+        assert len(actions) == self.n
+        return self._step_chunks(np.arange(self.n), actions, frozen_mask, *args, **kwargs)
+
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        assert len(walker_indices) == len(actions)
+        return self._step_chunks(
+            np.asarray(walker_indices, dtype=np.int64), actions, None, *args, **kwargs
+        )
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class AsyncVectorizedEnvironment(SerialVectorizedEnvironment):
+    """Awaits the `step`/`reset` calls of all walkers at once. Meant for I/O bound environments
+    (remote simulators, RPC clients, etc.) whose `step` and `reset` are coroutines, although
+    synchronous environments are supported by running them in threads.
+
+    At most `max_concurrency` calls are in flight at a time, and each call fails with a
+    `TimeoutError` after `timeout` seconds. Walkers whose calls time out (or are cancelled) are
+    rolled back to their state from before the call. `batch_step`/`batch_reset` are synchronous (they run
+    on the environment's own event loop), for use inside async code await `async_batch_step`
+    and `async_batch_reset` instead.
+
+    Cloning is the same as `SerialVectorizedEnvironment`.
+    """
+
+    def __init__(
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        observation_encoder: Callable = None,
+        max_concurrency: int = None,
+        timeout: float = None,
+        use_snapshots: bool = True,
+        seed: RNGSeed = None,
+    ):
+        super().__init__(
+            env,
+            n,
+            observation_encoder=observation_encoder,
+            use_snapshots=use_snapshots,
+            seed=seed,
+        )
+
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+
+    async def _gather(self, calls: List[Callable], description: str, walker_indices=None):
+        semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+
+        async def _call(i: int, call: Callable):
+            # NOTE: the timeout only starts once the call holds the semaphore.
+            try:
+                if semaphore is None:
+                    return await asyncio.wait_for(call(), self.timeout)
+                async with semaphore:
+                    return await asyncio.wait_for(call(), self.timeout)
+            except asyncio.TimeoutError:
+                walker = i if walker_indices is None else walker_indices[i]
+                raise TimeoutError(
+                    f"Walker {walker} timed out after {self.timeout}s while {description}."
+                )
+
+        tasks = [asyncio.ensure_future(_call(i, call)) for i, call in enumerate(calls)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # don't leave the other calls running in the background.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def async_batch_reset(self, *args, **kwargs):
+        calls = [
+            partial(env.async_reset, *args, **walker_kwargs)
+            for env, walker_kwargs in zip(self.envs, self._get_reset_kwargs(kwargs))
+        ]
+        return await self._gather(calls, "resetting")
+
+    async def async_batch_step(self, actions, frozen_mask, *args, **kwargs):
+        assert len(actions) == self.n
+
+        calls = []
+        for i, env in enumerate(self.envs):
+            if frozen_mask[i]:
+                calls.append(partial(asyncio.sleep, 0, env.empty_step()))
+            else:
+                calls.append(partial(env.async_step, actions[i], *args, **kwargs))
+
+        returns = await self._gather(calls, "stepping")
+        return self._collate_returns(returns)
+
+    async def async_batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        assert len(walker_indices) == len(actions)
+
+        calls = [
+            partial(self.envs[i].async_step, action, *args, **kwargs)
+            for i, action in zip(walker_indices, actions)
+        ]
+        returns = await self._gather(calls, "stepping", walker_indices)
+        return self._collate_returns(returns)
+
+    def batch_reset(self, *args, **kwargs):
+        return self._loop.run_until_complete(self.async_batch_reset(*args, **kwargs))
+
+    def batch_step(self, actions, frozen_mask, *args, **kwargs):
+        return self._loop.run_until_complete(
+            self.async_batch_step(actions, frozen_mask, *args, **kwargs)
+        )
+
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        return self._loop.run_until_complete(
+            self.async_batch_step_walkers(walker_indices, actions, *args, **kwargs)
+        )
+
+    def close(self):
+        self._loop.close()
+
+
+def _process_shard_worker(
+    remote,
+    env: Union[str, gym.Env],
+    n: int,
+    start: int,
+    end: int,
+    buffers: List[shared_memory.SharedMemory],
+    observation_shape: tuple,
+    observation_dtype: np.dtype,
+):
+    """Worker process loop. Owns the walkers `[start, end)` and writes their step results
+    straight into the shared memory buffers, so only the (usually empty) infos and snapshots
+    are ever pickled.
+    """
+
+    envs = [_WrappedEnvironment(env) for _ in range(end - start)]
+
+    observation_buffer, reward_buffer, done_buffer = buffers
+    observations = np.ndarray(
+        (n, *observation_shape), dtype=observation_dtype, buffer=observation_buffer.buf
+    )[start:end]
+    rewards = np.ndarray((n,), dtype=float, buffer=reward_buffer.buf)[start:end]
+    dones = np.ndarray((n,), dtype=bool, buffer=done_buffer.buf)[start:end]
+
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == "close":
+                break
+
+            try:
+                result = _run_shard_command(envs, observations, rewards, dones, command, data)
+            except Exception as e:
+                remote.send((False, e))
+            else:
+                remote.send((True, result))
+    finally:
+        # drop the views before closing, otherwise the buffers can't be released.
+        del observations, rewards, dones
+        remote.close()
+
+
+def _run_shard_command(
+    envs: List[_WrappedEnvironment],
+    observations: np.ndarray,
+    rewards: np.ndarray,
+    dones: np.ndarray,
+    command: str,
+    data,
+):
+    if command == "step":
+        actions, frozen_mask, args, kwargs = data
+        infos = []
+        for i, env in enumerate(envs):
+            if frozen_mask[i]:
+                ret = env.empty_step()
+            else:
+                ret = env.step(actions[i], *args, **kwargs)
+
+            observations[i], rewards[i], dones[i], info = ret
+            infos.append(info)
+        return infos
+
+    if command == "reset":
+        args, walker_kwargs = data
+        for i, env in enumerate(envs):
+            observations[i] = env.reset(*args, **walker_kwargs[i])
+        return None
+
+    if command == "set_state":
+        for env in envs:
+            env.set_state(data)
+        return None
+
+    if command == "get_snapshots":
+        return [envs[i].get_snapshot() for i in data]
+
+    if command == "restore_snapshots":
+        for i, snapshot in data:
+            envs[i].restore_snapshot(snapshot)
+        return None
+
+    raise ValueError(f"Unknown command {command}.")
+
+
+class ProcessVectorizedEnvironment(VectorizedEnvironment):
+    """Steps walkers in a pool of persistent worker processes. Each worker owns a contiguous
+    block of walkers and writes their observations, rewards and dones into shared memory, which
+    the driver reads as numpy arrays without copying or unpickling anything.
+
+    Only environments with a fixed-shape `Box` observation space are supported. The workers must
+    be shut down with `close`.
+    """
+
+    def __init__(
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        observation_encoder: Callable = None,
+        num_workers: int = None,
+        start_method: str = None,
+        seed: RNGSeed = None,
+    ):
+        super().__init__(env, n, seed=seed)
+
+        env = load_environment(env)
+        observation_space = env.observation_space
+        if not isinstance(observation_space, gym.spaces.Box):
+            raise NotImplementedError(
+                f"Only Box observation spaces are supported. Got {type(observation_space)}."
+            )
+
+        # TODO: explain
+        self.observation_encoder = (
+            observation_encoder if observation_encoder else torch.clone
+        )
+
+        observation_size = int(np.prod(observation_space.shape))
+        self._buffers = [
+            shared_memory.SharedMemory(
+                create=True,
+                size=max(1, n * observation_space.dtype.itemsize * observation_size),
+            ),
+            shared_memory.SharedMemory(create=True, size=n * 8),
+            shared_memory.SharedMemory(create=True, size=n),
+        ]
+        self.observation_buffer = np.ndarray(
+            (n, *observation_space.shape),
+            dtype=observation_space.dtype,
+            buffer=self._buffers[0].buf,
+        )
+        self.reward_buffer = np.ndarray((n,), dtype=float, buffer=self._buffers[1].buf)
+        self.done_buffer = np.ndarray((n,), dtype=bool, buffer=self._buffers[2].buf)
+
+        # each worker owns a contiguous block of walkers.
+        num_workers = min(num_workers if num_workers else os.cpu_count(), n)
+        self._worker_bounds = [
+            (int(walkers[0]), int(walkers[-1]) + 1)
+            for walkers in np.array_split(np.arange(n), num_workers)
+        ]
+        self._walker_workers = np.repeat(
+            np.arange(num_workers), [end - start for start, end in self._worker_bounds]
+        )
+        self._walker_local_indices = (
+            np.arange(n) - np.array(self._worker_bounds)[self._walker_workers, 0]
+        )
+
+        context = multiprocessing.get_context(start_method)
+        self._remotes = []
+        self._processes = []
+        for start, end in self._worker_bounds:
+            remote, worker_remote = context.Pipe()
+            process = context.Process(
+                target=_process_shard_worker,
+                args=(
+                    worker_remote,
+                    env,
+                    n,
+                    start,
+                    end,
+                    self._buffers,
+                    observation_space.shape,
+                    observation_space.dtype,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_remote.close()
+
+            self._remotes.append(remote)
+            self._processes.append(process)
+
+        self.closed = False
+
+    @property
+    def num_workers(self) -> int:
+        return len(self._processes)
+
+    def _send(self, commands: dict):
+        """Send `{worker: (command, data)}` to the workers, then wait for all of their replies."""
+
+        for worker, message in commands.items():
+            self._remotes[worker].send(message)
+
+        # all replies are received before raising, so the pipes stay in sync.
+        replies = {worker: self._remotes[worker].recv() for worker in commands}
+        for success, result in replies.values():
+            if not success:
+                raise result
+        return {worker: result for worker, (_, result) in replies.items()}
+
+    def _broadcast(self, command: str, data=None):
+        return self._send({worker: (command, data) for worker in range(self.num_workers)})
+
+    def batch_reset(self, *args, **kwargs):
+        walker_kwargs = self._get_reset_kwargs(kwargs)
+        self._send(
+            {
+                worker: ("reset", (args, walker_kwargs[start:end]))
+                for worker, (start, end) in enumerate(self._worker_bounds)
+            }
+        )
+        return list(self.observation_buffer.copy())
+
+    def batch_step(self, actions, frozen_mask, *args, **kwargs):
+        assert len(actions) == self.n
+        frozen_mask = np.asarray(frozen_mask, dtype=bool)
+
+        replies = self._send(
+            {
+                worker: (
+                    "step",
+                    (actions[start:end], frozen_mask[start:end], args, kwargs),
+                )
+                for worker, (start, end) in enumerate(self._worker_bounds)
+            }
+        )
+        infos = [info for worker in range(self.num_workers) for info in replies[worker]]
+
+        # NOTE: the buffers are overwritten by the next step, and the search tree keeps the
+        # observations of every step, so they are copied once here.
+        observations = torch.from_numpy(self.observation_buffer.copy())
+        states = self.observation_encoder(observations)
+
+        return (
+            states,
+            observations,
+            torch.from_numpy(self.reward_buffer.copy()),
+            torch.from_numpy(self.done_buffer.copy()),
+            infos,
+        )
+
+    def set_all_states(self, new_env: gym.Env, obs: np.ndarray):
+        self._broadcast("set_state", new_env)
+
+    def clone(self, partners, clone_mask):
+        assert len(clone_mask) == self.n
+
+        clone_indices = np.flatnonzero(np.asarray(clone_mask, dtype=bool))
+        if len(clone_indices) == 0:
+            return
+        partners = np.asarray(partners)[clone_indices]
+
+        # all snapshots are taken before restoring any, because partners may be cloned as well.
+        unique_partners = np.unique(partners)
+        snapshot_requests = {}
+        for partner in unique_partners.tolist():
+            worker = int(self._walker_workers[partner])
+            snapshot_requests.setdefault(worker, []).append(partner)
+        replies = self._send(
+            {
+                worker: ("get_snapshots", self._walker_local_indices[walkers].tolist())
+                for worker, walkers in snapshot_requests.items()
+            }
+        )
+        snapshots = {
+            partner: snapshot
+            for worker, walkers in snapshot_requests.items()
+            for partner, snapshot in zip(walkers, replies[worker])
+        }
+
+        restores = {}
+        for i, partner in zip(clone_indices.tolist(), partners.tolist()):
+            restores.setdefault(int(self._walker_workers[i]), []).append(
+                (int(self._walker_local_indices[i]), snapshots[partner])
+            )
+        self._send(
+            {worker: ("restore_snapshots", data) for worker, data in restores.items()}
+        )
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        for remote in self._remotes:
+            remote.send(("close", None))
+        for process in self._processes:
+            process.join()
+        for remote in self._remotes:
+            remote.close()
+
+        del self.observation_buffer, self.reward_buffer, self.done_buffer
+        for buffer in self._buffers:
+            buffer.close()
+            buffer.unlink()
+
+    def __del__(self):
+        if not getattr(self, "closed", True):
+            self.close()
+
+
+class CartPoleVectorizedEnvironment(VectorizedEnvironment):
+    """CartPole where the physics state of all walkers is held in a single `(n, 4)` array. Every
+    walker is stepped with one batched numpy update and cloning is a single fancy-index
+    assignment, so no per-walker gym environments exist at all. The dynamics match gym's
+    `CartPoleEnv` (including its `TimeLimit` wrapper), and this class doubles as a reference for
+    writing other batched environments.
+    """
+
+    def __init__(
+        self,
+        env: Union[str, gym.Env] = "CartPole-v0",
+        n: int = 1,
+        observation_encoder: Callable = None,
+        seed: RNGSeed = None,
+    ):
+        super().__init__(env, n, seed=seed)
+
+        env = load_environment(env)
+        cartpole = env.unwrapped
+
+        # physics constants are taken from the given environment, in case they were customized.
+        self.gravity = cartpole.gravity
+        self.masspole = cartpole.masspole
+        self.total_mass = cartpole.total_mass
+        self.length = cartpole.length
+        self.polemass_length = cartpole.polemass_length
+        self.force_mag = cartpole.force_mag
+        self.tau = cartpole.tau
+        self.kinematics_integrator = cartpole.kinematics_integrator
+        self.theta_threshold_radians = cartpole.theta_threshold_radians
+        self.x_threshold = cartpole.x_threshold
+
+        self.max_episode_steps = env.spec.max_episode_steps if env.spec else None
+
+        # TODO: explain
+        self.observation_encoder = (
+            observation_encoder if observation_encoder else torch.clone
+        )
+
+        self._state = np.zeros((n, 4), dtype=np.float64)
+        self._elapsed_steps = np.zeros(n, dtype=np.int64)
+        self._terminated = np.zeros(n, dtype=bool)
+        self._dones = np.zeros(n, dtype=bool)
+
+    def batch_reset(self, *args, **kwargs):
+        if kwargs.get("seed") is not None:
+            self._reset_rng = get_rng(kwargs["seed"])
+        self._state[:] = self._reset_rng.uniform(low=-0.05, high=0.05, size=(self.n, 4))
+        self._elapsed_steps[:] = 0
+        self._terminated[:] = False
+        self._dones[:] = False
+        return torch.tensor(self._state, dtype=torch.float32)
+
+    def _physics_step(self, state: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        x, x_dot, theta, theta_dot = state.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.polemass_length * theta_dot**2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta**2 / self.total_mass)
+        )
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        if self.kinematics_integrator == "euler":
+            x = x + self.tau * x_dot
+            x_dot = x_dot + self.tau * xacc
+            theta = theta + self.tau * theta_dot
+            theta_dot = theta_dot + self.tau * thetaacc
+        else:  # semi-implicit euler
+            x_dot = x_dot + self.tau * xacc
+            x = x + self.tau * x_dot
+            theta_dot = theta_dot + self.tau * thetaacc
+            theta = theta + self.tau * theta_dot
+
+        return np.stack((x, x_dot, theta, theta_dot), axis=-1)
+
+    def _step_active(self, active, actions: np.ndarray) -> np.ndarray:
+        """Step the walkers selected by `active` (a mask or indices), returning their rewards."""
+
+        new_state = self._physics_step(self._state[active], actions)
+        self._state[active] = new_state
+
+        x, theta = new_state[:, 0], new_state[:, 2]
+        terminated = (
+            (x < -self.x_threshold)
+            | (x > self.x_threshold)
+            | (theta < -self.theta_threshold_radians)
+            | (theta > self.theta_threshold_radians)
+        )
+
+        # the step where the pole falls is still rewarded, but any steps after aren't.
+        rewards = np.where(self._terminated[active], 0.0, 1.0)
+
+        self._terminated[active] |= terminated
+        self._elapsed_steps[active] += 1
+
+        dones = self._terminated[active]
+        if self.max_episode_steps is not None:
+            dones |= self._elapsed_steps[active] >= self.max_episode_steps
+        self._dones[active] = dones
+
+        return rewards
+
+    def batch_step(self, actions, frozen_mask=None, *args, **kwargs):
+        assert len(actions) == self.n
+
+        if frozen_mask is None:
+            active = np.ones(self.n, dtype=bool)
+        else:
+            active = ~np.asarray(frozen_mask, dtype=bool)
+
+        # frozen walkers re-emit their previous done value.
+        rewards = np.zeros(self.n, dtype=np.float64)
+        rewards[active] = self._step_active(
+            active, np.asarray(actions).reshape(self.n)[active]
+        )
+
+        observations = torch.tensor(self._state, dtype=torch.float32)
+        states = self.observation_encoder(observations)
+        infos = [{} for _ in range(self.n)]
+
+        return (
+            states,
+            observations,
+            torch.from_numpy(rewards),
+            torch.from_numpy(self._dones.copy()),
+            infos,
+        )
+
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        walker_indices = np.asarray(walker_indices, dtype=np.int64)
+        assert len(walker_indices) == len(actions)
+
+        rewards = self._step_active(
+            walker_indices, np.asarray(actions).reshape(len(walker_indices))
+        )
+
+        observations = torch.tensor(self._state[walker_indices], dtype=torch.float32)
+        states = self.observation_encoder(observations)
+        infos = [{} for _ in range(len(walker_indices))]
+
+        return (
+            states,
+            observations,
+            torch.from_numpy(rewards),
+            torch.from_numpy(self._dones[walker_indices]),
+            infos,
+        )
+
+    def set_all_states(self, new_env: gym.Env, obs: np.ndarray):
+        self._state[:] = np.asarray(new_env.unwrapped.state, dtype=np.float64)
+        self._elapsed_steps[:] = getattr(new_env, "_elapsed_steps", None) or 0
+        self._terminated[:] = new_env.unwrapped.steps_beyond_terminated is not None
+        self._dones[:] = self._terminated
+
+    def clone(self, partners, clone_mask):
+        assert len(clone_mask) == self.n
+
+        clone_mask = np.asarray(clone_mask, dtype=bool)
+        partners = np.asarray(partners)[clone_mask]
+
+        self._state[clone_mask] = self._state[partners]
+        self._elapsed_steps[clone_mask] = self._elapsed_steps[partners]
+        self._terminated[clone_mask] = self._terminated[partners]
+        self._dones[clone_mask] = self._dones[partners]
 
 
 class VectorizedDynamicsModelEnvironment(VectorizedEnvironment):
-    def __init__(self, env: Union[str, gym.Env], n: int, joint_model: JointModel):
-        super().__init__(env, n)
+    def __init__(
+        self,
+        env: Union[str, gym.Env],
+        n: int,
+        joint_model: JointModel,
+        seed: RNGSeed = None,
+    ):
+        super().__init__(env, n, seed=seed)
 
         self._env = env
 
@@ -286,23 +1180,65 @@ class VectorizedDynamicsModelEnvironment(VectorizedEnvironment):
     def batch_reset(self, *args, **kwargs):
         obs = self._env.reset(*args, **kwargs)
         self.set_all_states(self._env, obs)
-        return obs
+        return [obs] * self.n
 
-    def batch_step(self, actions, frozen_mask=None, *args, **kwargs):
+    def _forward(self, state: torch.Tensor, actions):
         device = self.joint_model.device
 
-        if frozen_mask is not None:
-            raise NotImplementedError
-
         if not isinstance(actions, torch.Tensor):
-            actions = torch.tensor(actions, device=device).float().unsqueeze(-1)
+            actions = torch.tensor(np.asarray(actions), device=device).float()
+        actions = actions.reshape(len(state), -1)
 
+        self.dynamics_model.set_state(state)
         rewards = self.dynamics_model.forward(actions)
-        observations = self.dynamics_model.state
+        if rewards.shape[-1] == 1:
+            rewards = rewards.squeeze(-1)
+
+        return self.dynamics_model.state, rewards
+
+    def batch_step_walkers(self, walker_indices, actions, *args, **kwargs):
+        device = self.joint_model.device
+        walker_indices = torch.as_tensor(
+            np.asarray(walker_indices), dtype=torch.long, device=device
+        )
+
+        # only the given walkers' hidden states go through the dynamics model.
+        state = self.dynamics_model.state
+        new_states, rewards = self._forward(state[walker_indices], actions)
+
+        state = state.clone()
+        state[walker_indices] = new_states
+        self.dynamics_model.set_state(state)
+
+        dones = torch.zeros(len(walker_indices), dtype=bool, device=device)
+        infos = [{} for _ in range(len(walker_indices))]
+
+        return new_states, new_states, rewards, dones, infos
+
+    def batch_step(self, actions, frozen_mask=None, *args, **kwargs):
+        device = self.joint_model.device
+
+        if frozen_mask is None:
+            observations, rewards = self._forward(self.dynamics_model.state, actions)
+        else:
+            walker_indices = np.flatnonzero(~np.asarray(frozen_mask, dtype=bool))
+            _, active_rewards, _, _, _ = self.batch_step_walkers(
+                walker_indices, select_indices(actions, walker_indices)
+            )
+
+            # frozen walkers keep their hidden states, and get no reward.
+            observations = self.dynamics_model.state
+            rewards = torch.zeros(
+                (self.n, *active_rewards.shape[1:]),
+                dtype=active_rewards.dtype,
+                device=device,
+            )
+            rewards[walker_indices] = active_rewards
+
         dones = torch.zeros(self.n, dtype=bool, device=device)
         infos = [{} for _ in range(self.n)]
 
-        return observations, rewards, dones, infos
+        return observations, observations, rewards, dones, infos
 
     def set_all_states(self, new_env: gym.Env, obs: np.ndarray):
         # TODO: explain, also how this interacts with FMC.
@@ -318,6 +1254,29 @@ class VectorizedDynamicsModelEnvironment(VectorizedEnvironment):
 
         self.dynamics_model.set_state(batched_initial_state)
 
+    def set_root_observations(self, observations: Sequence):
+        """Split the walkers into `len(observations)` contiguous groups of equal size, each
+        starting from its own root observation. All roots are embedded with one forward pass of the
+        representation model.
+        """
+
+        device = self.joint_model.device
+
+        num_roots = len(observations)
+        if self.n % num_roots != 0:
+            raise ValueError(
+                f"Can't split {self.n} walkers evenly between {num_roots} root observations."
+            )
+
+        observations = torch.stack(
+            [torch.as_tensor(obs) for obs in observations]
+        ).to(device=device, dtype=torch.float)
+        states = self.representation_model.forward(observations)
+
+        self.dynamics_model.set_state(
+            states.repeat_interleave(self.n // num_roots, dim=0)
+        )
+
     def clone(self, partners, clone_mask):
         state = self.dynamics_model.state
         state[clone_mask] = state[partners[clone_mask]]